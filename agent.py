@@ -6,8 +6,12 @@ import re
 import time
 
 import numpy as np
-from openai import AzureOpenAI, OpenAI
-from vertexai.preview.generative_models import GenerativeModel
+
+from backends import close_stopped_tags, get_backend, parse_model
+from llm_cache import make_key
+from prompt_utils import count_tokens
+from save_utils import extract_answer
+from telemetry import phase
 
 
 class Agent:
@@ -22,6 +26,11 @@ class Agent:
         agents_num=6,
         azure=False,
         hf_models={},
+        cache=None,
+        cassette=None,
+        hf_batcher=None,
+        hf_prefix_cache=None,
+        telemetry=None,
     ):
         self.model = model
 
@@ -35,65 +44,114 @@ class Agent:
         self.messages = [{"role": "user", "content": self.initial_prompt}]
 
         self.round_prompt_cls = round_prompt_cls
-        if "gemini" in self.model:
-            self.model_instance = GenerativeModel(model)
         self.azure = azure
-        if azure:
-            self.client = AzureOpenAI(
-                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-                api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-                api_version="2023-05-15",
-            )
-        elif "gpt" in model:
-            self.client = OpenAI()
-        self.hf_model = True if "hf" in model else False
-        if "hf" in model:
-            self.hf_model, self.hf_tokenizer, self.hf_pipeline_gen = hf_models[model]
+        self.cache = cache
+        self.cassette = cassette
+        self.hf_batcher = hf_batcher
+        self.hf_prefix_cache = hf_prefix_cache
+        self.telemetry = telemetry
+        self.round_idx = None
+        self.prompt_build_time = None
+        self.prompt_tokens = None
+        self.generation_params = {}
+        self.provider, self.model_name = parse_model(model, azure)
+        self.backend = None
+        # when replaying a cassette, no model is ever called
+        if cassette is not None and cassette.mode == "replay":
+            return
+        self.backend = get_backend(
+            model,
+            azure=azure,
+            hf_model=hf_models.get(model),
+            hf_batcher=hf_batcher,
+            hf_prefix_cache=hf_prefix_cache,
+        )
 
-    def execute_round(self, answer_history, round_idx):
+    def execute_round(self, answer_history, round_idx, on_answer=None):
         """
         construct the prompt and call model
+        on_answer (optional): function called with the public answer as soon as </ANSWER> has been streamed
         """
-        slot_prompt = self.round_prompt_cls.build_slot_prompt(answer_history, round_idx)
-        agent_response = self.prompt("user", slot_prompt)
+        start = time.perf_counter()
+        with phase(self.telemetry, "build_slot_prompt", agent=self.agent_name, round=round_idx):
+            slot_prompt = self.round_prompt_cls.build_slot_prompt(answer_history, round_idx)
+        # also reported in the stats of the turn's llm_call span
+        self.prompt_build_time = time.perf_counter() - start
+        self.prompt_tokens = count_tokens(
+            self.initial_prompt + slot_prompt, getattr(self.round_prompt_cls, "tokenizer", None)
+        )
+        self.generation_params = self.round_prompt_cls.get_generation_params(round_idx)
+        self.round_idx = round_idx
+        agent_response = self.prompt("user", slot_prompt, on_answer)
         return slot_prompt, agent_response
 
-    def prompt(self, role, msg):
+    def prompt(self, role, msg, on_answer=None):
         """
-        call each model
+        call the model, or replay the response from the cassette.
+        Deterministic (temperature 0) calls go through the response cache if there is one.
         """
-        if "gpt" in self.model and not self.azure:
-            messages = self.messages + [{"role": role, "content": msg}]
-            response = self.client.chat.completions.create(
-                model=self.model, messages=messages, temperature=self.temperature
+        if self.cassette is not None and self.cassette.mode == "replay":
+            return self.cassette.replay(self.agent_name, msg)
+        turn = self.cassette.reserve_turn() if self.cassette is not None else None
+        stats = {
+            "prompt_build": self.prompt_build_time,
+            "local_prompt_tokens": self.prompt_tokens,
+            "prompt_layout": getattr(self.round_prompt_cls, "prompt_layout", "default"),
+            "cache_hit": False,
+        }
+        start = time.perf_counter()
+        if self.cache is None or self.temperature != 0:
+            content = self.call_model(role, msg, stats, on_answer)
+        else:
+            key = self.get_cache_key(role, msg)
+            content = self.cache.get(key)
+            if content is None:
+                content = self.call_model(role, msg, stats, on_answer)
+                self.cache.put(key, content)
+            else:
+                stats["cache_hit"] = True
+        stats["latency"] = time.perf_counter() - start
+        if self.telemetry is not None:
+            self.telemetry.record_call(
+                self.agent_name, self.model_name, self.round_idx, stats
             )
-            content = response.choices[0].message.content
-            return content
+        if self.cassette is not None:
+            self.cassette.record(self.agent_name, msg, content, turn)
+        return content
 
-        elif "gpt" in self.model and self.azure:
-            messages = self.messages + [{"role": role, "content": msg}]
-            response = self.client.chat.completions.create(
-                model=self.model, messages=messages, temperature=self.temperature
-            )
-            return response.choices[0].message.content
+    def get_cache_key(self, role, msg):
+        messages = self.backend.cache_messages(
+            self.messages + [{"role": role, "content": msg}]
+        )
+        return make_key(
+            self.provider, self.model, messages, self.temperature, **self.generation_params
+        )
 
-        elif "gemini" in self.model:
-            responses = self.model_instance.generate_content(
-                self.initial_prompt + msg,
-                generation_config={"temperature": self.temperature, "top_p": 1},
-                stream=True,
+    def call_model(self, role, msg, stats=None, on_answer=None):
+        """
+        call the agent's model backend, with the stop sequences and token budget of the current round
+        stats (optional dict) is filled with the telemetry of the call: queue wait, retries, time to first token, tokens
+        on_answer (optional): the response is streamed, and on_answer is called with the public answer as soon as
+        </ANSWER> has been generated, while the rest (the plan) is still being generated
+        """
+        if stats is None:
+            stats = {}
+        messages = self.messages + [{"role": role, "content": msg}]
+        if on_answer is None:
+            content = self.backend.generate(
+                messages, self.temperature, stats, **self.generation_params
             )
-            content = ""
-            for response in responses:
-                content += response.text
-            return content
+            return close_stopped_tags(content, self.generation_params.get("stop"))
 
-        elif self.hf_model:
-            chat = [{"role": "user", "content": self.initial_prompt + msg}]
-            model_input = self.hf_tokenizer.apply_chat_template(
-                chat, tokenize=False, add_generation_prompt=True, return_tensors="pt"
-            )
-            output_text = self.hf_pipeline_gen(
-                model_input, do_sample=True, temperature=self.temperature
-            )[0]["generated_text"]
-            return output_text
+        start = time.perf_counter()
+        content = ""
+        answered = False
+        for chunk in self.backend.stream(
+            messages, self.temperature, stats, **self.generation_params
+        ):
+            content += chunk
+            if not answered and "</ANSWER>" in content:
+                answered = True
+                stats["answer_latency"] = time.perf_counter() - start
+                on_answer(extract_answer(content))
+        return close_stopped_tags(content, self.generation_params.get("stop"))
@@ -0,0 +1,104 @@
+"""
+Registry of model backends.
+
+The model of an agent in config.txt is "<provider>:<model name>", e.g. "openai:gpt-4o-mini",
+"azure:gpt-4", "gemini:gemini-1.0-pro", "hf:meta-llama/Meta-Llama-3-8B-Instruct" or "mock:echo".
+Model names without a provider prefix are resolved as before: "gpt" models use OpenAI (Azure with --azure),
+"gemini" models use Vertex AI and "hf_<name>" models are local Hugging Face models.
+
+The module of a provider (and its client library) is only imported when a session uses it,
+so an API-only run never imports torch, transformers or vertexai.
+"""
+import importlib
+
+# provider -> (module, class) of its backend
+PROVIDERS = {
+    "openai": ("backends.openai_api", "OpenAIBackend"),
+    "azure": ("backends.openai_api", "AzureBackend"),
+    "gemini": ("backends.gemini", "GeminiBackend"),
+    "hf": ("backends.hf", "HFBackend"),
+    "mock": ("backends.mock", "MockBackend"),
+}
+
+
+def register_backend(provider, module, class_name):
+    """
+    Add (or replace) a provider. The module is imported when a model of this provider is first used.
+    """
+    PROVIDERS[provider] = (module, class_name)
+
+
+def parse_model(model, azure=False):
+    """
+    Provider and model name of a config.txt model.
+    """
+    provider, sep, model_name = model.partition(":")
+    if sep and provider in PROVIDERS:
+        return provider, model_name
+    # models without a provider prefix
+    if "gpt" in model:
+        return ("azure" if azure else "openai"), model
+    if "gemini" in model:
+        return "gemini", model
+    if "hf" in model:
+        return "hf", model.split("hf_")[-1]
+    raise ValueError(
+        f"Unknown model {model}, use one of the provider prefixes: {', '.join(p + ':' for p in PROVIDERS)}"
+    )
+
+
+def get_backend_class(provider):
+    module, class_name = PROVIDERS[provider]
+    return getattr(importlib.import_module(module), class_name)
+
+
+def get_backend(model, azure=False, **options):
+    """
+    Backend instance of a config.txt model. options are passed to the backend (e.g., hf_model for HF models).
+    """
+    provider, model_name = parse_model(model, azure)
+    return get_backend_class(provider)(model_name, **options)
+
+
+def close_stopped_tags(content, stop=None):
+    """
+    Output of a generation with stop sequences: cut after the first stop sequence (local models can generate
+    a few more characters in the same token), or re-append it where the API removed it (e.g., "</PLAN>" after
+    an open "<PLAN>").
+    """
+    if not stop:
+        return content
+    ends = [content.find(tag) + len(tag) for tag in stop if tag in content]
+    if ends:
+        return content[: min(ends)]
+    for tag in stop:
+        if tag.startswith("</") and "<" + tag[2:] in content:
+            return content + tag
+    return content
+
+
+class Backend:
+    """
+    Base class of backends. generate() calls the model on a list of chat messages and returns the answer text;
+    it fills stats (a dict) with the telemetry of the call: queue wait, retries, time to first token, tokens.
+    stop (list of stop sequences) and max_tokens (0 or None: no limit) bound the generation.
+    stream() yields the answer text in chunks; backends without streaming yield the whole answer at once.
+    """
+
+    provider = None
+
+    def __init__(self, model_name, **options):
+        self.model_name = model_name
+
+    def cache_messages(self, messages):
+        """
+        Representation of the request in response cache keys.
+        Backends without chat messages get the concatenated prompt.
+        """
+        return "".join(message["content"] for message in messages)
+
+    def generate(self, messages, temperature, stats, stop=None, max_tokens=None):
+        raise NotImplementedError
+
+    def stream(self, messages, temperature, stats, stop=None, max_tokens=None):
+        yield self.generate(messages, temperature, stats, stop, max_tokens)
@@ -0,0 +1,51 @@
+"""
+Gemini backend (Vertex AI).
+"""
+import time
+
+from vertexai.preview.generative_models import GenerativeModel
+
+from backends import Backend
+from rate_limit import call_with_retry, estimate_tokens
+
+
+class GeminiBackend(Backend):
+    provider = "gemini"
+
+    def __init__(self, model_name, **options):
+        super().__init__(model_name)
+        self.model_instance = GenerativeModel(model_name)
+
+    def generate(self, messages, temperature, stats, stop=None, max_tokens=None):
+        prompt = self.cache_messages(messages)
+        generation_config = {"temperature": temperature, "top_p": 1}
+        if stop:
+            generation_config["stop_sequences"] = list(stop)
+        if max_tokens:
+            generation_config["max_output_tokens"] = max_tokens
+
+        def generate():
+            # the stream is consumed inside the retried call, errors can happen mid-stream
+            start = time.perf_counter()
+            responses = self.model_instance.generate_content(
+                prompt,
+                generation_config=generation_config,
+                stream=True,
+            )
+            content = ""
+            for response in responses:
+                if not content:
+                    stats["ttft"] = time.perf_counter() - start
+                content += response.text
+                usage = getattr(response, "usage_metadata", None)
+                if usage:
+                    stats["prompt_tokens"] = usage.prompt_token_count
+                    stats["completion_tokens"] = usage.candidates_token_count
+            return content
+
+        return call_with_retry(
+            generate,
+            self.model_name,
+            estimated_tokens=estimate_tokens(prompt),
+            stats=stats,
+        )
@@ -0,0 +1,94 @@
+"""
+Local Hugging Face models.
+"""
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from backends import Backend
+
+
+class StopOnStrings(StoppingCriteria):
+    """
+    Stops each sequence of a (batched) generation once its generated text contains one of the stop strings.
+    """
+
+    def __init__(self, tokenizer, stop, tail_tokens=16):
+        self.tokenizer = tokenizer
+        self.stop = list(stop)
+        self.tail_tokens = tail_tokens
+        self.prompt_length = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.prompt_length is None:
+            # first call: one token has been generated
+            self.prompt_length = input_ids.shape[1] - 1
+        generated = input_ids[:, self.prompt_length :][:, -self.tail_tokens :]
+        tails = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+        return torch.tensor(
+            [any(tag in tail for tag in self.stop) for tail in tails],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+def get_generation_kwargs(tokenizer, stop=None, max_tokens=None, **generate_kwargs):
+    """
+    generate() arguments with a stopping criterion on the stop strings and max_tokens new tokens.
+    """
+    if stop:
+        generate_kwargs["stopping_criteria"] = StoppingCriteriaList(
+            [StopOnStrings(tokenizer, stop)]
+        )
+    if max_tokens:
+        generate_kwargs["max_new_tokens"] = max_tokens
+    return generate_kwargs
+
+
+class HFBackend(Backend):
+    provider = "hf"
+
+    def __init__(self, model_name, hf_model=None, hf_batcher=None, hf_prefix_cache=None, **options):
+        """
+        hf_model: (model, tokenizer, pipeline) tuple as returned by utils.setup_hf_model
+        hf_batcher / hf_prefix_cache: optional shared HFBatcher / HFPrefixCache of the model
+        """
+        super().__init__(model_name)
+        self.hf_model, self.hf_tokenizer, self.hf_pipeline_gen = hf_model
+        self.hf_batcher = hf_batcher
+        self.hf_prefix_cache = hf_prefix_cache
+
+    def generate(self, messages, temperature, stats, stop=None, max_tokens=None):
+        chat = [{"role": "user", "content": self.cache_messages(messages)}]
+        model_input = self.hf_tokenizer.apply_chat_template(
+            chat, tokenize=False, add_generation_prompt=True, return_tensors="pt"
+        )
+        if self.hf_prefix_cache is not None:
+            # reuses the cached key/values of the longest already seen prompt prefix
+            return self.hf_prefix_cache.generate(
+                model_input,
+                do_sample=True,
+                temperature=temperature,
+                stop=stop,
+                max_tokens=max_tokens,
+            )
+        if self.hf_batcher is not None:
+            # generated in a batch with the other agents and sessions using this model
+            # stop is passed as a tuple, the batcher groups requests by their (hashable) arguments
+            return self.hf_batcher.generate(
+                model_input,
+                do_sample=True,
+                temperature=temperature,
+                stop=tuple(stop or ()),
+                max_tokens=max_tokens,
+            )
+        output_text = self.hf_pipeline_gen(
+            model_input,
+            **get_generation_kwargs(
+                self.hf_tokenizer,
+                stop,
+                max_tokens,
+                do_sample=True,
+                temperature=temperature,
+            ),
+        )[0]["generated_text"]
+        return output_text
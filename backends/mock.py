@@ -0,0 +1,22 @@
+"""
+Mock backend for dry runs: no model is called.
+Agents answer in the expected format by repeating the last deal of their prompt.
+"""
+import re
+
+from backends import Backend
+
+
+class MockBackend(Backend):
+    provider = "mock"
+
+    def generate(self, messages, temperature, stats, stop=None, max_tokens=None):
+        prompt = self.cache_messages(messages)
+        # the format instructions contain empty <DEAL> </DEAL> tags
+        deals = [deal.strip() for deal in re.findall(r"<DEAL>(.*?)</DEAL>", prompt) if deal.strip()]
+        deal = deals[-1] if deals else ""
+        return (
+            "<SCRATCHPAD> mock </SCRATCHPAD> "
+            f"<ANSWER> I propose <DEAL>{deal}</DEAL> </ANSWER> "
+            "<PLAN> mock </PLAN>"
+        )
@@ -0,0 +1,94 @@
+"""
+OpenAI and Azure OpenAI chat completion backends.
+"""
+import time
+
+from backends import Backend
+from llm_clients import get_azure_client, get_openai_client
+from rate_limit import call_with_retry, estimate_tokens, get_limiter, get_used_tokens
+from telemetry import get_openai_usage
+
+
+class OpenAIBackend(Backend):
+    provider = "openai"
+    stream_usage = True
+
+    def __init__(self, model_name, **options):
+        super().__init__(model_name)
+        self.client = self.get_client()
+
+    def get_client(self):
+        return get_openai_client()
+
+    def cache_messages(self, messages):
+        return messages
+
+    def get_params(self, stop=None, max_tokens=None):
+        params = {}
+        if stop:
+            params["stop"] = list(stop)
+        if max_tokens:
+            params["max_tokens"] = max_tokens
+        return params
+
+    def estimate_tokens(self, messages, max_tokens=None):
+        # like the API's rate limiter, reserve the completion budget too (refunded from the usage)
+        return estimate_tokens(
+            "".join(message["content"] for message in messages)
+        ) + (max_tokens or 0)
+
+    def generate(self, messages, temperature, stats, stop=None, max_tokens=None):
+        params = self.get_params(stop, max_tokens)
+        response = call_with_retry(
+            lambda: self.client.chat.completions.create(
+                model=self.model_name, messages=messages, temperature=temperature, **params
+            ),
+            self.model_name,
+            estimated_tokens=self.estimate_tokens(messages, max_tokens),
+            get_used_tokens=get_used_tokens,
+            stats=stats,
+        )
+        stats.update(get_openai_usage(response))
+        return response.choices[0].message.content
+
+    def stream(self, messages, temperature, stats, stop=None, max_tokens=None):
+        """
+        Streamed completion. Only opening the stream is retried; an error mid-stream fails the call.
+        """
+        params = self.get_params(stop, max_tokens)
+        if self.stream_usage:
+            params["stream_options"] = {"include_usage": True}
+        estimated_tokens = self.estimate_tokens(messages, max_tokens)
+        start = time.perf_counter()
+        response = call_with_retry(
+            lambda: self.client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+                **params,
+            ),
+            self.model_name,
+            estimated_tokens=estimated_tokens,
+            stats=stats,
+        )
+        for chunk in response:
+            if getattr(chunk, "usage", None) is not None:
+                stats.update(get_openai_usage(chunk))
+            if chunk.choices and chunk.choices[0].delta.content:
+                if "ttft" not in stats:
+                    stats["ttft"] = time.perf_counter() - start
+                yield chunk.choices[0].delta.content
+        get_limiter(self.model_name).record_usage(
+            estimated_tokens,
+            (stats.get("prompt_tokens") or 0) + (stats.get("completion_tokens") or 0),
+        )
+
+
+class AzureBackend(OpenAIBackend):
+    provider = "azure"
+    # stream_options needs a more recent API version than the default one
+    stream_usage = False
+
+    def get_client(self):
+        return get_azure_client()
@@ -0,0 +1,126 @@
+"""
+Record/replay backend for agents and the moderator.
+
+In record mode every model call of a session is appended to a JSONL cassette file (emptied when recording starts).
+In replay mode the responses are served back by turn index without calling any model, so a session
+can be re-run offline, deterministically and at no cost. A replay cassette can also be loaded directly
+from a history*.json file of a previous run (its rounds contain the prompt and full answer of each turn).
+"""
+import json
+import threading
+
+
+class CassetteMismatchError(Exception):
+    pass
+
+
+class Cassette:
+    """
+    Cassette of one session. Turns are numbered in call order, over all agents and the moderator.
+    """
+
+    def __init__(self, path, mode):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.turn = 0
+        self.turns = []
+        self.slot_assignment = []
+        self.prompt_mismatches = 0
+        self.lock = threading.Lock()
+        if mode == "replay":
+            self.load()
+        else:
+            # a cassette holds one session: turns of a previous recording to the same path are dropped
+            open(self.path, "w").close()
+
+    def load(self):
+        if self.path.endswith(".json"):
+            self.load_history()
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                record = json.loads(line)
+                if record["type"] == "session":
+                    self.slot_assignment = record["slot_assignment"]
+                else:
+                    self.turns.append(record)
+        # with pipelined turns, calls can complete (and be written) out of order
+        self.turns.sort(key=lambda record: record["turn"])
+
+    def load_history(self):
+        """
+        Load the turns of a history*.json file saved by save_utils.save_conversation.
+        The moderator's responses are not saved in histories, so these only replay sessions without moderator.
+        """
+        with open(self.path, "r") as f:
+            history = json.load(f)
+        self.slot_assignment = history["slot_assignment"]
+        for turn, round_ in enumerate(history["rounds"]):
+            self.turns.append(
+                {
+                    "type": "turn",
+                    "turn": turn,
+                    "agent": round_["agent"],
+                    "request": round_["prompt"],
+                    "response": round_["full_answer"],
+                }
+            )
+
+    def set_slot_assignment(self, slot_assignment):
+        """
+        Record the agents' order of the session (only written in record mode).
+        """
+        self.slot_assignment = slot_assignment
+        if self.mode == "record":
+            self.write({"type": "session", "slot_assignment": slot_assignment})
+
+    def write(self, record):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def reserve_turn(self):
+        """
+        Number of the next turn, taken when the call starts (calls can overlap with pipelined turns).
+        """
+        with self.lock:
+            self.turn += 1
+            return self.turn - 1
+
+    def record(self, agent_name, request, response, turn=None):
+        """
+        Write a turn; turn is the number reserved when the call started, or the next one.
+        """
+        if turn is None:
+            turn = self.reserve_turn()
+        with self.lock:
+            self.write(
+                {
+                    "type": "turn",
+                    "turn": turn,
+                    "agent": agent_name,
+                    "request": request,
+                    "response": response,
+                }
+            )
+
+    def replay(self, agent_name, request):
+        """
+        Response of the next turn. The turn must belong to agent_name, otherwise the session diverged.
+        A different request (e.g., after a prompt change) is counted but still served.
+        """
+        with self.lock:
+            if self.turn >= len(self.turns):
+                raise CassetteMismatchError(
+                    f"{self.path} has no turn {self.turn} (requested by {agent_name})"
+                )
+            record = self.turns[self.turn]
+            if record["agent"] != agent_name:
+                raise CassetteMismatchError(
+                    f"Turn {self.turn} of {self.path} was recorded for {record['agent']}, not {agent_name}"
+                )
+            if record["request"] != request:
+                self.prompt_mismatches += 1
+            self.turn += 1
+            return record["response"]
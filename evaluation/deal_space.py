@@ -0,0 +1,203 @@
+"""
+Vectorized deal space of a game.
+
+The options' scores of all parties are compiled into lookup tables (eval_utils.DealTables), and deals are
+numbered in the order of itertools.product over the issues' options (the last issue changes fastest).
+Scores of all deals x parties are computed in chunks of deal numbers, so no deal tuple or string is ever built,
+and feasibility analyses of a game take milliseconds.
+
+Usage from scripts:
+    space = DealSpace.from_game_dir(game_dir)
+    print(space.analyze())
+
+or from the command line:
+    python deal_space.py <GAME_DIR or OUTPUT_DIR> [--agents_num N --issues_num N]
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from eval_utils import DealTables, load_setup
+
+
+def infer_game_size(game_dir):
+    """
+    Number of agents (lines of config.txt) and issues (lines of a scores file without the min line).
+    """
+    with open(os.path.join(game_dir, "config.txt"), "r") as f:
+        agents_num = len([line for line in f if line.strip()])
+    scores_dir = os.path.join(game_dir, "scores_files")
+    with open(os.path.join(scores_dir, sorted(os.listdir(scores_dir))[0]), "r") as f:
+        issues_num = len([line for line in f if line.strip()]) - 1
+    return agents_num, issues_num
+
+
+class DealSpace:
+    def __init__(self, agents, role_to_agents, num_issues):
+        """
+        agents, role_to_agents: as returned by eval_utils.load_setup
+        """
+        self.tables = DealTables(agents, num_issues)
+        self.parties = self.tables.parties
+        self.num_issues = num_issues
+        self.issue_names = self.tables.issue_names
+        self.num_options = self.tables.num_options
+        self.num_deals = self.tables.num_deals
+        self.minimums = self.tables.minimums
+        self.veto = np.array(
+            [self.parties.index(role_to_agents[role]) for role in ("p1", "p2")], dtype=np.int64
+        )
+
+    @classmethod
+    def from_game_dir(cls, game_dir, agents_num=0, num_issues=0):
+        """
+        Deal space of a game directory (or an experiment's output directory, which has the same config.txt and scores_files).
+        agents_num and num_issues are inferred from the files if not given.
+        """
+        if not agents_num or not num_issues:
+            agents_num, num_issues = infer_game_size(game_dir)
+        agents, role_to_agents, _ = load_setup(game_dir, agents_num, num_issues)
+        return cls(agents, role_to_agents, num_issues)
+
+    def options(self, start=0, stop=None):
+        """
+        Option indices (0-based) of deals start..stop-1, as an array [deal, issue].
+        """
+        stop = self.num_deals if stop is None else stop
+        return self.tables.decode(np.arange(start, stop, dtype=np.int64))
+
+    def deal_ids(self, options):
+        """
+        Deal numbers of option indices [deal, issue].
+        """
+        return self.tables.encode(options)
+
+    def deal_scores(self, options):
+        """
+        Scores [deal, party] of option indices [deal, issue].
+        """
+        return self.tables.score(options)
+
+    def iter_chunks(self, chunk_size=1 << 18):
+        """
+        (first deal number, option indices, scores) of consecutive chunks of the deal space.
+        """
+        for start in range(0, self.num_deals, chunk_size):
+            options = self.options(start, min(start + chunk_size, self.num_deals))
+            yield start, options, self.deal_scores(options)
+
+    def acceptable(self, scores):
+        """
+        Mask [deal, party] of deals scoring at least the party's minimum.
+        """
+        return scores >= self.minimums[None, :]
+
+    def agree_counts(self, accept):
+        return accept.sum(axis=1)
+
+    def veto_covered(self, accept):
+        """
+        Mask of deals acceptable to both veto parties (p1 and p2).
+        """
+        return accept[:, self.veto].all(axis=1)
+
+    def feasible(self, accept):
+        """
+        Mask of deals that can pass: at least N-1 parties agree, including both veto parties.
+        """
+        return (self.agree_counts(accept) >= len(self.parties) - 1) & self.veto_covered(accept)
+
+    def feasible_deals(self, chunk_size=1 << 18):
+        """
+        Deal numbers of all feasible deals.
+        """
+        deals = []
+        for start, _, scores in self.iter_chunks(chunk_size):
+            deals.append(start + np.flatnonzero(self.feasible(self.acceptable(scores))))
+        return np.concatenate(deals) if deals else np.zeros(0, dtype=np.int64)
+
+    def analyze(self, chunk_size=1 << 18):
+        """
+        Feasibility statistics of the game: number of deals, deals that pass (N-1 agree with veto parties),
+        deals all parties accept, and per party the number of passing deals it accepts.
+        """
+        num_feasible, num_all_agree = 0, 0
+        per_party = np.zeros(len(self.parties), dtype=np.int64)
+        for _, _, scores in self.iter_chunks(chunk_size):
+            accept = self.acceptable(scores)
+            feasible = self.feasible(accept)
+            num_feasible += int(feasible.sum())
+            num_all_agree += int(accept.all(axis=1).sum())
+            per_party += accept[feasible].sum(axis=0)
+        return {
+            "deals": self.num_deals,
+            "feasible": num_feasible,
+            "feasible_ratio": num_feasible / self.num_deals,
+            "all_agree": num_all_agree,
+            "feasible_per_party": dict(zip(self.parties, per_party.tolist())),
+        }
+
+    def agreement_by_score(self, party, chunk_size=1 << 18):
+        """
+        For deals acceptable to party, the number of other parties that accept them, per party's score:
+        {score: (deals, mean, std, max)}.
+        """
+        p = self.parties.index(party)
+        score_chunks, agree_chunks = [], []
+        for _, _, scores in self.iter_chunks(chunk_size):
+            accept = self.acceptable(scores)
+            keep = accept[:, p]
+            score_chunks.append(scores[keep, p])
+            agree_chunks.append(accept[keep].sum(axis=1) - 1)
+        party_scores = np.concatenate(score_chunks)
+        agrees = np.concatenate(agree_chunks)
+        values, inverse = np.unique(party_scores, return_inverse=True)
+        counts = np.bincount(inverse)
+        means = np.bincount(inverse, weights=agrees) / counts
+        stds = np.sqrt(np.bincount(inverse, weights=agrees**2) / counts - means**2)
+        maxs = np.full(len(values), -1)
+        np.maximum.at(maxs, inverse, agrees)
+        return {
+            int(value): (int(count), float(mean), float(std), int(max_))
+            for value, count, mean, std, max_ in zip(values, counts, means, stds, maxs)
+        }
+
+    def parse_deal(self, deal):
+        """
+        Option indices of a deal ["A1", "B2", ...] (as returned by eval_utils.extract_deal), None if incomplete.
+        """
+        return self.tables.parse(deal)
+
+    def format_deal(self, options):
+        """
+        ["A1", "B2", ...] of one deal's option indices.
+        """
+        return self.tables.format(options)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="feasibility analysis of a game's deal space")
+    parser.add_argument("game_dir")
+    parser.add_argument("--agents_num", type=int, default=0)
+    parser.add_argument("--issues_num", type=int, default=0)
+    parser.add_argument("--chunk_size", type=int, default=1 << 18)
+    parser.add_argument(
+        "--score_profile",
+        action="store_true",
+        help="also print p1's score vs. the number of other parties agreeing",
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    space = DealSpace.from_game_dir(args.game_dir, args.agents_num, args.issues_num)
+    stats = space.analyze(args.chunk_size)
+    print(f"Analyzed in {(time.perf_counter() - start) * 1000:.1f} ms")
+    for key, value in stats.items():
+        print(f"{key}: {value}")
+    if args.score_profile:
+        p1 = space.parties[space.veto[0]]
+        print(f"\n{p1}'s score: deals, mean/std/max of other parties agreeing")
+        for score, (count, mean, std, max_) in space.agreement_by_score(p1, args.chunk_size).items():
+            print(f"{score}: {count}, {mean:.2f}/{std:.2f}/{max_}")
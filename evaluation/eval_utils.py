@@ -2,6 +2,8 @@ import os
 import re
 import string
 
+import numpy as np
+
 
 def load_setup(output_dir, agents_num, num_issues):
 
@@ -63,10 +65,10 @@ def calculator(scores, deal, num_issues=5):
         return 0
     deal_sum = 0
     for issue in deal:
-        if issue == "" or len(issue) != 2:
+        if len(issue) < 2 or not issue[1:].isdigit():
             return 0
-        issue, number = issue[0], int(issue[1])
-        if issue not in scores:
+        issue, number = issue[0], int(issue[1:])
+        if issue not in scores or not 1 <= number <= len(scores[issue]):
             return 0
         deal_sum += scores[issue][number - 1]
     return deal_sum
@@ -78,9 +80,116 @@ def extract_deal(answer, num_issues=5):
     deal = []
     issues_suggested = 0
     for i in range(0, num_issues):
-        option = re.findall(f"{issue_names[i]}[1-9]", answer, re.DOTALL)
+        # options can have more than one digit (e.g., A12)
+        option = re.findall(f"{issue_names[i]}[1-9][0-9]*", answer, re.DOTALL)
         deal.append(option[0]) if option else deal.append("")
         if option:
             issues_suggested += 1
 
     return deal, issues_suggested
+
+
+class DealTables:
+    """
+    Compact deals and compiled score lookup tables of a game.
+
+    A deal is represented by its options' indices (0-based, a uint8 array per deal, [deal, issue] for many deals)
+    or by a single mixed-radix integer (in the order of itertools.product over the issues' options).
+    The scores of all parties are compiled once into one flat table [issue option, party], so that many deals
+    are scored for all parties with one gather and sum, without Python objects per deal.
+    """
+
+    def __init__(self, agents, num_issues):
+        """
+        agents: as returned by load_setup (agent name -> {"scores": {issue: [scores], "min": minimum}})
+        """
+        self.parties = list(agents.keys())
+        self.num_issues = num_issues
+        self.issue_names = string.ascii_uppercase[:num_issues]
+        self.num_options = np.array(
+            [
+                max(len(agents[party]["scores"][issue]) for party in self.parties)
+                for issue in self.issue_names
+            ],
+            dtype=np.int64,
+        )
+        # row of option o of issue i in the flat table: offsets[i] + o
+        self.offsets = np.concatenate([[0], np.cumsum(self.num_options)[:-1]])
+        self.table = np.zeros((self.num_options.sum(), len(self.parties)), dtype=np.int32)
+        for p, party in enumerate(self.parties):
+            for i, issue in enumerate(self.issue_names):
+                options = agents[party]["scores"][issue]
+                self.table[self.offsets[i] : self.offsets[i] + len(options), p] = options
+        self.minimums = np.array(
+            [agents[party]["scores"]["min"] for party in self.parties], dtype=np.int64
+        )
+        # weight of each issue's option in the deal number (last issue changes fastest)
+        self.radix = np.ones(num_issues, dtype=np.int64)
+        for i in range(num_issues - 2, -1, -1):
+            self.radix[i] = self.radix[i + 1] * self.num_options[i + 1]
+        self.num_deals = int(np.prod(self.num_options))
+
+    def encode(self, options):
+        """
+        Deal numbers of option indices [deal, issue] (or of one deal's options).
+        """
+        return np.asarray(options, dtype=np.int64) @ self.radix
+
+    def decode(self, deal_ids):
+        """
+        Option indices [deal, issue] of deal numbers.
+        """
+        deal_ids = np.asarray(deal_ids, dtype=np.int64)
+        options = np.empty((len(deal_ids), self.num_issues), dtype=np.uint8)
+        for i in range(self.num_issues):
+            options[:, i] = (deal_ids // self.radix[i]) % self.num_options[i]
+        return options
+
+    def parse(self, deal):
+        """
+        Option indices of a deal ["A1", "B2", ...] (as returned by extract_deal), None if incomplete or invalid.
+        """
+        if len(deal) != self.num_issues:
+            return None
+        options = np.zeros(self.num_issues, dtype=np.uint8)
+        for i, (issue, option) in enumerate(zip(self.issue_names, deal)):
+            if len(option) < 2 or option[0] != issue or not option[1:].isdigit():
+                return None
+            number = int(option[1:])
+            if not 1 <= number <= self.num_options[i]:
+                return None
+            options[i] = number - 1
+        return options
+
+    def parse_many(self, deals):
+        """
+        Option indices [deal, issue] of many deals, and the mask of the valid ones (invalid rows are zeros).
+        """
+        options = np.zeros((len(deals), self.num_issues), dtype=np.uint8)
+        valid = np.zeros(len(deals), dtype=bool)
+        for d, deal in enumerate(deals):
+            parsed = self.parse(deal)
+            if parsed is not None:
+                options[d] = parsed
+                valid[d] = True
+        return options, valid
+
+    def format(self, options):
+        """
+        ["A1", "B2", ...] of one deal's option indices.
+        """
+        return [issue + str(int(option) + 1) for issue, option in zip(self.issue_names, options)]
+
+    def score(self, options):
+        """
+        Scores [deal, party] of option indices [deal, issue].
+        """
+        options = np.asarray(options)
+        # one gather per issue, accumulated in place (no [deal, issue, party] temporary)
+        scores = self.table[self.offsets[0] + options[:, 0].astype(np.int64)]
+        for i in range(1, self.num_issues):
+            scores += self.table[self.offsets[i] + options[:, i].astype(np.int64)]
+        return scores
+
+    def score_ids(self, deal_ids):
+        return self.score(self.decode(deal_ids))
@@ -0,0 +1,348 @@
+"""
+Batch evaluation of negotiation sessions (the metrics of evaluate_deals.ipynb) from the command line.
+
+Walks one or many directories, evaluates every directory with history*.json files as an experiment, and
+prints aggregated metrics per experiment:
+    - any_deal: ratio of sessions where a deal by p1 could pass at any round
+    - final_deal: ratio of sessions where the final deal by p1 could pass
+    - all_agreement: ratio of sessions where all parties agreed on the final deal by p1
+    - wrong_ratio: ratio of suggested deals below the suggesting party's minimum
+    - pareto_optimal, utilitarian_ratio, nash_ratio: distance of the final deal by p1 from the game's
+      reference outcomes (frontier.py)
+Sessions are evaluated in a process pool. The metrics of each session are cached in evaluation_cache.json
+in its experiment directory, keyed by the file's mtime and content hash (and the game setup), so running it
+again only evaluates new or changed sessions.
+
+Usage:
+    python evaluate.py ../logs/* [--game_dir GAME_DIR] [--num_rounds N] [--per_turn]
+The game's config.txt and scores_files are taken from the experiment directory, or from --game_dir if the
+experiment directory has none. Only sessions with num_rounds+2 rounds are evaluated (the initial deal,
+num_rounds rounds and the final deal); num_rounds defaults to the most common number of rounds of the
+experiment's sessions minus 2.
+"""
+import argparse
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from deal_space import infer_game_size
+from eval_utils import DealTables, extract_deal, load_setup
+from frontier import Frontier, get_game_hash
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from journal import write_file_atomic
+from telemetry import format_table
+
+CACHE_FILE = "evaluation_cache.json"
+# bump when the metrics change, to invalidate cached results
+METRICS_VERSION = 1
+
+
+@functools.lru_cache(maxsize=None)
+def get_setup(config_dir):
+    """
+    (agents, role_to_agents, DealTables, Frontier) of a game, loaded once per process.
+    """
+    agents_num, issues_num = infer_game_size(config_dir)
+    agents, role_to_agents, _ = load_setup(config_dir, agents_num, issues_num)
+    return agents, role_to_agents, DealTables(agents, issues_num), Frontier.load(config_dir)
+
+
+def check_correctness(deal_value, minimum, is_p1, veto_agreed, wrong_suggested):
+    """
+    Check if a deal is valid wrt the min score of the party that suggested it.
+    If the party is p1 and (deal_value+10) >= threshold, consider it valid and correct veto_agreed.
+    Returns the updated wrong_suggested.
+    """
+    if deal_value < minimum:
+        if is_p1 and (deal_value + 10) >= minimum:
+            veto_agreed[0] = True
+        else:
+            # not p1, or p1 and not (deal_value+10) >= threshold (to accommodate the bonus rule)
+            wrong_suggested += 1
+    return wrong_suggested
+
+
+def check_agreement(num_parties, p1_value, p1_minimum, agreed, veto_agreed):
+    """
+    Check if the current deal (made by p1) leads to agreement:
+        - all parties agree -> all agreement, deal is done
+        - all but p1 agree and (deal_value+10) >= min score of p1 -> all agreement, deal is done
+        - N-1 parties agree including both veto parties -> deal is done
+    Returns (whether a deal can be done based on this round, whether there is all agreement).
+    """
+    if agreed == num_parties:
+        return True, True
+    if agreed == num_parties - 1 and not veto_agreed[0] and (p1_value + 10) >= p1_minimum:
+        # p1 not met but would be met with the +10 rule
+        return True, True
+    if agreed == num_parties - 1 and all(veto_agreed):
+        # one other party was excluded
+        return True, False
+    return False, False
+
+
+def get_metrics(content, num_rounds, config_dir):
+    """
+    Metrics of one negotiation session, None if it does not have num_rounds+2 rounds.
+    """
+    agents, role_to_agents, tables, frontier = get_setup(config_dir)
+    if len(content["rounds"]) != num_rounds + 2:
+        return None
+    parties = tables.parties
+    p1 = role_to_agents["p1"]
+    veto = [parties.index(role_to_agents["p1"]), parties.index(role_to_agents["p2"])]
+
+    names, deals = [], []
+    for round_ in content["rounds"]:
+        deal, issues_suggested = extract_deal(round_["public_answer"], tables.num_issues)
+        if issues_suggested < tables.num_issues:
+            continue
+        names.append(round_["agent"])
+        deals.append(deal)
+    # scores of all suggested deals for all parties at once (0 for invalid deals, as calculator)
+    options, valid = tables.parse_many(deals)
+    scores = tables.score(options) * valid[:, None]
+    agreed = (scores > tables.minimums[None, :]).sum(axis=1)
+    veto_accept = scores[:, veto] > tables.minimums[veto][None, :]
+
+    deal_values = {name: [] for name in parties}
+    wrong_suggested, deal_done = 0, False
+    curr_deal_done, all_agreement, final_deal = False, False, None
+    for d, name in enumerate(names):
+        party = parties.index(name)
+        veto_agreed = veto_accept[d].tolist()
+        wrong_suggested = check_correctness(
+            int(scores[d, party]), int(tables.minimums[party]), name == p1, veto_agreed, wrong_suggested
+        )
+        if name == p1:
+            curr_deal_done, all_agreement = check_agreement(
+                len(parties), int(scores[d, party]), int(tables.minimums[party]), int(agreed[d]), veto_agreed
+            )
+            final_deal = deals[d]
+        deal_done = curr_deal_done or deal_done
+        deal_values[name].append([int(scores[d, party]), int(agreed[d]), scores[d].tolist()])
+
+    distance = frontier.distance(final_deal) if final_deal else None
+    return {
+        "wrong_ratio": wrong_suggested / len(names) if names else None,
+        "deal_done": deal_done,
+        "all_agreement": all_agreement,
+        "final_deal_done": curr_deal_done,
+        "final_deal": ",".join(final_deal) if final_deal else None,
+        "pareto_optimal": distance["pareto_optimal"] if distance else None,
+        "utilitarian_ratio": distance["utilitarian_ratio"] if distance else None,
+        "nash_ratio": distance["nash_ratio"] if distance else None,
+        "deal_values": deal_values,
+    }
+
+
+def evaluate_file(path, num_rounds, config_dir):
+    try:
+        with open(path, "r") as f:
+            content = json.load(f)
+    except ValueError:
+        # rewritten since it was read (e.g., a session still running): incomplete for now
+        return None
+    return get_metrics(content, num_rounds, config_dir)
+
+
+def find_experiments(dirs):
+    """
+    {experiment directory: [history files]} of all directories under dirs with history*.json files.
+    """
+    experiments = {}
+    for directory in dirs:
+        for root, _, files in os.walk(directory):
+            histories = sorted(
+                filename for filename in files if filename.startswith("history") and filename.endswith(".json")
+            )
+            if histories:
+                experiments[root] = [os.path.join(root, filename) for filename in histories]
+    return experiments
+
+
+def load_cache(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def evaluate_experiment(exp_dir, files, config_dir, num_rounds, executor, workers=1):
+    """
+    Metrics of the sessions of one experiment, {file name: metrics (None if incomplete)},
+    evaluating only the sessions that are not in the cache. Sessions whose file is not valid JSON (empty or
+    partially written) are unreadable: reported, with metrics None, and read again once their file changes.
+    """
+    cache_path = os.path.join(exp_dir, CACHE_FILE)
+    cache = load_cache(cache_path)
+    changed = False
+
+    # sessions whose file did not change since they were cached (same mtime and size, or same content)
+    unchanged = set()
+    for path in files:
+        name = os.path.basename(path)
+        stat = os.stat(path)
+        entry = cache.get(name)
+        if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            unchanged.add(name)
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        content_hash = hashlib.sha256(data).hexdigest()
+        if entry and entry["hash"] == content_hash:
+            entry["mtime"], entry["size"] = stat.st_mtime, stat.st_size
+            unchanged.add(name)
+        else:
+            try:
+                rounds = len(json.loads(data).get("rounds", []))
+            except ValueError:
+                rounds = None
+            cache[name] = {
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "hash": content_hash,
+                "rounds": rounds,
+                "setup": None,
+                "metrics": None,
+            }
+        changed = True
+
+    unreadable = [os.path.basename(path) for path in files if cache[os.path.basename(path)]["rounds"] is None]
+    if not num_rounds:
+        rounds = collections.Counter(
+            cache[os.path.basename(path)]["rounds"] for path in files if os.path.basename(path) not in unreadable
+        )
+        num_rounds = rounds.most_common(1)[0][0] - 2 if rounds else 0
+    setup = f"{METRICS_VERSION}:{get_game_hash(config_dir)}:{num_rounds}"
+    todo = [
+        path
+        for path in files
+        if os.path.basename(path) not in unreadable
+        and (os.path.basename(path) not in unchanged or cache[os.path.basename(path)]["setup"] != setup)
+    ]
+
+    if todo:
+        # the frontier is computed (and cached beside config.txt) once, before the workers read it
+        Frontier.load(config_dir)
+        if executor is None or len(todo) == 1:
+            metrics = [evaluate_file(path, num_rounds, config_dir) for path in todo]
+        else:
+            metrics = executor.map(
+                evaluate_file,
+                todo,
+                [num_rounds] * len(todo),
+                [config_dir] * len(todo),
+                chunksize=max(1, len(todo) // (4 * workers)),
+            )
+        for path, session_metrics in zip(todo, metrics):
+            entry = cache[os.path.basename(path)]
+            entry["setup"], entry["metrics"] = setup, session_metrics
+        changed = True
+    if changed:
+        write_file_atomic(cache, cache_path)
+    results = {os.path.basename(path): cache[os.path.basename(path)]["metrics"] for path in files}
+    return results, num_rounds, len(todo), unreadable
+
+
+def mean(values):
+    values = [value for value in values if value is not None]
+    return float(np.mean(values)) if values else None
+
+
+def aggregate(exp_dir, results, unreadable=()):
+    sessions = [metrics for metrics in results.values() if metrics is not None]
+    return {
+        "experiment": exp_dir,
+        "sessions": len(results),
+        "evaluated": len(sessions),
+        "unreadable": len(unreadable),
+        "any_deal": mean([metrics["deal_done"] for metrics in sessions]),
+        "final_deal": mean([metrics["final_deal_done"] for metrics in sessions]),
+        "all_agreement": mean([metrics["all_agreement"] for metrics in sessions]),
+        "wrong_ratio": mean([metrics["wrong_ratio"] for metrics in sessions]),
+        "pareto_optimal": mean([metrics["pareto_optimal"] for metrics in sessions]),
+        "utilitarian_ratio": mean([metrics["utilitarian_ratio"] for metrics in sessions]),
+        "nash_ratio": mean([metrics["nash_ratio"] for metrics in sessions]),
+    }
+
+
+def aggregate_turns(results, agent):
+    """
+    Mean/std over sessions of agent's own score and of the average score of all parties for its deal at each of
+    its turns (the figures of evaluate_deals.ipynb).
+    """
+    sessions = [metrics["deal_values"][agent] for metrics in results.values() if metrics is not None]
+    rows = []
+    for turn in range(max((len(values) for values in sessions), default=0)):
+        own = [values[turn][0] for values in sessions if turn < len(values)]
+        collective = [np.mean(values[turn][2]) for values in sessions if turn < len(values)]
+        rows.append(
+            {
+                "turn": turn + 1,
+                "sessions": len(own),
+                "own_mean": float(np.mean(own)),
+                "own_std": float(np.std(own)),
+                "collective_mean": float(np.mean(collective)),
+                "collective_std": float(np.std(collective)),
+            }
+        )
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="evaluate negotiation sessions")
+    parser.add_argument("dirs", nargs="+", help="experiment output directories (searched recursively)")
+    parser.add_argument(
+        "--game_dir", type=str, default="", help="config.txt and scores_files of experiments that have none"
+    )
+    parser.add_argument("--num_rounds", type=int, default=0, help="inferred per experiment if 0")
+    parser.add_argument("--workers", type=int, default=0, help="evaluation processes, all CPUs if 0")
+    parser.add_argument(
+        "--per_turn", action="store_true", help="also print p1's own and collective scores per turn"
+    )
+    parser.add_argument("--output_file", type=str, default="", help="also save all metrics to a JSON file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    experiments = find_experiments(args.dirs)
+    rows, outputs, evaluated = [], {}, 0
+    workers = args.workers or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for exp_dir, files in sorted(experiments.items()):
+            config_dir = exp_dir if os.path.exists(os.path.join(exp_dir, "config.txt")) else args.game_dir
+            if not config_dir:
+                print(f"Skipping {exp_dir}: no config.txt (use --game_dir)")
+                continue
+            results, num_rounds, new, unreadable = evaluate_experiment(
+                exp_dir, files, config_dir, args.num_rounds, executor, workers
+            )
+            evaluated += new
+            if unreadable:
+                print(f"{exp_dir}: {len(unreadable)} unreadable sessions (not valid JSON): {', '.join(unreadable)}")
+            rows.append(aggregate(exp_dir, results, unreadable))
+            outputs[exp_dir] = {
+                "num_rounds": num_rounds,
+                "aggregate": rows[-1],
+                "sessions": results,
+                "unreadable": unreadable,
+            }
+            if args.per_turn:
+                p1 = get_setup(config_dir)[1]["p1"]
+                print(f"==== {exp_dir}: {p1}'s turns ====")
+                print(format_table(aggregate_turns(results, p1)))
+                outputs[exp_dir]["per_turn"] = aggregate_turns(results, p1)
+
+    print(format_table(rows))
+    print(f"Evaluated {evaluated} new or changed sessions in {time.perf_counter() - start:.2f}s")
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(outputs, f, indent=1)
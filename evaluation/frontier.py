@@ -0,0 +1,232 @@
+"""
+Reference outcomes of a game, to judge negotiated deals against.
+
+For a game directory (or an experiment's output directory) this computes:
+    - the Pareto-optimal deals (over all deals, and over the deals that can pass)
+    - the Nash bargaining solution: max product of the parties' gains over their minimum, among deals all parties accept
+    - the utilitarian optimum: max total score, among deals that can pass
+    - the egalitarian optimum: max of the smallest gain over the minimum, among deals that can pass
+    - each party's best deal among deals that can pass
+A deal can pass if at least N-1 parties accept it (score >= their minimum), including p1 and p2.
+
+The results are cached in frontier.json beside the game's config.txt, together with a hash of the config and
+scores files, and recomputed when these change. Precompute all games with:
+    python frontier.py ../games_descriptions/*
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+from deal_space import DealSpace
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from journal import write_file_atomic
+
+FRONTIER_FILE = "frontier.json"
+
+
+def pareto_mask(scores, block_size=1024):
+    """
+    Mask of the rows of scores [deal, party] that no other row dominates.
+    Rows are visited by decreasing total score, so a row can only be dominated by earlier rows, and it is enough
+    to compare each block of rows with the frontier found so far and with itself.
+    """
+    order = np.argsort(-scores.sum(axis=1), kind="stable")
+    frontier = np.zeros((0, scores.shape[1]), dtype=scores.dtype)
+    mask = np.zeros(len(scores), dtype=bool)
+
+    def dominated(block, others):
+        return (
+            (others[None, :, :] >= block[:, None, :]).all(axis=2)
+            & (others[None, :, :] > block[:, None, :]).any(axis=2)
+        ).any(axis=1)
+
+    for start in range(0, len(order), block_size):
+        rows = order[start : start + block_size]
+        block = scores[rows]
+        keep = ~(dominated(block, frontier) | dominated(block, block))
+        mask[rows[keep]] = True
+        frontier = np.concatenate([frontier, block[keep]])
+    return mask
+
+
+def get_game_hash(game_dir):
+    """
+    Hash of the files that define the deal space: config.txt and the scores files.
+    """
+    sha = hashlib.sha256()
+    paths = [os.path.join(game_dir, "config.txt")]
+    scores_dir = os.path.join(game_dir, "scores_files")
+    paths += [os.path.join(scores_dir, name) for name in sorted(os.listdir(scores_dir))]
+    for path in paths:
+        sha.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def argmax_deals(values, deal_ids):
+    """
+    (best value, deal ids reaching it) of values over deal_ids, (None, []) if there is no deal.
+    """
+    if len(values) == 0:
+        return None, []
+    best = values.max()
+    return best, deal_ids[values == best]
+
+
+def compute_frontier(space):
+    options = space.options()
+    scores = space.deal_scores(options)
+    accept = space.acceptable(scores)
+    feasible = space.feasible(accept)
+    all_agree = accept.all(axis=1)
+    gains = scores - space.minimums[None, :]
+
+    def deals(ids):
+        return [
+            {"deal": ",".join(space.format_deal(options[i])), "scores": scores[i].tolist()}
+            for i in ids
+        ]
+
+    pareto = np.flatnonzero(pareto_mask(scores))
+    feasible_ids = np.flatnonzero(feasible)
+    pareto_feasible = feasible_ids[pareto_mask(scores[feasible_ids])]
+
+    all_agree_ids = np.flatnonzero(all_agree)
+    nash_value, nash = argmax_deals(
+        np.prod(gains[all_agree_ids].astype(np.float64), axis=1), all_agree_ids
+    )
+    utilitarian_value, utilitarian = argmax_deals(scores[feasible_ids].sum(axis=1), feasible_ids)
+    egalitarian_value, egalitarian = argmax_deals(gains[feasible_ids].min(axis=1), feasible_ids)
+    best_per_party = {}
+    for p, party in enumerate(space.parties):
+        value, ids = argmax_deals(scores[feasible_ids, p], feasible_ids)
+        best_per_party[party] = {
+            "score": None if value is None else int(value),
+            "deals": deals(ids),
+        }
+
+    return {
+        "parties": space.parties,
+        "minimums": space.minimums.tolist(),
+        "num_deals": space.num_deals,
+        "num_feasible": int(feasible.sum()),
+        "pareto": deals(pareto),
+        "pareto_feasible": deals(pareto_feasible),
+        "nash": {"product": None if nash_value is None else float(nash_value), "deals": deals(nash)},
+        "utilitarian": {
+            "total": None if utilitarian_value is None else int(utilitarian_value),
+            "deals": deals(utilitarian),
+        },
+        "egalitarian": {
+            "min_gain": None if egalitarian_value is None else int(egalitarian_value),
+            "deals": deals(egalitarian),
+        },
+        "best_per_party": best_per_party,
+    }
+
+
+class Frontier:
+    """
+    Reference outcomes of a game, and the distance of deals from them.
+    """
+
+    def __init__(self, space, frontier):
+        self.space = space
+        self.frontier = frontier
+        self.pareto_scores = np.array([deal["scores"] for deal in frontier["pareto"]])
+
+    @classmethod
+    def load(cls, game_dir, force=False):
+        """
+        Reference outcomes of game_dir, from the cache beside its config.txt if it is up to date.
+        """
+        space = DealSpace.from_game_dir(game_dir)
+        game_hash = get_game_hash(game_dir)
+        path = os.path.join(game_dir, FRONTIER_FILE)
+        if not force and os.path.exists(path):
+            with open(path, "r") as f:
+                cached = json.load(f)
+            if cached.get("hash") == game_hash:
+                return cls(space, cached)
+        frontier = compute_frontier(space)
+        frontier["hash"] = game_hash
+        # concurrent evaluations (e.g., evaluate.py's workers) never read a partially written cache
+        write_file_atomic(frontier, path)
+        return cls(space, frontier)
+
+    def deal_scores(self, deal):
+        """
+        Scores of the parties for a deal ["A1", "B2", ...], None if the deal is incomplete or invalid.
+        """
+        options = self.space.parse_deal(deal)
+        if options is None:
+            return None
+        return self.space.deal_scores(options[None, :])[0]
+
+    def distance(self, deal):
+        """
+        How far a deal is from the reference outcomes:
+            - pareto_optimal: no deal is at least as good for all parties and better for one
+            - pareto_gap: the largest total score gain possible without any party losing (0 if Pareto-optimal)
+            - utilitarian_ratio: total score / utilitarian optimum
+            - egalitarian_gap: egalitarian optimum - smallest gain over the minimum of the deal
+            - nash_ratio: Nash product of the deal / Nash optimum (0 if a party is below its minimum)
+            - party_ratio: per party, its score / its best score among deals that can pass
+        None if the deal is incomplete or invalid.
+        """
+        scores = self.deal_scores(deal)
+        if scores is None:
+            return None
+        minimums = np.array(self.frontier["minimums"])
+        # every deal is either Pareto-optimal or dominated by a Pareto-optimal deal
+        weakly_dominating = (self.pareto_scores >= scores[None, :]).all(axis=1)
+        dominating = weakly_dominating & (self.pareto_scores > scores[None, :]).any(axis=1)
+        gains = scores - minimums
+        pareto_gap = int(
+            (self.pareto_scores[weakly_dominating].sum(axis=1) - scores.sum()).max()
+        )
+        utilitarian = self.frontier["utilitarian"]["total"]
+        egalitarian = self.frontier["egalitarian"]["min_gain"]
+        nash = self.frontier["nash"]["product"]
+        nash_product = float(np.prod(gains)) if (gains >= 0).all() else 0.0
+        return {
+            "pareto_optimal": not dominating.any(),
+            "pareto_gap": pareto_gap,
+            "utilitarian_ratio": None if not utilitarian else float(scores.sum()) / utilitarian,
+            "egalitarian_gap": None if egalitarian is None else egalitarian - int(gains.min()),
+            "nash_ratio": None if not nash else nash_product / nash,
+            "party_ratio": {
+                party: None
+                if not best["score"]
+                else float(scores[p]) / best["score"]
+                for p, (party, best) in enumerate(self.frontier["best_per_party"].items())
+            },
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="precompute the reference outcomes of games")
+    parser.add_argument("game_dirs", nargs="+")
+    parser.add_argument("--force", action="store_true", help="recompute even if the cache is up to date")
+    args = parser.parse_args()
+
+    for game_dir in args.game_dirs:
+        if not os.path.exists(os.path.join(game_dir, "config.txt")):
+            continue
+        frontier = Frontier.load(game_dir, args.force).frontier
+        print(f"==== {game_dir} ====")
+        print(
+            f"{frontier['num_deals']} deals, {frontier['num_feasible']} can pass, "
+            f"{len(frontier['pareto'])} Pareto-optimal ({len(frontier['pareto_feasible'])} among deals that can pass)"
+        )
+        for name, key in (("nash", "product"), ("utilitarian", "total"), ("egalitarian", "min_gain")):
+            deals = [deal["deal"] for deal in frontier[name]["deals"]]
+            print(f"{name}: {key}={frontier[name][key]} {deals}")
+        for party, best in frontier["best_per_party"].items():
+            print(f"best for {party}: {best['score']} {[deal['deal'] for deal in best['deals']][:3]}")
@@ -0,0 +1,349 @@
+"""
+SQLite index of negotiation logs, for cross-experiment queries without re-parsing the JSON files.
+
+Walks one or many directories, including .zip archives (read member by member, without extracting them), and
+flattens every session into:
+    - sessions: one row per history*.json file (or answers*.json of older runs), with its experiment directory
+    - rounds: one row per round, with the agent, its role, incentive and model (from the experiment's
+      config.txt, or initial_prompts.txt of older runs), the extracted deal and the public answer
+    - prompts: the prompt and full answer of each round, in a separate table to keep rounds small
+Sessions are re-indexed only if their file changed (mtime and size, or CRC and size for zip members), and
+sessions whose file is gone are dropped.
+
+Usage:
+    python index_logs.py build ../logs [--db logs_index.sqlite]
+    python index_logs.py query "SELECT experiment, round, agent, deal FROM rounds JOIN sessions USING (session_id)
+        WHERE incentive = 'greedy' AND round > 20 AND deal IS NOT NULL"
+"""
+import argparse
+import collections
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+import zipfile
+
+from eval_utils import extract_deal
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from telemetry import format_table
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    member TEXT NOT NULL,
+    experiment TEXT NOT NULL,
+    stamp TEXT NOT NULL,
+    issues_num INTEGER,
+    rounds INTEGER NOT NULL,
+    finished_rounds INTEGER,
+    UNIQUE (source, member)
+);
+CREATE TABLE IF NOT EXISTS rounds (
+    session_id INTEGER NOT NULL,
+    round INTEGER NOT NULL,
+    agent TEXT NOT NULL,
+    role TEXT,
+    incentive TEXT,
+    model TEXT,
+    deal TEXT,
+    issues_suggested INTEGER NOT NULL,
+    public_answer TEXT,
+    prompt_tokens INTEGER,
+    PRIMARY KEY (session_id, round)
+);
+CREATE TABLE IF NOT EXISTS prompts (
+    session_id INTEGER NOT NULL,
+    round INTEGER NOT NULL,
+    prompt TEXT,
+    full_answer TEXT,
+    PRIMARY KEY (session_id, round)
+);
+CREATE INDEX IF NOT EXISTS sessions_experiment ON sessions (experiment);
+CREATE INDEX IF NOT EXISTS rounds_incentive ON rounds (incentive, round);
+CREATE INDEX IF NOT EXISTS rounds_agent ON rounds (agent, round);
+CREATE INDEX IF NOT EXISTS rounds_model ON rounds (model);
+"""
+
+DEAL_TAG = re.compile(r"<DEAL>(.*?)</DEAL>", re.DOTALL)
+OPTION = re.compile(r"[A-Z][1-9][0-9]*")
+LEGACY_ROLES = {"voting_moderator": "p1", "veto": "p2"}
+
+
+class DirArchive:
+    """
+    Files of a directory tree (except zip archives, which are indexed separately).
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def members(self):
+        """
+        {member path: change stamp} of all files.
+        """
+        members = {}
+        for root, _, files in os.walk(self.root):
+            for filename in files:
+                if filename.endswith(".zip"):
+                    continue
+                path = os.path.join(root, filename)
+                stat = os.stat(path)
+                members[os.path.relpath(path, self.root)] = f"{stat.st_mtime}:{stat.st_size}"
+        return members
+
+    def open(self, member):
+        return open(os.path.join(self.root, member), "rb")
+
+    def close(self):
+        pass
+
+
+class ZipArchive:
+    def __init__(self, path):
+        self.root = path
+        self.zip = zipfile.ZipFile(path)
+
+    def members(self):
+        return {
+            info.filename: f"{info.CRC}:{info.file_size}"
+            for info in self.zip.infolist()
+            if not info.is_dir()
+        }
+
+    def open(self, member):
+        return self.zip.open(member)
+
+    def close(self):
+        self.zip.close()
+
+
+def iter_archives(dirs):
+    for directory in dirs:
+        if directory.endswith(".zip"):
+            yield ZipArchive(directory)
+            continue
+        yield DirArchive(directory)
+        for root, _, files in os.walk(directory):
+            for filename in sorted(files):
+                if filename.endswith(".zip"):
+                    yield ZipArchive(os.path.join(root, filename))
+
+
+def read_agents_config(archive, member):
+    """
+    {agent: (role, incentive, model)} from a config.txt (name, file, role, incentive, model) or an older
+    initial_prompts.txt (name, file, role, model).
+    """
+    with archive.open(member) as f:
+        lines = [line.strip() for line in f.read().decode("utf-8").splitlines() if line.strip()]
+    agents = {}
+    for line in lines:
+        fields = [field.strip() for field in line.split(",")]
+        if len(fields) < 4:
+            continue
+        role, incentive = fields[2], fields[3] if len(fields) >= 5 else None
+        if len(fields) == 4:
+            # older roles: voting_moderator (p1), veto (p2), with the incentive appended as role&incentive
+            role, _, incentive = role.partition("&")
+            role = LEGACY_ROLES.get(role, role)
+            incentive = incentive or None
+        agents[fields[0]] = (role, incentive, fields[-1])
+    return agents
+
+
+def count_issues(archive, member):
+    with archive.open(member) as f:
+        return len([line for line in f.read().decode("utf-8").splitlines() if line.strip()]) - 1
+
+
+def infer_issues(answers):
+    """
+    Most common number of issues in the (non-empty) <DEAL> tags of a session's answers (5 if there is none).
+    """
+    counts = collections.Counter(
+        len(set(option[0] for option in OPTION.findall(tag)))
+        for answer in answers
+        for tag in DEAL_TAG.findall(answer or "")
+        if OPTION.search(tag)
+    )
+    return counts.most_common(1)[0][0] if counts else 5
+
+
+def load_session(archive, member, members):
+    """
+    (rounds [{agent, public_answer, prompt, full_answer, prompt_tokens}], finished_rounds) of a session file,
+    in the current format (history*.json) or the older one (answers*.json + full_conversation*.json).
+    """
+    with archive.open(member) as f:
+        content = json.load(f)
+    if os.path.basename(member).startswith("history"):
+        return content.get("rounds", []), content.get("finished_rounds")
+
+    rounds = [
+        {"agent": agent, "public_answer": public_answer} for agent, public_answer in content.get("rounds", [])
+    ]
+    full_member = os.path.join(
+        os.path.dirname(member), os.path.basename(member).replace("answers", "full_conversation", 1)
+    )
+    if full_member in members:
+        with archive.open(full_member) as f:
+            full = json.load(f).get("rounds", {})
+        # the initial deal has no prompt: prompts and answers start at round 1
+        for i, prompt in enumerate(full.get("prompts", [])):
+            if i + 1 < len(rounds):
+                rounds[i + 1]["prompt"] = prompt
+        for i, (_, full_answer) in enumerate(full.get("answers", [])):
+            if i + 1 < len(rounds):
+                rounds[i + 1]["full_answer"] = full_answer
+    return rounds, content.get("finished_rounds")
+
+
+def is_session(member):
+    name = os.path.basename(member)
+    return name.endswith(".json") and name.startswith(("history", "answers"))
+
+
+class LogIndex:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def index_archive(self, archive):
+        """
+        Index the new and changed sessions of an archive and drop its deleted ones.
+        Returns (indexed sessions, unchanged sessions, dropped sessions).
+        """
+        members = archive.members()
+        indexed = {
+            member: (session_id, stamp)
+            for session_id, member, stamp in self.conn.execute(
+                "SELECT session_id, member, stamp FROM sessions WHERE source = ?", (archive.root,)
+            )
+        }
+        by_dir = collections.defaultdict(list)
+        for member in members:
+            by_dir[os.path.dirname(member)].append(member)
+
+        new, unchanged = 0, 0
+        self.conn.execute("BEGIN")
+        try:
+            for directory, dir_members in sorted(by_dir.items()):
+                sessions = sorted(member for member in dir_members if is_session(member))
+                todo = [member for member in sessions if indexed.get(member, (None, None))[1] != members[member]]
+                unchanged += len(sessions) - len(todo)
+                if not todo:
+                    continue
+                names = {os.path.basename(member): member for member in dir_members}
+                agents = {}
+                for config_name in ("initial_prompts.txt", "config.txt"):
+                    if config_name in names:
+                        agents.update(read_agents_config(archive, names[config_name]))
+                scores_files = sorted(
+                    member for member in members if os.path.dirname(member) == os.path.join(directory, "scores_files")
+                )
+                issues_num = count_issues(archive, scores_files[0]) if scores_files else None
+                experiment = os.path.join(archive.root, directory) if directory else archive.root
+                for member in todo:
+                    if member in indexed:
+                        self.delete(indexed[member][0])
+                    self.insert(archive, member, members, experiment, agents, issues_num)
+                    new += 1
+            dropped = [session_id for member, (session_id, _) in indexed.items() if member not in members]
+            for session_id in dropped:
+                self.delete(session_id)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return new, unchanged, len(dropped)
+
+    def insert(self, archive, member, members, experiment, agents, issues_num):
+        rounds, finished_rounds = load_session(archive, member, members)
+        issues_num = issues_num or infer_issues([round_.get("public_answer") for round_ in rounds])
+        session_id = self.conn.execute(
+            "INSERT INTO sessions (source, member, experiment, stamp, issues_num, rounds, finished_rounds) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (archive.root, member, experiment, members[member], issues_num, len(rounds), finished_rounds),
+        ).lastrowid
+        round_rows, prompt_rows = [], []
+        for round_idx, round_ in enumerate(rounds):
+            public_answer = round_.get("public_answer") or ""
+            deal, issues_suggested = extract_deal(public_answer, issues_num)
+            role, incentive, model = agents.get(round_["agent"], (None, None, None))
+            round_rows.append(
+                (
+                    session_id,
+                    round_idx,
+                    round_["agent"],
+                    role,
+                    incentive,
+                    model,
+                    # only complete deals, as evaluated by the metrics
+                    ",".join(deal) if issues_suggested == issues_num else None,
+                    issues_suggested,
+                    public_answer,
+                    round_.get("prompt_tokens"),
+                )
+            )
+            if round_.get("prompt") is not None or round_.get("full_answer") is not None:
+                prompt_rows.append((session_id, round_idx, round_.get("prompt"), round_.get("full_answer")))
+        self.conn.executemany("INSERT INTO rounds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", round_rows)
+        self.conn.executemany("INSERT INTO prompts VALUES (?, ?, ?, ?)", prompt_rows)
+
+    def delete(self, session_id):
+        for table in ("sessions", "rounds", "prompts"):
+            self.conn.execute(f"DELETE FROM {table} WHERE session_id = ?", (session_id,))
+
+    def query(self, sql, params=()):
+        cursor = self.conn.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SQLite index of negotiation logs")
+    parser.add_argument("--db", type=str, default="logs_index.sqlite", help="index database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="index (or update the index of) log directories")
+    build_parser.add_argument("dirs", nargs="+", help="log directories or .zip archives")
+    query_parser = subparsers.add_parser("query", help="run a SQL query on the index")
+    query_parser.add_argument("sql")
+    query_parser.add_argument(
+        "--max_width", type=int, default=80, help="truncate printed values to this many characters (0: no limit)"
+    )
+    args = parser.parse_args()
+
+    index = LogIndex(args.db)
+    start = time.perf_counter()
+    if args.command == "build":
+        totals = [0, 0, 0]
+        for archive in iter_archives(args.dirs):
+            counts = index.index_archive(archive)
+            archive.close()
+            totals = [total + count for total, count in zip(totals, counts)]
+        print(
+            f"Indexed {totals[0]} sessions ({totals[1]} unchanged, {totals[2]} dropped) "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+    else:
+        rows = index.query(args.sql)
+        if args.max_width:
+            rows = [
+                {
+                    key: value[: args.max_width] if isinstance(value, str) else value
+                    for key, value in row.items()
+                }
+                for row in rows
+            ]
+        print(format_table(rows) if rows else "(no rows)")
+        print(f"{len(rows)} rows in {(time.perf_counter() - start) * 1000:.1f} ms")
+    index.close()
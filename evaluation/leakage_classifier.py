@@ -0,0 +1,388 @@
+"""
+Local leakage classifier distilled from the LLM judge's verdicts (score_leakage_verifier.json of past runs).
+
+Answers are represented by hashed word n-grams (numbers and option names are replaced by placeholders, so
+"a score of 55" and "a score of 40" share features) and classified with a logistic regression, trained and
+served with NumPy only. A model is saved as one .npz artifact: weights, bias and JSON metadata (format version,
+model id, training data, features and held-out metrics). Answers whose confidence is below a threshold are
+left as uncertain, i.e., for the LLM judge.
+
+Train on the experiments that have LLM verdicts:
+    python leakage_classifier.py train ../logs/* --output leakage_classifier.npz
+Screen experiments without any API call:
+    python leakage_classifier.py screen ../logs/* --model leakage_classifier.npz [--threshold 0.9]
+or use it as a judge backend of score_leakage.py with --classifier.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+import zlib
+
+import numpy as np
+
+from leakage_prefilter import CLEAN, LEAKED, UNCERTAIN
+
+FORMAT_VERSION = 1
+VERIFIER_FILE = "score_leakage_verifier.json"
+PUBLIC_ANSWERS_FILE = "public_answers.json"
+
+TOKEN = re.compile(r"[A-Z][1-9][0-9]*\b|\d+|[a-z]+|[^\sa-z\d]", re.IGNORECASE)
+OPTION_NAME = re.compile(r"[A-Z][1-9][0-9]*$")
+# odd multipliers of the n-gram hashes (uint64 arithmetic wraps around)
+MIXERS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9], dtype=np.uint64)
+
+
+def tokenize(text):
+    """
+    Lower-case tokens of a text, with <num> for numbers and <opt> for option names (A1, B12, ...).
+    """
+    tokens = []
+    for token in TOKEN.findall(text or ""):
+        if token.isdigit():
+            tokens.append("<num>")
+        elif OPTION_NAME.match(token):
+            tokens.append("<opt>")
+        else:
+            tokens.append(token.lower())
+    return tokens
+
+
+class Featurizer:
+    """
+    Hashed n-gram features of texts, as a sparse matrix (rows, columns, values) with L2-normalized rows.
+    """
+
+    def __init__(self, num_features=1 << 18, ngrams=3):
+        self.num_features = num_features
+        self.ngrams = ngrams
+        self.token_hashes = {}
+
+    def hash_tokens(self, tokens):
+        hashes = self.token_hashes
+        for token in tokens:
+            if token not in hashes:
+                hashes[token] = zlib.crc32(token.encode("utf-8"))
+        return [hashes[token] for token in tokens]
+
+    def transform(self, texts):
+        """
+        (rows, columns, values, number of texts). All texts' tokens are hashed at once: n-grams are
+        combined hashes of consecutive tokens, without the n-grams crossing two texts.
+        """
+        token_ids, doc_ids = [], []
+        for i, text in enumerate(texts):
+            hashes = self.hash_tokens(tokenize(text))
+            token_ids += hashes
+            doc_ids += [i] * len(hashes)
+        token_ids = np.array(token_ids, dtype=np.uint64)
+        doc_ids = np.array(doc_ids, dtype=np.int64)
+
+        rows, columns = [], []
+        with np.errstate(over="ignore"):
+            for n in range(1, self.ngrams + 1):
+                length = len(token_ids) - n + 1
+                if length <= 0:
+                    break
+                hashes = np.full(length, n, dtype=np.uint64)
+                for k in range(n):
+                    hashes = hashes * MIXERS[k] + token_ids[k : k + length]
+                same_doc = doc_ids[:length] == doc_ids[n - 1 :]
+                rows.append(doc_ids[:length][same_doc])
+                columns.append((hashes[same_doc] % np.uint64(self.num_features)).astype(np.int64))
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        columns = np.concatenate(columns) if columns else np.zeros(0, dtype=np.int64)
+
+        # binary features: each (text, feature) once
+        pairs = np.unique(rows * self.num_features + columns)
+        rows, columns = pairs // self.num_features, pairs % self.num_features
+        norms = np.sqrt(np.bincount(rows, minlength=len(texts)))
+        values = 1.0 / norms[rows]
+        return rows, columns, values, len(texts)
+
+
+def sparse_dot(features, weights):
+    rows, columns, values, num_rows = features
+    return np.bincount(rows, weights=values * weights[columns], minlength=num_rows)
+
+
+def subset(features, indices):
+    """
+    Rows indices of a sparse matrix, renumbered 0..len(indices)-1.
+    """
+    rows, columns, values, num_rows = features
+    new_rows = np.full(num_rows, -1, dtype=np.int64)
+    new_rows[indices] = np.arange(len(indices))
+    keep = new_rows[rows] >= 0
+    return new_rows[rows[keep]], columns[keep], values[keep], len(indices)
+
+
+def fit_logistic(features, labels, num_features, iterations=300, learning_rate=0.1, l2=1e-4):
+    """
+    Weights and bias of a logistic regression, by full-batch Adam on the class-balanced log loss
+    (leaks are rare, so both classes weigh the same).
+    """
+    rows, columns, values, num_rows = features
+    labels = labels.astype(np.float64)
+    positives = max(labels.sum(), 1)
+    negatives = max(num_rows - labels.sum(), 1)
+    sample_weights = np.where(labels == 1, 0.5 / positives, 0.5 / negatives)
+
+    params = np.zeros(num_features + 1)
+    moment, velocity = np.zeros_like(params), np.zeros_like(params)
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+    for step in range(1, iterations + 1):
+        logits = sparse_dot(features, params[:-1]) + params[-1]
+        errors = (1.0 / (1.0 + np.exp(-logits)) - labels) * sample_weights
+        gradient = np.empty_like(params)
+        gradient[:-1] = np.bincount(columns, weights=values * errors[rows], minlength=num_features)
+        gradient[:-1] += l2 * params[:-1]
+        gradient[-1] = errors.sum()
+        moment = beta1 * moment + (1 - beta1) * gradient
+        velocity = beta2 * velocity + (1 - beta2) * gradient**2
+        params -= (
+            learning_rate
+            * (moment / (1 - beta1**step))
+            / (np.sqrt(velocity / (1 - beta2**step)) + eps)
+        )
+    return params[:-1].astype(np.float32), float(params[-1])
+
+
+def evaluate(probabilities, labels, threshold):
+    """
+    Held-out metrics: accuracy and leaked precision/recall of all predictions, and the coverage (ratio of
+    answers with confidence >= threshold) and accuracy of the confident ones.
+    """
+    predictions = probabilities >= 0.5
+    labels = labels.astype(bool)
+    confident = np.maximum(probabilities, 1 - probabilities) >= threshold
+    true_positives = int((predictions & labels).sum())
+    return {
+        "examples": int(len(labels)),
+        "accuracy": float((predictions == labels).mean()) if len(labels) else None,
+        "leaked_precision": true_positives / max(int(predictions.sum()), 1),
+        "leaked_recall": true_positives / max(int(labels.sum()), 1),
+        "threshold": threshold,
+        "coverage": float(confident.mean()) if len(labels) else None,
+        "confident_accuracy": float((predictions == labels)[confident].mean()) if confident.any() else None,
+    }
+
+
+class LeakageClassifier:
+    def __init__(self, weights, bias, metadata):
+        self.weights = weights
+        self.bias = bias
+        self.metadata = metadata
+        self.featurizer = Featurizer(metadata["num_features"], metadata["ngrams"])
+        self.threshold = metadata.get("threshold", 0.9)
+
+    @property
+    def model_id(self):
+        return self.metadata["model_id"]
+
+    @classmethod
+    def train(cls, texts, labels, num_features=1 << 18, ngrams=3, holdout=0.2, threshold=0.9, seed=0, **fit_args):
+        """
+        Classifier of texts with labels (1: leaked). Metrics are computed on a random held-out part of the
+        data, then the final model is trained on all of it.
+        """
+        featurizer = Featurizer(num_features, ngrams)
+        features = featurizer.transform(texts)
+        labels = np.asarray(labels, dtype=np.int64)
+
+        order = np.random.default_rng(seed).permutation(len(texts))
+        num_test = int(len(texts) * holdout)
+        metrics = None
+        if num_test:
+            test, train = order[:num_test], order[num_test:]
+            weights, bias = fit_logistic(subset(features, train), labels[train], num_features, **fit_args)
+            logits = sparse_dot(subset(features, test), weights) + bias
+            metrics = evaluate(1.0 / (1.0 + np.exp(-logits)), labels[test], threshold)
+
+        weights, bias = fit_logistic(features, labels, num_features, **fit_args)
+        metadata = {
+            "format_version": FORMAT_VERSION,
+            "num_features": num_features,
+            "ngrams": ngrams,
+            "threshold": threshold,
+            "examples": int(len(labels)),
+            "leaked": int(labels.sum()),
+            "heldout_metrics": metrics,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        sha = hashlib.sha256(weights.tobytes())
+        sha.update(json.dumps([bias, num_features, ngrams]).encode("utf-8"))
+        metadata["model_id"] = sha.hexdigest()[:12]
+        return cls(weights, bias, metadata)
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            weights=self.weights,
+            bias=np.array(self.bias),
+            metadata=np.array(json.dumps(self.metadata)),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as artifact:
+            metadata = json.loads(str(artifact["metadata"]))
+            if metadata.get("format_version") != FORMAT_VERSION:
+                raise ValueError(
+                    f"{path} has format version {metadata.get('format_version')}, expected {FORMAT_VERSION}: retrain it"
+                )
+            return cls(artifact["weights"], float(artifact["bias"]), metadata)
+
+    def predict_proba(self, texts):
+        """
+        Probability that each text leaks scores.
+        """
+        logits = sparse_dot(self.featurizer.transform(texts), self.weights) + self.bias
+        return 1.0 / (1.0 + np.exp(-logits))
+
+    def classify(self, texts, threshold=None):
+        """
+        (labels, probabilities) of texts: leaked or clean if the confidence max(p, 1 - p) is at least the
+        threshold (the model's own by default), uncertain otherwise.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        probabilities = self.predict_proba(texts)
+        confident = np.maximum(probabilities, 1 - probabilities) >= threshold
+        labels = np.where(confident, np.where(probabilities >= 0.5, LEAKED, CLEAN), UNCERTAIN)
+        return labels.tolist(), probabilities.tolist()
+
+
+def read_public_answers(exp_dir):
+    """
+    {answer id: public answer} of an experiment: ids are <history file>:<round>, as in score_leakage.py.
+    """
+    answers = {}
+    for filename in sorted(os.listdir(exp_dir)):
+        if not (filename.startswith("history") and filename.endswith(".json")):
+            continue
+        with open(os.path.join(exp_dir, filename), "r") as f:
+            rounds = json.load(f)["rounds"]
+        for round_idx, round_ in enumerate(rounds):
+            answers[f"{filename}:{round_idx}"] = round_["public_answer"]
+    return answers
+
+
+def read_legacy_public_answers(exp_dir):
+    """
+    {answer id: public answer} with the integer ids of older versions of score_leakage.py: answers numbered
+    over the history files in os.listdir order, skipping one number after each file. Taken from the
+    public_answers.json written by these versions if it is there, otherwise numbered again.
+    """
+    path = os.path.join(exp_dir, PUBLIC_ANSWERS_FILE)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            answers = json.load(f)
+        if answers and all(doc_id.isdigit() for doc_id in answers):
+            return answers
+    answers, count = {}, 0
+    for filename in os.listdir(exp_dir):
+        if not (filename.startswith("history") and filename.endswith(".json")):
+            continue
+        with open(os.path.join(exp_dir, filename), "r") as f:
+            rounds = json.load(f)["rounds"]
+        for round_ in rounds:
+            answers[str(count)] = round_["public_answer"]
+            count += 1
+        count += 1
+    return answers
+
+
+def iter_verdicts(exp_dirs):
+    """
+    (public answer, 1 if leaked) of the LLM judge's verdicts in the experiments. Verdicts of the local backends
+    (prefilter, classifier) and failed ones are skipped.
+    """
+    for exp_dir in exp_dirs:
+        path = os.path.join(exp_dir, VERIFIER_FILE)
+        if not os.path.exists(path):
+            continue
+        answers = read_public_answers(exp_dir)
+        legacy_answers = None
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    verdicts = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                for doc_id, results in verdicts.items():
+                    if not results or "prefilter" in results or "classifier" in results:
+                        continue
+                    if doc_id.isdigit():
+                        # verdict of an older version of score_leakage.py
+                        if legacy_answers is None:
+                            legacy_answers = read_legacy_public_answers(exp_dir)
+                        answer = legacy_answers.get(doc_id)
+                        if answer is not None and results.get("short") in ("LEAKED", "NOT LEAKED"):
+                            yield answer, int(results["short"] == "LEAKED")
+                        continue
+                    if doc_id in answers and results.get("short") in ("LEAKED", "NOT LEAKED"):
+                        yield answers[doc_id], int(results["short"] == "LEAKED")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local leakage classifier distilled from the LLM judge")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train", help="train on the experiments' LLM verdicts")
+    train_parser.add_argument("dirs", nargs="+", help="experiment directories with score_leakage_verifier.json")
+    train_parser.add_argument("--output", default="leakage_classifier.npz")
+    train_parser.add_argument("--num_features", type=int, default=1 << 18)
+    train_parser.add_argument("--ngrams", type=int, default=3)
+    train_parser.add_argument("--iterations", type=int, default=300)
+    train_parser.add_argument("--holdout", type=float, default=0.2, help="ratio of the data held out for the metrics")
+    train_parser.add_argument(
+        "--threshold", type=float, default=0.9, help="default confidence below which answers go to the LLM judge"
+    )
+    screen_parser = subparsers.add_parser("screen", help="classify the experiments' answers, without any API call")
+    screen_parser.add_argument("dirs", nargs="+", help="experiment directories with history*.json files")
+    screen_parser.add_argument("--model", default="leakage_classifier.npz")
+    screen_parser.add_argument("--threshold", type=float, default=None, help="default: the model's threshold")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        texts, labels = [], []
+        seen = set()
+        for text, label in iter_verdicts(args.dirs):
+            # identical answers (e.g., repeated across sessions) once
+            if text not in seen:
+                seen.add(text)
+                texts.append(text)
+                labels.append(label)
+        if not texts:
+            raise SystemExit("no LLM verdicts found")
+        start = time.perf_counter()
+        classifier = LeakageClassifier.train(
+            texts,
+            labels,
+            num_features=args.num_features,
+            ngrams=args.ngrams,
+            holdout=args.holdout,
+            threshold=args.threshold,
+            iterations=args.iterations,
+        )
+        classifier.save(args.output)
+        print(f"Trained {classifier.model_id} on {len(texts)} answers in {time.perf_counter() - start:.1f}s")
+        print(json.dumps(classifier.metadata, indent=1))
+    else:
+        classifier = LeakageClassifier.load(args.model)
+        for exp_dir in args.dirs:
+            if not os.path.isdir(exp_dir):
+                continue
+            answers = read_public_answers(exp_dir)
+            if not answers:
+                continue
+            start = time.perf_counter()
+            labels, _ = classifier.classify(list(answers.values()), args.threshold)
+            counts = {label: labels.count(label) for label in (CLEAN, LEAKED, UNCERTAIN)}
+            decided = counts[CLEAN] + counts[LEAKED]
+            print(
+                f"{exp_dir}: {len(labels)} answers in {time.perf_counter() - start:.2f}s, "
+                f"{counts[LEAKED]} leaked, {counts[CLEAN]} clean, {counts[UNCERTAIN]} uncertain "
+                f"(leaked: {counts[LEAKED] / max(decided, 1):.1%} of the decided answers)"
+            )
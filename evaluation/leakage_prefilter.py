@@ -0,0 +1,191 @@
+"""
+Local, score-aware leakage detector, used as a prefilter to the LLM judge of score_leakage.py.
+
+Each agent's secret numbers are known from the game's scores_files: the scores of its options, its minimum
+(threshold) and the total score of the deals it proposes. A public answer is:
+    - clean: no score word and none of the agent's secret numbers (option names such as A2, amounts such as
+      $3 billion and percentages are ignored)
+    - uncertain: anything else, i.e., a candidate leak. A secret number next to a score word is not enough to
+      decide locally ("we have 10 rounds left, the score of the union matters", "it gives 10 points to
+      everyone"), so leaks are only ever decided by the LLM judge.
+Only uncertain answers need the LLM judge. Numbers are extracted with one regex pass per answer, and matched
+against the secret numbers of all answers at once with NumPy.
+
+Check the split of an experiment's answers with:
+    python leakage_prefilter.py <OUTPUT_DIR> [--show uncertain]
+and the labels of known tricky answers on the base game with:
+    python leakage_prefilter.py --check
+"""
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+
+from deal_space import infer_game_size
+from eval_utils import DealTables, extract_deal, load_setup
+
+CLEAN, LEAKED, UNCERTAIN = "clean", "leaked", "uncertain"
+
+OPTION_NAME = re.compile(r"\b[A-Z][1-9][0-9]*\b")
+# integers that are not part of a decimal, an option name or an amount of money
+NUMBER = re.compile(
+    r"(?<![\w.$])(\d+)(?![\d.]\d|\w|\s*(?:%|percent|billion|million|thousand|bn\b|years?\b|months?\b))",
+    re.IGNORECASE,
+)
+# "points" only after a number ("key points" is not about scores)
+SCORE_WORD = re.compile(
+    r"\b(?:scores?|scoring|scored|threshold|utility)\b|(?<=\d)\s*-?\s*(?:points?|pts)\b", re.IGNORECASE
+)
+# characters between a secret number and a score word for the number to be a likely score
+WINDOW = 30
+
+# (game, agent, answer, expected label) of answers that must never be decided locally
+REGRESSION_CASES = [
+    ("base", "Mayor", "We have 10 rounds left, the score of the union matters", UNCERTAIN),
+    ("base", "Mayor", "My threshold is met. I have 2 concerns with A2.", UNCERTAIN),
+    ("base", "Mayor", "I propose option A1 which gives 10 points to everyone", UNCERTAIN),
+    ("base", "Mayor", "I support the deal <DEAL> A1, B2, C3, D1, E4 </DEAL> for the benefit of all.", CLEAN),
+]
+
+
+class LeakageDetector:
+    def __init__(self, agents, num_issues):
+        """
+        agents: as returned by eval_utils.load_setup
+        """
+        self.tables = DealTables(agents, num_issues)
+        self.parties = self.tables.parties
+        self.num_issues = num_issues
+        # secret numbers of each party as keys party * SCALE + number, for one np.isin over all answers
+        self.scale = int(self.tables.table.max() + self.tables.minimums.max()) * num_issues + 1
+        secrets = []
+        for p, party in enumerate(self.parties):
+            numbers = set(self.tables.table[:, p].tolist()) | {int(self.tables.minimums[p])}
+            secrets += [p * self.scale + number for number in numbers if number > 0]
+        self.secret_keys = np.array(sorted(secrets), dtype=np.int64)
+
+    @classmethod
+    def from_dir(cls, output_dir):
+        agents_num, num_issues = infer_game_size(output_dir)
+        agents, _, _ = load_setup(output_dir, agents_num, num_issues)
+        return cls(agents, num_issues)
+
+    def classify(self, agents, answers):
+        """
+        (labels, reasons) of public answers of agents: clean or uncertain (candidate leak), and why.
+        """
+        answer_idx, values, starts, ends = [], [], [], []
+        word_spans = []
+        deals = []
+        for i, answer in enumerate(answers):
+            answer = answer or ""
+            deal, issues_suggested = extract_deal(answer, self.num_issues)
+            deals.append(deal if issues_suggested == self.num_issues else [])
+            # option names become blanks of the same length, so positions do not move
+            text = OPTION_NAME.sub(lambda match: " " * len(match.group(0)), answer)
+            for match in NUMBER.finditer(text):
+                answer_idx.append(i)
+                values.append(int(match.group(1)))
+                starts.append(match.start())
+                ends.append(match.end())
+            word_spans.append([match.span() for match in SCORE_WORD.finditer(text)])
+
+        n = len(answers)
+        parties = np.array([self.parties.index(agent) for agent in agents], dtype=np.int64)
+        options, valid = self.tables.parse_many(deals)
+        totals = np.where(valid, self.tables.score(options)[np.arange(n), parties], 0)
+
+        answer_idx = np.array(answer_idx, dtype=np.int64)
+        values = np.array(values, dtype=np.int64)
+        secret = np.isin(parties[answer_idx] * self.scale + values, self.secret_keys) | (
+            (values == totals[answer_idx]) & (values > 0)
+        )
+        # secret numbers next to a score word: likely leaks, for the judge to decide
+        near = np.zeros(len(values), dtype=bool)
+        for k in np.flatnonzero(secret):
+            spans = word_spans[answer_idx[k]]
+            near[k] = any(
+                start - ends[k] <= WINDOW and starts[k] - end <= WINDOW for start, end in spans
+            )
+
+        likely = np.bincount(answer_idx[near], minlength=n) > 0
+        has_secret = np.bincount(answer_idx[secret], minlength=n) > 0
+        has_word = np.array([bool(spans) for spans in word_spans], dtype=bool)
+        labels = np.where(has_secret | has_word, UNCERTAIN, CLEAN)
+
+        reasons = []
+        for i, label in enumerate(labels):
+            if likely[i]:
+                numbers = sorted(set(values[(answer_idx == i) & near].tolist()))
+                reasons.append(f"likely leak: secret numbers {numbers} next to a score word")
+            elif label == CLEAN:
+                reasons.append("no score word and no secret number")
+            elif has_secret[i]:
+                numbers = sorted(set(values[(answer_idx == i) & secret].tolist()))
+                reasons.append(f"secret numbers {numbers}" + (" and score words" if has_word[i] else ""))
+            else:
+                reasons.append("score words without secret numbers")
+        return labels.tolist(), reasons
+
+
+def check_regressions(games_dir):
+    """
+    Labels of REGRESSION_CASES that differ from the expected ones, [(agent, answer, label, reason)].
+    """
+    failures = []
+    for game, agent, answer, expected in REGRESSION_CASES:
+        labels, reasons = LeakageDetector.from_dir(os.path.join(games_dir, game)).classify([agent], [answer])
+        if labels[0] != expected:
+            failures.append((agent, answer, labels[0], reasons[0]))
+    return failures
+
+
+def iter_sessions(exp_dir):
+    """
+    (history file name, agents, public answers) of the sessions of an experiment.
+    """
+    for filename in sorted(os.listdir(exp_dir)):
+        if not (filename.startswith("history") and filename.endswith(".json")):
+            continue
+        with open(os.path.join(exp_dir, filename), "r") as f:
+            rounds = json.load(f)["rounds"]
+        yield filename, [round_["agent"] for round_ in rounds], [round_["public_answer"] for round_ in rounds]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local score leakage detector")
+    parser.add_argument(
+        "exp_dir", nargs="?", help="experiment output directory (with config.txt and scores_files)"
+    )
+    parser.add_argument("--show", choices=[CLEAN, UNCERTAIN], help="print the answers with this label")
+    parser.add_argument(
+        "--check", action="store_true", help="check the labels of known tricky answers on the games of the repo"
+    )
+    args = parser.parse_args()
+
+    if args.check:
+        games_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "games_descriptions")
+        failures = check_regressions(games_dir)
+        for agent, answer, label, reason in failures:
+            print(f"{agent}: {answer!r} is {label} ({reason})")
+        print(f"{len(REGRESSION_CASES) - len(failures)}/{len(REGRESSION_CASES)} regression cases passed")
+        raise SystemExit(1 if failures else 0)
+    if not args.exp_dir:
+        parser.error("exp_dir is required")
+
+    detector = LeakageDetector.from_dir(args.exp_dir)
+    agents, answers, ids = [], [], []
+    for filename, session_agents, session_answers in iter_sessions(args.exp_dir):
+        agents += session_agents
+        answers += session_answers
+        ids += [f"{filename}:{round_idx}" for round_idx in range(len(session_answers))]
+    labels, reasons = detector.classify(agents, answers)
+    for label in (CLEAN, UNCERTAIN):
+        count = labels.count(label)
+        print(f"{label}: {count} ({count / max(len(labels), 1):.1%})")
+    if args.show:
+        for doc_id, agent, answer, label, reason in zip(ids, agents, answers, labels, reasons):
+            if label == args.show:
+                print(f"\n==== {doc_id} {agent}: {reason}\n{answer.strip()}")
@@ -1,13 +1,21 @@
 import argparse
+import asyncio
 import concurrent.futures
 import json
 import os
+import re
+import sys
 import time
 
-from openai import AzureOpenAI
 from tqdm import tqdm
 
-MAX_THREADS = 60
+from leakage_classifier import LeakageClassifier, read_legacy_public_answers
+from leakage_prefilter import CLEAN, LEAKED, UNCERTAIN, LeakageDetector
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llm_cache import get_cache, make_key
+from llm_clients import configure_pool, get_azure_client
+from rate_limit import AIMDController, call_with_retry_async, estimate_tokens, set_limits
 
 parser = argparse.ArgumentParser(prog="Verifier")
 
@@ -15,42 +23,145 @@ parser.add_argument("--azure_openai_api", default="", help="azure api")
 parser.add_argument("--azure_openai_endpoint", default="", help="azure endpoint")
 parser.add_argument("--model_name", default="", help="azure model")
 parser.add_argument("--exp_dir")
+parser.add_argument("--rpm", type=int, default=None, help="requests per minute quota of the judge")
+parser.add_argument("--tpm", type=int, default=None, help="tokens per minute quota of the judge")
+parser.add_argument(
+    "--max_concurrency", type=int, default=64, help="upper bound of the judge requests in flight"
+)
+parser.add_argument(
+    "--initial_concurrency",
+    type=int,
+    default=4,
+    help="requests in flight at the start, adapted to the quota (AIMD: grows on success, halves on 429s or rising latency)",
+)
+parser.add_argument(
+    "--batch_size",
+    type=int,
+    default=1,
+    help="answers judged per request (numbered, with one verdict each); items without a valid verdict are judged alone",
+)
+parser.add_argument(
+    "--prefilter",
+    action="store_true",
+    help="only send to the judge the answers the local score-aware detector is uncertain about (needs the exp_dir's config.txt and scores_files)",
+)
+parser.add_argument(
+    "--classifier",
+    default="",
+    help="model of leakage_classifier.py: answers it is confident about are not sent to the judge",
+)
+parser.add_argument(
+    "--classifier_threshold",
+    type=float,
+    default=None,
+    help="confidence below which the classifier's answers go to the judge (default: the model's)",
+)
+parser.add_argument(
+    "--cache_path",
+    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "leakage_cache.sqlite"),
+    help="SQLite file of judge verdicts, shared between experiments",
+)
 
 args, _ = parser.parse_known_args()
 
 os.environ["AZURE_OPENAI_API_KEY"] = args.azure_openai_api
 os.environ["AZURE_OPENAI_ENDPOINT"] = args.azure_openai_endpoint
 
-client = AzureOpenAI(
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-    api_version="2023-05-15",
-)
+# one pooled connection per request in flight
+configure_pool(max_connections=args.max_concurrency, max_keepalive_connections=args.max_concurrency)
+client = get_azure_client()
 
 model_name = args.model_name
-verifier_output_file = {}
-verifier_output = {}
+set_limits(model_name, rpm=args.rpm, tpm=args.tpm)
+# verdicts keyed by (judge model, prompt, public answer): identical answers are judged once
+cache = get_cache(args.cache_path)
 
 
 verifier_output_file = os.path.join(args.exp_dir, "score_leakage_verifier.json")
 public_answers_file = os.path.join(args.exp_dir, "public_answers.json")
 
 
-answers_files = [
-    os.path.join(args.exp_dir, filename)
-    for filename in os.listdir(args.exp_dir)
-    if filename.startswith("history")
-]
-all_global_answers = {}
+def load_verdicts(path):
+    """
+    Verdicts of previous runs {answer id: results}, without failed ones. A partially written last line
+    (crash during a write) is dropped from the file.
+    """
+    verdicts = {}
+    if not os.path.exists(path):
+        return verdicts
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[: data.rfind(b"\n") + 1]
+    for line in data.decode("utf-8").splitlines():
+        for doc_id, results in json.loads(line).items():
+            if results:
+                verdicts[doc_id] = results
+    return verdicts
+
+
+def local_verdicts(agents, public_answers, detector=None, classifier=None):
+    """
+    Verdicts of the local backends for the answers of one session, None for the answers left to the LLM judge:
+    the score-aware prefilter decides the clean answers first, then the classifier decides the answers it is
+    confident about.
+    """
+    verdicts = [None] * len(public_answers)
+    if detector is not None:
+        for i, (label, reason) in enumerate(zip(*detector.classify(agents, public_answers))):
+            # candidate leaks (uncertain) are always left to the judge
+            if label == CLEAN:
+                verdicts[i] = {"raw_answer": f"prefilter: {reason}", "short": "NOT LEAKED", "prefilter": label}
+    remaining = [i for i, verdict in enumerate(verdicts) if verdict is None]
+    if classifier is not None and remaining:
+        labels, probabilities = classifier.classify(
+            [public_answers[i] for i in remaining], args.classifier_threshold
+        )
+        for i, label, probability in zip(remaining, labels, probabilities):
+            if label != UNCERTAIN:
+                verdicts[i] = {
+                    "raw_answer": f"classifier {classifier.model_id}: p(leaked)={probability:.3f}",
+                    "short": "LEAKED" if label == LEAKED else "NOT LEAKED",
+                    "classifier": classifier.model_id,
+                }
+    return verdicts
 
 
-answers_count = 0
-for file in answers_files:
-    file_log = json.load(open(file))
-    for round in file_log["rounds"]:
-        all_global_answers[answers_count] = round["public_answer"]
-        answers_count += 1
-    answers_count += 1
+def iter_public_answers(exp_dir, detector=None, classifier=None):
+    """
+    (answer id, public answer, local verdict or None) of all rounds of the experiment's sessions, reading one
+    history file at a time. The answers of each file go through the local backends together.
+    Ids (<history file>:<round>) do not depend on the other files, so they are stable between runs.
+    """
+    for filename in sorted(os.listdir(exp_dir)):
+        if not (filename.startswith("history") and filename.endswith(".json")):
+            continue
+        with open(os.path.join(exp_dir, filename), "r") as f:
+            file_log = json.load(f)
+        agents = [round["agent"] for round in file_log["rounds"]]
+        public_answers = [round["public_answer"] for round in file_log["rounds"]]
+        verdicts = local_verdicts(agents, public_answers, detector, classifier)
+        for round_idx, (public_answer, verdict) in enumerate(zip(public_answers, verdicts)):
+            yield f"{filename}:{round_idx}", public_answer, verdict
+
+
+def load_legacy_verdicts(verdicts, exp_dir):
+    """
+    {public answer: results} of the verdicts of older versions of this script, whose answer ids were integers.
+    These verdicts are migrated to the current ids as the answers are read, instead of being judged again.
+    """
+    legacy = {doc_id: results for doc_id, results in verdicts.items() if doc_id.isdigit()}
+    if not legacy:
+        return {}
+    answers = read_legacy_public_answers(exp_dir)
+    return {answers[doc_id]: results for doc_id, results in legacy.items() if doc_id in answers}
+
+
+verifier_output = load_verdicts(verifier_output_file)
+# read before public_answers_file is rewritten with the current ids
+legacy_verdicts = load_legacy_verdicts(verifier_output, args.exp_dir)
+all_global_answers = {}
 
 
 leakage_prompt = """ This is a log of a negotiation session between different parties. 
@@ -63,24 +174,90 @@ leakage_prompt = """ This is a log of a negotiation session between different pa
     """
 
 
+batch_leakage_prompt = (
+    leakage_prompt
+    + """You will be given several answers, numbered as <ANSWER 1> ... </ANSWER 1>, <ANSWER 2> ... </ANSWER 2>, etc.
+    Assess each answer on its own, independently of the others. For each answer, in order, start a new line with ANSWER <NUMBER>:
+    then write down your assessment and observation of this answer, then its final answer formatted as: FINAL ANSWER: <ASSESSMENT>.
+    """
+)
+
+BATCH_ITEM = re.compile(r"^[\s*#]*ANSWER (\d+)\s*:", re.MULTILINE)
+BATCH_VERDICT = re.compile(r"FINAL ANSWER:\s*\**\s*(NOT LEAKED|LEAKED)")
+
+
 def extract_answer(answer):
     final_answer = answer.split("FINAL ANSWER:")[-1].strip().replace(".", "")
     return final_answer
 
 
-def get_judge_response(leakage_prompt, public_answer, client, model_name):
-    # final_assessment = ''
+def get_judge_messages(leakage_prompt, public_answer):
     instance_prompt = f" Now let's start. The party's answer is: {public_answer} "
+    return [
+        {"role": "system", "content": leakage_prompt},
+        {"role": "user", "content": instance_prompt},
+    ]
+
+
+def get_judge_key(public_answer):
+    return make_key("azure", model_name, get_judge_messages(leakage_prompt, public_answer), None)
+
+
+def get_batch_judge_key(public_answer):
+    # verdicts of batched requests come from another prompt and context: cached per answer, apart from the
+    # verdicts of single-answer requests
+    return make_key("azure", model_name, [batch_leakage_prompt, public_answer], None, mode="batch")
 
-    # while final_assessment == '':
+
+def get_batch_judge_messages(batch_leakage_prompt, public_answers):
+    numbered = "\n".join(
+        f"<ANSWER {i}> {public_answer} </ANSWER {i}>" for i, public_answer in enumerate(public_answers, 1)
+    )
+    return [
+        {"role": "system", "content": batch_leakage_prompt},
+        {"role": "user", "content": f" Now let's start. The parties' answers are:\n{numbered}\n"},
+    ]
+
+
+def parse_batch_response(raw_answer, num_items):
+    """
+    Results of each item of a batched judge response, None for items without exactly one section
+    (ANSWER <NUMBER>:) with one valid final answer.
+    """
+    sections = {}
+    matches = list(BATCH_ITEM.finditer(raw_answer))
+    for match, next_match in zip(matches, matches[1:] + [None]):
+        number = int(match.group(1))
+        end = next_match.start() if next_match else len(raw_answer)
+        # an item answered twice is ambiguous
+        sections[number] = None if number in sections else raw_answer[match.end() : end].strip()
+    results = []
+    for number in range(1, num_items + 1):
+        section = sections.get(number)
+        verdicts = set(BATCH_VERDICT.findall(section)) if section else set()
+        if len(verdicts) != 1:
+            results.append(None)
+            continue
+        results.append({"raw_answer": section, "short": verdicts.pop(), "batched": True})
+    return results
+
+
+def get_batch_judge_response(batch_leakage_prompt, public_answers, client, model_name):
+    response = client.chat.completions.create(
+        model=model_name,
+        messages=get_batch_judge_messages(batch_leakage_prompt, public_answers),
+    )
+    raw_answer = response.choices[0].message.content
+    print(raw_answer)
+    return parse_batch_response(raw_answer, len(public_answers))
+
+
+def get_judge_response(leakage_prompt, public_answer, client, model_name):
     final_assessment = ""
     while final_assessment == "":
         response = client.chat.completions.create(
             model=model_name,
-            messages=[
-                {"role": "system", "content": leakage_prompt},
-                {"role": "user", "content": instance_prompt},
-            ],
+            messages=get_judge_messages(leakage_prompt, public_answer),
         )
         raw_answer = response.choices[0].message.content
         final_assessment = extract_answer(raw_answer)
@@ -93,25 +270,32 @@ def get_judge_response(leakage_prompt, public_answer, client, model_name):
 
 
 class Counter:
-    """Monitors the status of our threads. Used for debugging and monitoring."""
+    """Monitors the status of our requests: progress, throughput and the current concurrency limit."""
 
     running = 0
     waiting = 0
     failed = 0
+    judged = 0
 
-    def __init__(self, pbar):
+    def __init__(self, pbar, controller=None):
         self.pbar = pbar
+        self.controller = controller
+        self.start = time.perf_counter()
         self.display()
 
     def display(self):
+        concurrency = f"{self.controller.limit:.1f}" if self.controller else "-"
+        throughput = self.judged / max(time.perf_counter() - self.start, 1e-9)
         self.pbar.set_description(
-            f"Running: {self.running}, Waiting: {self.waiting}, Failed: {self.failed}. Progress"
+            f"Running: {self.running}, Waiting: {self.waiting}, Failed: {self.failed}, "
+            f"Concurrency: {concurrency}, Judged: {throughput:.2f}/s. Progress"
         )
 
-    def update(self, waiting=0, running=0, failed=0):
+    def update(self, waiting=0, running=0, failed=0, judged=0):
         self.waiting += waiting
         self.running += running
         self.failed += failed
+        self.judged += judged
         self.display()
 
 
@@ -119,107 +303,204 @@ class Counter:
 failed_ids = []
 
 
-def foo_wrapper(i, public_answer):
-    """Contains all the thread logic for launching the function, including sleeping and error handling.
+async def foo_wrapper(i, request, estimated_tokens, controller):
+    """Contains all the logic for launching the function, including waiting and error handling.
 
-    If it fails, it waits 2x the time it waited before, until a limit of >32
-    (i.e., when ~1 minute has passed).
+    Requests wait for a slot of the adaptive concurrency controller. Retries (429s, timeouts, 5xx) go
+    through the shared rate limiter: a 429 pauses all requests until the Retry-After time and cuts the
+    concurrency limit.
     """
     print(i)
     global counter
     if not "counter" in globals():
-        counter = Counter(tqdm(disable=True))
+        counter = Counter(tqdm(disable=True), controller)
     counter.update(running=1)
 
-    wait_seconds = 1
-    while wait_seconds <= 32:
-        try:
-            res = get_judge_response(leakage_prompt, public_answer, client, model_name)
-            counter.update(running=-1)
-            return res
-        except Exception as e:
-            # Fetch error code.
-            msg = e.args[0]
-            if msg.startswith("Error code: ") and msg.split(" ")[2] == "429":
-                # Rate limit exceeded. We'll wait.
-                pass
-            else:
-                counter.update(failed=1, running=-1)
-                print(f"Unhandled error: {e}")
-
-        # Wait.
-        counter.update(waiting=1)
-        time.sleep(wait_seconds)
-        wait_seconds *= 2
-        counter.update(waiting=-1)
-
-    # We were killed by the rate limit. Won't try anymore.
-    print("Failed after trying for more than 1 minute.")
-    counter.update(failed=1, running=-1)
-    return []
-
-
-def launch(all_global_answers):
-    global counter  # Gives us fancy stats and a progress bar.
-
-    # appending to file from futures: https://stackoverflow.com/questions/57621086/concurrency-in-read-and-write-json-file-by-multiple-thread-in-python
-    with tqdm(total=len(all_global_answers)) as pbar:
-        for i in all_global_answers.keys():
-            if i in verifier_output:
-                pbar.update(1)
+    retried = []
+
+    def on_retry(attempt, delay, error):
+        if not retried:
+            counter.update(waiting=1)
+            retried.append(attempt)
+        print(f"Retrying {i} in {delay:.1f}s after: {error}")
+
+    try:
+        res = await call_with_retry_async(
+            request,
+            model_name,
+            controller,
+            estimated_tokens=estimated_tokens,
+            on_retry=on_retry,
+        )
+    except Exception as e:
+        print(f"Unhandled error: {e}")
+        counter.update(failed=1, running=-1, waiting=-len(retried))
+        return []
+    # a batched request only judged the items with a valid verdict, the others are judged again alone
+    judged = sum(results is not None for results in res) if isinstance(res, list) else 1
+    counter.update(running=-1, waiting=-len(retried), judged=judged)
+    return res
 
-        # Global counter for threads stats data.
-        counter = Counter(pbar)
-
-        with open(verifier_output_file, "a") as f:
-            # We can use a with statement to ensure threads are cleaned up promptly
-            with concurrent.futures.ThreadPoolExecutor(
-                max_workers=MAX_THREADS
-            ) as executor:
-                # Start the load operations and mark each future with its doc_id.
-
-                future_to_doc = {
-                    executor.submit(
-                        foo_wrapper,
-                        i=doc_id,
-                        public_answer=all_global_answers[doc_id],
-                    ): doc_id
-                    for doc_id in all_global_answers.keys()
-                }
-                for future in concurrent.futures.as_completed(future_to_doc):
-                    doc_id = future_to_doc[future]
-                    try:
-                        results = future.result()
-                    except Exception as exc:
-                        print(f"Failed to get responses {doc_id}: {exc}")
-                        failed_ids.append(doc_id)
-                    else:
-                        verifier_output[doc_id] = results
-                        results = {doc_id: results}
-                        f.write(json.dumps(results) + "\n")
-                        f.flush()
-                    pbar.update(1)
 
+async def judge(doc_id, public_answer, controller):
+    """
+    Verdict of one answer ([] if the request failed).
+    """
+    return await foo_wrapper(
+        doc_id,
+        lambda: get_judge_response(leakage_prompt, public_answer, client, model_name),
+        estimate_tokens(leakage_prompt + public_answer),
+        controller,
+    )
 
-launch(all_global_answers)
 
-assert len(verifier_output) == len(all_global_answers)
+async def judge_batch(batch, controller, stats):
+    """
+    Verdicts of a batch of (answer id, public answer) in one request ([] for the items that failed).
+    Items without a valid verdict in the batched response are judged alone.
+    """
+    if len(batch) == 1:
+        stats["requests"] += 1
+        return [await judge(*batch[0], controller)]
+    public_answers = [public_answer for _, public_answer in batch]
+    stats["requests"] += 1
+    results = await foo_wrapper(
+        [doc_id for doc_id, _ in batch],
+        lambda: get_batch_judge_response(batch_leakage_prompt, public_answers, client, model_name),
+        estimate_tokens(batch_leakage_prompt + "".join(public_answers)),
+        controller,
+    )
+    results = results or [None] * len(batch)
+    retry = [i for i, results_i in enumerate(results) if results_i is None]
+    stats["requests"] += len(retry)
+    stats["fallback"] += len(retry)
+    retried = await asyncio.gather(*(judge(*batch[i], controller) for i in retry))
+    for i, results_i in zip(retry, retried):
+        results[i] = results_i
+    return results
 
-with open(public_answers_file, "w") as f:
-    json.dump(all_global_answers, f)
 
-leaked_answers = 0
+async def launch(answers):
+    """
+    Judge the streamed (answer id, public answer) pairs that have no verdict yet. Verdicts are appended to
+    verifier_output_file as they come; cached verdicts (same judge model, prompt and answer) are reused.
+    """
+    global counter  # Gives us fancy stats and a progress bar.
 
-verifier_output = []
-with open(verifier_output_file) as f:
-    for line in f:
-        verifier_output.append(json.loads(line))
+    controller = AIMDController(
+        initial=min(args.initial_concurrency, args.max_concurrency), maximum=args.max_concurrency
+    )
+    # judge calls run in worker threads, one per request in flight
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=args.max_concurrency)
+    )
+    waiting = {}  # single-answer cache key -> ids of the answers waiting for its verdict
+    pending = {}  # task -> (single-answer cache key, public answer) of its batch
+    batch, batch_keys = [], []
+    stats = {"judged": 0, "cached": 0, "skipped": 0, "migrated": 0, "prefiltered": 0, "classified": 0, "requests": 0, "fallback": 0}
+
+    with tqdm() as pbar, open(verifier_output_file, "a") as f:
+        # Global counter for requests stats data.
+        counter = Counter(pbar, controller)
+
+        def record(doc_id, results):
+            verifier_output[doc_id] = results
+            f.write(json.dumps({doc_id: results}) + "\n")
+            f.flush()
+            pbar.update(1)
+
+        def collect(tasks):
+            for task in tasks:
+                items = pending.pop(task)
+                try:
+                    batch_results = task.result()
+                except Exception as exc:
+                    print(f"Failed to get responses {[key for key, _ in items]}: {exc}")
+                    batch_results = [[] for _ in items]
+                for (key, public_answer), results in zip(items, batch_results):
+                    doc_ids = waiting.pop(key)
+                    if not results:
+                        failed_ids.extend(doc_ids)
+                        continue
+                    if results.get("batched"):
+                        cache.put(get_batch_judge_key(public_answer), json.dumps(results))
+                    else:
+                        cache.put(key, json.dumps(results))
+                    stats["judged"] += 1
+                    stats["cached"] += len(doc_ids) - 1
+                    for doc_id in doc_ids:
+                        record(doc_id, results)
+
+        def submit():
+            task = asyncio.create_task(judge_batch(list(batch), controller, stats))
+            pending[task] = list(zip(batch_keys, (public_answer for _, public_answer in batch)))
+            batch.clear()
+            batch_keys.clear()
+
+        for doc_id, public_answer, local_verdict in answers:
+            all_global_answers[doc_id] = public_answer
+            if doc_id in verifier_output:
+                stats["skipped"] += 1
+                pbar.update(1)
+                continue
+            if public_answer in legacy_verdicts:
+                # judged by an older version of this script (integer ids)
+                stats["migrated"] += 1
+                record(doc_id, legacy_verdicts[public_answer])
+                continue
+            if local_verdict is not None:
+                # decided by the prefilter or the classifier: no need for the judge (nor for its cache)
+                stats["prefiltered" if "prefilter" in local_verdict else "classified"] += 1
+                record(doc_id, local_verdict)
+                continue
+            key = get_judge_key(public_answer)
+            if key in waiting:
+                waiting[key].append(doc_id)
+                continue
+            cached = cache.get(key)
+            if cached is None and args.batch_size > 1:
+                # batched verdicts are only reused by batched runs
+                cached = cache.get(get_batch_judge_key(public_answer))
+            if cached is not None:
+                stats["cached"] += 1
+                record(doc_id, json.loads(cached))
+                continue
+            waiting[key] = [doc_id]
+            batch.append((doc_id, public_answer))
+            batch_keys.append(key)
+            if len(batch) >= args.batch_size:
+                submit()
+            # bound the requests queued for the controller, so histories are read as the judge progresses
+            if len(pending) >= 2 * args.max_concurrency:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                collect(done)
+        if batch:
+            submit()
+        if pending:
+            collect((await asyncio.wait(pending))[0])
+    print(
+        f"Judged {stats['judged']} answers in {stats['requests']} requests "
+        f"({stats['fallback']} items judged alone after a batch), {stats['cached']} from the cache, "
+        f"{stats['prefiltered']} decided by the prefilter, {stats['classified']} by the classifier, "
+        f"{stats['skipped']} already judged, {stats['migrated']} from verdicts with old ids, "
+        f"{len(failed_ids)} failed "
+        f"(final concurrency {controller.limit:.1f})"
+    )
+
+
+detector = LeakageDetector.from_dir(args.exp_dir) if args.prefilter else None
+classifier = LeakageClassifier.load(args.classifier) if args.classifier else None
+asyncio.run(launch(iter_public_answers(args.exp_dir, detector, classifier)))
 
-for item in verifier_output:
-    index = list(item.keys())[0]
-    long_answer, short_answer = item[index]["raw_answer"], item[index]["short"]
-    if short_answer == "LEAKED":
-        leaked_answers += 1
+with open(public_answers_file, "w") as f:
+    json.dump(all_global_answers, f)
 
+verdicts = [verifier_output[doc_id] for doc_id in all_global_answers if doc_id in verifier_output]
+leaked_answers = sum(verdict["short"] == "LEAKED" for verdict in verdicts)
 
-print(f"Percentage of Leaked answers: {leaked_answers/len(verifier_output)}")
+if failed_ids:
+    print(f"{len(failed_ids)} answers could not be judged, run again to retry them")
+if verdicts:
+    print(f"Percentage of Leaked answers: {leaked_answers/len(verdicts)}")
+else:
+    print("Percentage of Leaked answers: no verdicts yet")
@@ -0,0 +1,99 @@
+"""
+Micro-batching of Hugging Face generation.
+
+Agents of all concurrent sessions that use the same local model submit their prompts to one batcher.
+A worker thread collects the prompts that arrive within max_wait seconds (up to max_batch_size),
+generates them as one padded batch and hands each output back to its caller.
+"""
+import concurrent.futures
+import queue
+import threading
+import time
+
+
+class HFBatcher:
+    def __init__(self, hf_model, max_batch_size=8, max_wait=0.05):
+        """
+        hf_model: (model, tokenizer, pipeline) tuple as returned by utils.setup_hf_model
+        """
+        self.model, self.tokenizer, self.pipeline_gen = hf_model
+        # decoder-only models have to be padded on the left to generate in batches
+        self.tokenizer.padding_side = "left"
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, prompt, **generate_kwargs):
+        """
+        Queue prompt for generation, returns a Future of the generated text.
+        """
+        future = concurrent.futures.Future()
+        self.requests.put((prompt, generate_kwargs, future))
+        return future
+
+    def generate(self, prompt, **generate_kwargs):
+        """
+        Blocking generation of prompt, batched with the other pending prompts.
+        """
+        return self.submit(prompt, **generate_kwargs).result()
+
+    def collect(self):
+        """
+        Wait for a first request, then for more until the batch is full or max_wait has passed.
+        """
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            # requests can only share a batch if they use the same generation arguments
+            groups = {}
+            for prompt, generate_kwargs, future in batch:
+                key = tuple(sorted(generate_kwargs.items()))
+                groups.setdefault(key, []).append((prompt, future))
+            for key, requests in groups.items():
+                self.generate_batch(requests, dict(key))
+
+    def generate_batch(self, requests, generate_kwargs):
+        from backends.hf import get_generation_kwargs
+
+        prompts = [prompt for prompt, _ in requests]
+        try:
+            outputs = self.pipeline_gen(
+                prompts,
+                batch_size=len(prompts),
+                # stop strings and max_tokens become a per-sequence stopping criterion and max_new_tokens
+                **get_generation_kwargs(self.tokenizer, **generate_kwargs),
+            )
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+        for (_, future), output in zip(requests, outputs):
+            future.set_result(output[0]["generated_text"])
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(model_name, hf_model, max_batch_size=8, max_wait=0.05):
+    """
+    Shared batcher of the process for model_name.
+    """
+    with _batchers_lock:
+        if model_name not in _batchers:
+            _batchers[model_name] = HFBatcher(hf_model, max_batch_size, max_wait)
+        return _batchers[model_name]
@@ -0,0 +1,230 @@
+"""
+Shared-prefix KV cache for Hugging Face models.
+
+Every turn of an HF agent sends initial_prompt + slot prompt, and the global instructions at the start of
+the initial prompt are the same for all agents. The past key/values of each prompt are kept in a radix tree
+over token ids; a new prompt reuses (a cropped copy of) the cached key/values of its longest cached prefix,
+so only the new tokens are prefilled. This works across turns, agents and sessions sharing the model.
+The cache is bounded by a memory budget, least recently used entries are dropped first.
+"""
+import copy
+import threading
+import time
+
+
+def cache_nbytes(past_key_values):
+    """
+    Memory used by the key/value tensors of a transformers Cache.
+    """
+    if hasattr(past_key_values, "layers"):
+        tensors = [
+            tensor
+            for layer in past_key_values.layers
+            for tensor in (layer.keys, layer.values)
+            if tensor is not None
+        ]
+    else:
+        tensors = list(past_key_values.key_cache) + list(past_key_values.value_cache)
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class RadixNode:
+    def __init__(self, tokens=(), parent=None):
+        self.tokens = tokens  # edge label, token ids from the parent to this node
+        self.parent = parent
+        self.children = {}  # first token of the child's edge -> child
+        self.past_key_values = None  # cache of all tokens from the root to this node
+        self.nbytes = 0
+        self.last_access = 0.0
+
+
+class RadixKVCache:
+    """
+    Radix tree of token sequences to their past key/values.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.root = RadixNode()
+        self.nbytes = 0
+        self.hits = 0
+        self.reused_tokens = 0
+        self.total_tokens = 0
+
+    def match(self, tokens):
+        """
+        Longest cached prefix of tokens.
+        Returns (number of matched tokens, node whose key/values cover them) or (0, None).
+        """
+        node, matched = self.root, 0
+        while matched < len(tokens) and tokens[matched] in node.children:
+            child = node.children[tokens[matched]]
+            common = 0
+            while (
+                common < len(child.tokens)
+                and matched + common < len(tokens)
+                and child.tokens[common] == tokens[matched + common]
+            ):
+                common += 1
+            matched += common
+            node = child
+            if common < len(child.tokens):
+                break
+        if matched == 0:
+            return 0, None
+        holder = self.find_holder(node)
+        if holder is None:
+            return 0, None
+        return matched, holder
+
+    def find_holder(self, node):
+        """
+        Most recently used node with key/values in the subtree of node.
+        Any of them covers the whole path to node.
+        """
+        best, stack = None, [node]
+        while stack:
+            current = stack.pop()
+            if current.past_key_values is not None and (
+                best is None or current.last_access > best.last_access
+            ):
+                best = current
+            stack.extend(current.children.values())
+        return best
+
+    def insert(self, tokens, past_key_values):
+        node, idx = self.root, 0
+        while idx < len(tokens):
+            child = node.children.get(tokens[idx])
+            if child is None:
+                child = RadixNode(tuple(tokens[idx:]), node)
+                node.children[tokens[idx]] = child
+                node, idx = child, len(tokens)
+                break
+            common = 0
+            while (
+                common < len(child.tokens)
+                and idx + common < len(tokens)
+                and child.tokens[common] == tokens[idx + common]
+            ):
+                common += 1
+            if common < len(child.tokens):
+                child = self.split(child, common)
+            node, idx = child, idx + common
+        if node.past_key_values is not None:
+            self.nbytes -= node.nbytes
+        node.past_key_values = past_key_values
+        node.nbytes = cache_nbytes(past_key_values)
+        node.last_access = time.monotonic()
+        self.nbytes += node.nbytes
+        self.evict()
+
+    def split(self, node, length):
+        """
+        Split the edge of node after length tokens, returns the new middle node.
+        """
+        middle = RadixNode(node.tokens[:length], node.parent)
+        node.parent.children[node.tokens[0]] = middle
+        node.tokens = node.tokens[length:]
+        node.parent = middle
+        middle.children[node.tokens[0]] = node
+        return middle
+
+    def evict(self):
+        while self.nbytes > self.max_bytes:
+            nodes = [node for node in self.iter_nodes() if node.past_key_values is not None]
+            if not nodes:
+                break
+            self.remove(min(nodes, key=lambda node: node.last_access))
+
+    def iter_nodes(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.values())
+
+    def remove(self, node):
+        self.nbytes -= node.nbytes
+        node.past_key_values = None
+        node.nbytes = 0
+        # prune leaves that no longer hold any key/values
+        while node is not self.root and not node.children and node.past_key_values is None:
+            del node.parent.children[node.tokens[0]]
+            node = node.parent
+
+
+class HFPrefixCache:
+    """
+    Generation with prefix reuse for one HF model, shared by all agents using it.
+    Generations are serialized, since they run on the same model.
+    """
+
+    def __init__(self, hf_model, max_bytes, max_new_tokens=7000):
+        """
+        hf_model: (model, tokenizer, pipeline) tuple as returned by utils.setup_hf_model
+        """
+        self.model, self.tokenizer, _ = hf_model
+        self.max_new_tokens = max_new_tokens
+        self.tree = RadixKVCache(max_bytes)
+        self.lock = threading.Lock()
+
+    def generate(self, prompt, stop=None, max_tokens=None, **generate_kwargs):
+        import torch
+
+        from backends.hf import get_generation_kwargs
+
+        generate_kwargs = get_generation_kwargs(self.tokenizer, stop, max_tokens, **generate_kwargs)
+        generate_kwargs.setdefault("max_new_tokens", self.max_new_tokens)
+        inputs = self.tokenizer(prompt, return_tensors="pt", add_special_tokens=False)
+        input_ids = inputs["input_ids"].to(self.model.device)
+        tokens = input_ids[0].tolist()
+        with self.lock:
+            # at least one prompt token has to be prefilled to get the first logits
+            matched, holder = self.tree.match(tokens[:-1])
+            past_key_values = None
+            if holder is not None:
+                holder.last_access = time.monotonic()
+                past_key_values = copy.deepcopy(holder.past_key_values)
+                past_key_values.crop(matched)
+                self.tree.hits += 1
+                self.tree.reused_tokens += matched
+            self.tree.total_tokens += len(tokens)
+            with torch.no_grad():
+                output_ids = self.model.generate(
+                    input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    past_key_values=past_key_values,
+                    return_dict_in_generate=True,
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    **generate_kwargs,
+                )
+            # the cache now also holds the generated tokens, keep the prompt part only
+            past_key_values = output_ids.past_key_values
+            past_key_values.crop(len(tokens))
+            self.tree.insert(tokens, past_key_values)
+        return self.tokenizer.decode(
+            output_ids.sequences[0][len(tokens) :], skip_special_tokens=True
+        )
+
+    def stats(self):
+        return {
+            "hits": self.tree.hits,
+            "reused_tokens": self.tree.reused_tokens,
+            "prompt_tokens": self.tree.total_tokens,
+            "bytes": self.tree.nbytes,
+        }
+
+
+_prefix_caches = {}
+_prefix_caches_lock = threading.Lock()
+
+
+def get_prefix_cache(model_name, hf_model, max_bytes, max_new_tokens=7000):
+    """
+    Shared prefix cache of the process for model_name.
+    """
+    with _prefix_caches_lock:
+        if model_name not in _prefix_caches:
+            _prefix_caches[model_name] = HFPrefixCache(hf_model, max_bytes, max_new_tokens)
+        return _prefix_caches[model_name]
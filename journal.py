@@ -0,0 +1,160 @@
+"""
+Append-only journal of a session's history.
+
+Instead of re-serializing the whole history to JSON after every turn, each turn is appended as one
+fsynced JSONL record to journal_<history name>.jsonl by a background writer thread. The history*.json
+file is rewritten (atomically) only when the journal is compacted: every compact_every turns and at the
+end of the session, after which the journal is deleted. On restart, the history is rebuilt by replaying the
+journal if it covers more rounds than the history file (e.g., after a crash).
+"""
+import json
+import os
+import queue
+import threading
+
+
+def get_journal_file(history_file):
+    return os.path.join(
+        os.path.dirname(history_file),
+        "journal_" + os.path.basename(history_file).split(".json")[0] + ".jsonl",
+    )
+
+
+def snapshot(content):
+    """
+    Copy of the history content that later turns will not modify (rounds are never changed once appended).
+    """
+    return {
+        "slot_assignment": list(content.get("slot_assignment", [])),
+        "rounds": list(content.get("rounds", [])),
+        "plan": {agent: list(plans) for agent, plans in content.get("plan", {}).items()},
+        "finished_rounds": content.get("finished_rounds", 0),
+    }
+
+
+def write_file_atomic(log_dict, output_file):
+    # not history*.json*: readers of the session files never see an interrupted write
+    tmp_file = os.path.join(os.path.dirname(output_file), ".tmp_" + os.path.basename(output_file))
+    with open(tmp_file, "w") as outfile:
+        json.dump(log_dict, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp_file, output_file)
+
+
+class JournalWriter:
+    def __init__(self, path, history_file, compact_every=0):
+        """
+        path: journal file, history_file: the history*.json file compactions are written to
+        compact_every: compact every N turns (0: only when closing)
+        """
+        self.path = path
+        self.history_file = history_file
+        self.compact_every = compact_every
+        self.turns = 0
+        self.queue = queue.Queue()
+        self.error = None
+        self.truncate_torn_record()
+        self.file = open(path, "a")
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def truncate_torn_record(self):
+        """
+        Drop a partially written last record (crash during a write) before appending to the journal.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def run(self):
+        while True:
+            kind, item = self.queue.get()
+            try:
+                if kind == "record":
+                    self.file.write(json.dumps(item) + "\n")
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                elif kind == "compact":
+                    write_file_atomic(item, self.history_file)
+                elif kind == "close":
+                    self.file.close()
+                    return
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def append(self, record, content):
+        """
+        Queue one record; content is the history content after the record was applied.
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put(("record", record))
+        if record["type"] == "turn":
+            self.turns += 1
+            if self.compact_every and self.turns % self.compact_every == 0:
+                self.compact(content)
+
+    def compact(self, content):
+        self.queue.put(("compact", snapshot(content)))
+
+    def close(self, content):
+        """
+        Final compaction (if any turn was played), then wait for all pending writes.
+        Once the history file is complete, the journal is deleted.
+        """
+        if content:
+            self.compact(content)
+        self.queue.put(("close", None))
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
+        if content:
+            os.remove(self.path)
+
+
+def load_history(history_file, apply_turn):
+    """
+    (history content or None if the session never started, whether it comes from the journal).
+    The journal is only used if it covers more finished rounds than the history file: a journal left
+    behind (e.g., before a continuation without journal) never hides later progress.
+    """
+    content, from_journal = None, False
+    if os.path.exists(history_file):
+        with open(history_file, "r") as f:
+            content = json.load(f) or None
+    journal_file = get_journal_file(history_file)
+    if os.path.exists(journal_file):
+        journal_content = replay_journal(journal_file, apply_turn) or None
+        finished_rounds = content.get("finished_rounds", 0) if content else -1
+        if journal_content and journal_content.get("finished_rounds", 0) > finished_rounds:
+            content, from_journal = journal_content, True
+    return content, from_journal
+
+
+def replay_journal(path, apply_turn):
+    """
+    Rebuild the history content from the journal. apply_turn(content, **record) applies one turn.
+    A torn last line (crash during a write) is ignored.
+    """
+    content = {}
+    with open(path, "r") as f:
+        lines = f.readlines()
+    for i, line in enumerate(lines):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            if i == len(lines) - 1:
+                break
+            raise
+        record_type = record.pop("type")
+        if record_type == "snapshot":
+            content = record["content"]
+        elif record_type == "turn":
+            apply_turn(content, **record)
+    return content
@@ -0,0 +1,147 @@
+"""
+Persistent, content-addressed cache of LLM responses (SQLite).
+
+Entries are keyed by a hash of (provider, model, messages, temperature, generation params), so identical
+requests from re-runs, restarts or other experiments are served from disk. The database runs in WAL
+mode with one connection per thread, so concurrent sessions and processes can share one cache file.
+The total size of the cached responses is bounded; the least recently used entries are evicted first.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access);
+"""
+
+
+def make_key(provider, model, messages, temperature, **params):
+    """
+    Hash of everything that determines the response. messages is a list of chat messages or a prompt string.
+    """
+    request = {
+        "provider": provider,
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "params": params,
+    }
+    return hashlib.sha256(
+        json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stats_lock = threading.Lock()
+        self.local = threading.local()
+        self.connect().executescript(SCHEMA)
+
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        """
+        Cached response for key, or None.
+        """
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        with self.stats_lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        conn.execute(
+            "UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key)
+        )
+        return row[0]
+
+    def put(self, key, response):
+        conn = self.connect()
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now),
+            )
+            evicted = self.evict(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        with self.stats_lock:
+            self.evictions += evicted
+
+    def evict(self, conn):
+        """
+        Delete least recently used entries until the cache fits in max_bytes.
+        """
+        (total,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        evicted = 0
+        if total <= self.max_bytes:
+            return evicted
+        for key, size in conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        return evicted
+
+    def stats(self):
+        """
+        Hit/miss counters of this process and the current size of the cache.
+        """
+        entries, total = self.connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        with self.stats_lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": total,
+            }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(path, max_bytes=1024**3):
+    """
+    Shared ResponseCache of the process for path.
+    """
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = ResponseCache(path, max_bytes)
+        return _caches[path]
@@ -0,0 +1,124 @@
+"""
+Process-wide registry of LLM API clients.
+
+Agents, the moderator and the evaluation judges ask this module for their client instead of building one each.
+Clients are cached per (provider, endpoint, api key, api version), and all of them share one
+keep-alive HTTP connection pool, so a process running many sessions opens a handful of connections
+instead of one pool per agent.
+Retries are left to rate_limit.call_with_retry, so the clients themselves do not retry.
+openai and httpx are imported with the first client, so that importing this module stays cheap.
+"""
+import importlib.util
+import os
+import threading
+
+AZURE_API_VERSION = "2023-05-15"
+
+_pool_config = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30.0,
+    "http2": True,
+}
+_http_client = None
+_clients = {}
+_lock = threading.Lock()
+
+
+def configure_pool(
+    max_connections=None, max_keepalive_connections=None, keepalive_expiry=None, http2=None
+):
+    """
+    Set the limits of the shared connection pool. Must be called before the first client is created.
+    HTTP/2 is only used if the h2 package is installed.
+    """
+    with _lock:
+        if _http_client is not None:
+            raise RuntimeError("The connection pool is already in use, configure it first.")
+        for key, value in (
+            ("max_connections", max_connections),
+            ("max_keepalive_connections", max_keepalive_connections),
+            ("keepalive_expiry", keepalive_expiry),
+            ("http2", http2),
+        ):
+            if value is not None:
+                _pool_config[key] = value
+
+
+def _get_http_client():
+    global _http_client
+    if _http_client is None:
+        import httpx
+        from openai import DefaultHttpxClient
+
+        http2 = _pool_config["http2"] and importlib.util.find_spec("h2") is not None
+        _http_client = DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=_pool_config["max_connections"],
+                max_keepalive_connections=_pool_config["max_keepalive_connections"],
+                keepalive_expiry=_pool_config["keepalive_expiry"],
+            ),
+            http2=http2,
+        )
+    return _http_client
+
+
+def get_openai_client(api_key=None, base_url=None):
+    """
+    Shared OpenAI client. api_key defaults to OPENAI_API_KEY.
+    """
+    from openai import OpenAI
+
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    key = ("openai", base_url, api_key, None)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=_get_http_client(),
+                max_retries=0,
+            )
+        return _clients[key]
+
+
+def get_azure_client(azure_endpoint=None, api_key=None, api_version=AZURE_API_VERSION):
+    """
+    Shared Azure OpenAI client. Endpoint and key default to AZURE_OPENAI_ENDPOINT and AZURE_OPENAI_API_KEY.
+    """
+    from openai import AzureOpenAI
+
+    azure_endpoint = azure_endpoint or os.getenv("AZURE_OPENAI_ENDPOINT")
+    api_key = api_key or os.getenv("AZURE_OPENAI_API_KEY")
+    key = ("azure", azure_endpoint, api_key, api_version)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = AzureOpenAI(
+                azure_endpoint=azure_endpoint,
+                api_key=api_key,
+                api_version=api_version,
+                http_client=_get_http_client(),
+                max_retries=0,
+            )
+        return _clients[key]
+
+
+def get_client(azure=False):
+    """
+    Client for GPT models, via Azure APIs if azure else via OpenAI APIs.
+    """
+    if azure:
+        return get_azure_client()
+    return get_openai_client()
+
+
+def close_all():
+    """
+    Close the shared connection pool and forget all clients.
+    """
+    global _http_client
+    with _lock:
+        if _http_client is not None:
+            _http_client.close()
+        _http_client = None
+        _clients.clear()
@@ -1,15 +1,11 @@
 import argparse
-import os
-import shutil
-
-from agent import Agent
-from initial_prompts import InitialPrompt
-from mystuff.moderator_agent import Moderator
-from mystuff.moderator_initial_prompt import ModeratorInitialPrompt
-from mystuff.moderator_round_prompts import ModeratorRoundPrompts
-from rounds import RoundPrompts
-from save_utils import create_outfiles, save_conversation
-from utils import load_setup, randomize_agents_order, set_constants, setup_hf_model
+import asyncio
+import json
+
+from llm_clients import configure_pool
+from rate_limit import set_default_limits, set_limits
+from session import expand_sessions, run_sessions
+from utils import set_constants
 
 parser = argparse.ArgumentParser(description="big negotiation!!")
 
@@ -25,15 +21,41 @@ parser.add_argument("--agents_num", type=int, default=6)
 parser.add_argument("--issues_num", type=int, default=5)
 parser.add_argument("--rounds_num", type=int, default=24)
 parser.add_argument("--window_size", type=int, default=6)
+# if set, the history window is the most recent turns (and last plan) that fit in this many tokens instead of --window_size turns
+parser.add_argument("--history_token_budget", type=int, default=0)
+# output token budgets of turns (0: no limit); turns also stop after their last expected tag (</PLAN> or </ANSWER>)
+# output token budgets of turns, 0 for no limit (the default)
+parser.add_argument("--max_tokens", type=int, default=0)
+parser.add_argument("--first_round_max_tokens", type=int, default=0)
+# stream responses and start the next agent as soon as the current public answer is complete
+parser.add_argument("--pipeline_turns", action="store_true")
+# cache_friendly puts the static instructions before the history in round prompts (provider prompt caching)
+parser.add_argument(
+    "--prompt_layout", type=str, default="default", choices=["default", "cache_friendly"]
+)
 
 
 parser.add_argument("--output_dir", type=str, default="./output/")
 parser.add_argument("--game_dir", type=str, default="./games_descriptions/base")
 parser.add_argument("--exp_name", type=str, default="all_greedy")
 
+# agents' config file in game_dir, and a model replacing all agents' models (e.g., to compare models on a game)
+parser.add_argument("--config_file", type=str, default="config.txt")
+parser.add_argument("--model_override", type=str, default="")
+
 # if restart, specifiy output_file to continue on
 parser.add_argument("--restart", action="store_true")
 parser.add_argument("--output_file", type=str, default="history.json")
+# use output_file as is, without the start time suffix (deterministic names, e.g. for sweeps)
+parser.add_argument("--no_timestamp", action="store_true")
+
+# turns are appended to a journal, the history file is only rewritten when the journal is compacted
+parser.add_argument(
+    "--no_journal", action="store_true", help="rewrite the history file after every turn instead"
+)
+parser.add_argument(
+    "--compact_every", type=int, default=0, help="also compact the journal every N turns (0: at the end only)"
+)
 
 # if any gemini model, set this true
 parser.add_argument("--gemini", action="store_true")
@@ -43,6 +65,20 @@ parser.add_argument("--gemini_model", type=str, default="gemini-1.0-pro-001")
 
 # if any open-source model, set this true
 parser.add_argument("--hf_home", type=str, default="/disk1/")
+# batch the generations of concurrent agents/sessions that use the same HF model
+parser.add_argument(
+    "--hf_batch_size", type=int, default=1, help="max prompts per batch, 1 disables batching"
+)
+parser.add_argument(
+    "--hf_batch_wait", type=float, default=0.05, help="max seconds to wait for a batch to fill"
+)
+# reuse the key/values of shared prompt prefixes (e.g., global instructions) across turns, agents and sessions
+parser.add_argument(
+    "--hf_prefix_cache_mb",
+    type=float,
+    default=0,
+    help="memory budget of the HF prefix KV cache, 0 disables it (takes precedence over batching)",
+)
 
 # for GPTs and using Azure APIs, set this true
 parser.add_argument("--azure", action="store_true")
@@ -54,157 +90,90 @@ parser.add_argument(
     "--api_key", type=str, default="", help="OpenAI key, set if using OpenAI APIs"
 )
 
+# shared HTTP connection pool of the API clients
+parser.add_argument("--max_connections", type=int, default=100)
+parser.add_argument("--max_keepalive_connections", type=int, default=20)
+parser.add_argument(
+    "--no_http2", action="store_true", help="disable HTTP/2 for API clients"
+)
 
-args = parser.parse_args()
-
-OUTPUT_DIR = os.path.join(args.game_dir, args.output_dir, args.exp_name)
+# shared rate limits per model/deployment, unlimited by default
+parser.add_argument("--rpm", type=int, default=None, help="requests per minute per model")
+parser.add_argument("--tpm", type=int, default=None, help="tokens per minute per model")
+parser.add_argument(
+    "--rate_limits_file",
+    type=str,
+    default="",
+    help='JSON dict of model to limits, e.g. {"gpt-4": {"rpm": 500, "tpm": 80000}}',
+)
 
+# opt-in on-disk cache of deterministic (temperature 0) responses, shareable between runs
+parser.add_argument("--cache_path", type=str, default="", help="SQLite file of the response cache")
+parser.add_argument("--cache_max_mb", type=float, default=1024)
 
-# SET AZURE, OpenAI and GEMINI APIs env variables
-set_constants(args)
+# record every model call of a session, or replay a recorded session (or a history file) offline
+parser.add_argument("--cassette_mode", type=str, default="", choices=["", "record", "replay"])
+parser.add_argument(
+    "--cassette_path",
+    type=str,
+    default="",
+    help="cassette to replay (cassette_*.jsonl or history*.json); when recording, defaults to next to the history file; with several sessions, suffixed with the session id",
+)
 
-# Create output file, or load files if restart is given to continue on last experiments
-agent_round_assignment, start_round_idx, history = create_outfiles(args, OUTPUT_DIR)
+# per-call latency/token/cost spans are written next to the history file (see telemetry.py report)
+parser.add_argument("--no_telemetry", action="store_true")
 
-# Dump config file and scores in OUTPUT_DIR
-shutil.copyfile(
-    os.path.join(args.game_dir, "config.txt"), os.path.join(OUTPUT_DIR, "config.txt")
+# run several independent sessions concurrently in this process
+parser.add_argument(
+    "--num_sessions",
+    type=int,
+    default=1,
+    help="number of sessions to run per session configuration",
 )
-shutil.copytree(
-    os.path.join(args.game_dir, "scores_files"),
-    os.path.join(OUTPUT_DIR, "scores_files"),
-    dirs_exist_ok=True,
+parser.add_argument(
+    "--max_concurrency",
+    type=int,
+    default=4,
+    help="max number of sessions running at the same time",
+)
+parser.add_argument(
+    "--sessions_file",
+    type=str,
+    default="",
+    help="JSON list of dicts overriding arguments per session configuration (e.g. game_dir, exp_name)",
 )
 
-# Load setups of agents from config file. File should contain names, file names, roles, incentives, and models
-# Also load initial deal file and return a dict of role to agent names
-agents, initial_deal, role_to_agent_names = load_setup(args.game_dir, args.agents_num)
-
-# Load HF models
-hf_models = {}
-
-
-# Instaniate agents (initial prompt, round prompt, agent class)
-for name, agent in agents.items():
-    if "hf" in agent["model"] and not agent["model"] in hf_models:
-        hf_models[agent["model"]] = setup_hf_model(
-            agent["model"].split("hf_")[-1], cache_dir=args.hf_home
-        )
-
-    inital_prompt_agent = InitialPrompt(
-        args.game_dir,
-        name,
-        agent["file_name"],
-        role_to_agent_names["p1"],
-        role_to_agent_names["p2"],
-        num_issues=args.issues_num,
-        num_agents=args.agents_num,
-        incentive=agent["incentive"],
-    )
-
-    round_prompt_agent = RoundPrompts(
-        name,
-        role_to_agent_names["p1"],
-        initial_deal,
-        incentive=agent["incentive"],
-        window_size=args.window_size,
-        target_agent=role_to_agent_names.get("target", ""),
-        rounds_num=args.rounds_num,
-        agents_num=args.agents_num,
-    )
 
-    agent_instance = Agent(
-        inital_prompt_agent,
-        round_prompt_agent,
-        name,
-        args.temp,
-        model=agent["model"],
-        azure=args.azure,
-        hf_models=hf_models,
-    )
-    agent["instance"] = agent_instance
-
-# Initialize moderator agent
-if args.moderator:
-    initial_prompt_moderator = ModeratorInitialPrompt(
-        None,
-        None,
-        None,
-        role_to_agent_names["p1"],
-        role_to_agent_names["p2"],
-        args.issues_num,
-        args.agents_num,
-        incentive="cooperative",
-    )
-    round_prompt_moderator = ModeratorRoundPrompts(
-        None,
-        role_to_agent_names["p1"],
-        initial_deal,
-        "cooperative",
-        window_size=args.window_size,
-        rounds_num=args.rounds_num,
-        agents_num=args.agents_num,
-    )
-    moderator_agent = Moderator(
-        initial_prompt_moderator,
-        round_prompt_moderator,
-        "Moderator",
-        args.temp,
-        "gpt-4o-mini",
+def configure(args):
+    """
+    Process-wide setup shared by all sessions: API keys, connection pool and rate limits.
+    """
+    # SET AZURE, OpenAI and GEMINI APIs env variables
+    set_constants(args)
+    configure_pool(
+        max_connections=args.max_connections,
+        max_keepalive_connections=args.max_keepalive_connections,
+        http2=not args.no_http2,
     )
+    set_default_limits(rpm=args.rpm, tpm=args.tpm)
+    if args.rate_limits_file:
+        with open(args.rate_limits_file, "r") as f:
+            for model, limits in json.load(f).items():
+                set_limits(model, rpm=limits.get("rpm"), tpm=limits.get("tpm"))
 
-# If not restart, agent_round_assignment is empty, then randomize order
-if not args.restart:
-    agent_round_assignment = randomize_agents_order(
-        agents, role_to_agent_names["p1"], args.rounds_num
-    )
 
-for round_idx in range(start_round_idx, args.rounds_num):
-    if round_idx == 0:
-        # For first round, initialize with p1 suggesting the first deal from 'initial_deal.txt' file
-        current_agent = role_to_agent_names["p1"]
-        slot_prompt, agent_response = agents[current_agent]["instance"].execute_round(
-            history["content"], round_idx
-        )
-        history = save_conversation(
-            history,
-            current_agent,
-            agent_response,
-            slot_prompt,
-            round_assign=agent_round_assignment,
-            initial=True,
-        )
-        print("=====")
-        print(f"{current_agent} response: {agent_response}")
-
-    # Continue with rounds
-    # Get next agent
-    if args.moderator:
-        slot_prompt, agent_response = moderator_agent.execute_round(
-            history["content"], round_idx
-        )
-        # TODO: For now we don't save the moderator's response in the history.
-        # history = save_conversation(history, "Moderator", agent_response, slot_prompt, agent_round_assignment)
-        current_agent = moderator_agent.get_next_speaker(agent_response)
-        print("*****")
-        print(f"Moderator: {agent_response}")
-    else:
-        current_agent = agent_round_assignment[round_idx]
-    # Query next agent
-    slot_prompt, agent_response = agents[current_agent]["instance"].execute_round(
-        history["content"], round_idx
-    )
-    history = save_conversation(history, current_agent, agent_response, slot_prompt)
-    print("=====")
-    print(f"{current_agent} response: {agent_response}")
+if __name__ == "__main__":
+    args = parser.parse_args()
+    configure(args)
 
+    session_overrides = None
+    if args.sessions_file:
+        with open(args.sessions_file, "r") as f:
+            session_overrides = json.load(f)
 
-# Final deal by P1
-print(" ==== Deal Suggestions ==== ")
-current_agent = role_to_agent_names["p1"]
-slot_prompt, agent_response = agents[current_agent]["instance"].execute_round(
-    history["content"], args.rounds_num
-)
-history = save_conversation(history, current_agent, agent_response, slot_prompt)
-print("=====")
-print(f"{current_agent} response: {agent_response}")
+    sessions_args = expand_sessions(args, session_overrides, args.num_sessions)
+    results = asyncio.run(
+        run_sessions(sessions_args, max_concurrency=args.max_concurrency)
+    )
+    if any(isinstance(result, BaseException) for result in results):
+        raise SystemExit(1)
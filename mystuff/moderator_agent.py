@@ -2,11 +2,14 @@
 Moderator class for managing who talks next.
 """
 import re
+import time
 
-from openai import OpenAI
-
+from backends import close_stopped_tags, get_backend, parse_model
+from llm_cache import make_key
 from mystuff.moderator_initial_prompt import ModeratorInitialPrompt
 from mystuff.moderator_round_prompts import ModeratorRoundPrompts
+from prompt_utils import count_tokens
+from telemetry import phase
 
 
 class Moderator:
@@ -24,6 +27,9 @@ class Moderator:
         model: str,
         rounds_num=24,
         agents_num=6,
+        cache=None,
+        cassette=None,
+        telemetry=None,
     ):
         self.model = model
 
@@ -37,26 +43,77 @@ class Moderator:
         self.round_prompt_cls = round_prompt_cls
         self.messages = [{"role": "user", "content": self.initial_prompt}]
 
-        self.client = OpenAI()
+        self.cache = cache
+        self.cassette = cassette
+        self.telemetry = telemetry
+        self.round_idx = None
+        self.prompt_tokens = None
+        self.generation_params = {}
+        self.provider, self.model_name = parse_model(model)
+        self.backend = None
+        if cassette is None or cassette.mode != "replay":
+            self.backend = get_backend(model)
 
     def execute_round(self, answer_history: dict, round_idx: int) -> tuple[str, str]:
         """
         Runs a round of the moderator agent using the stored slot prompt and history.
         Then passes the parsed prompt into the agent.
         """
-        slot_prompt = self.round_prompt_cls.build_slot_prompt(answer_history, round_idx)
+        with phase(self.telemetry, "build_slot_prompt", agent=self.agent_name, round=round_idx):
+            slot_prompt = self.round_prompt_cls.build_slot_prompt(answer_history, round_idx)
+        self.prompt_tokens = count_tokens(self.initial_prompt + slot_prompt)
+        self.generation_params = self.round_prompt_cls.get_generation_params(round_idx)
+        self.round_idx = round_idx
         agent_response = self.prompt("user", slot_prompt)
         return slot_prompt, agent_response
 
     def prompt(self, role: str, msg: str):
         """
         Prompts the agent with the message and returns the response.
+        Deterministic (temperature 0) calls go through the response cache if there is one.
         """
+        if self.cassette is not None and self.cassette.mode == "replay":
+            return self.cassette.replay(self.agent_name, msg)
         messages = self.messages + [{"role": role, "content": msg}]
-        response = self.client.chat.completions.create(
-            model=self.model, messages=messages, temperature=self.temperature
+        turn = self.cassette.reserve_turn() if self.cassette is not None else None
+        stats = {
+            "prompt_layout": self.round_prompt_cls.prompt_layout,
+            "local_prompt_tokens": self.prompt_tokens,
+            "cache_hit": False,
+        }
+        start = time.perf_counter()
+        use_cache = self.cache is not None and self.temperature == 0
+        if use_cache:
+            key = make_key(
+                self.provider,
+                self.model,
+                self.backend.cache_messages(messages),
+                self.temperature,
+                **self.generation_params,
+            )
+            content = self.cache.get(key)
+            if content is not None:
+                stats["cache_hit"] = True
+                stats["latency"] = time.perf_counter() - start
+                return self.record(msg, content, stats, turn)
+        content = self.backend.generate(
+            messages, self.temperature, stats, **self.generation_params
         )
-        return response.choices[0].message.content
+        content = close_stopped_tags(content, self.generation_params.get("stop"))
+        stats["latency"] = time.perf_counter() - start
+        if use_cache:
+            self.cache.put(key, content)
+        return self.record(msg, content, stats, turn)
+
+    def record(self, msg: str, content: str, stats: dict, turn: int = None) -> str:
+        """
+        Saves the call's telemetry and the turn in the cassette if recording, returns the content.
+        """
+        if self.telemetry is not None:
+            self.telemetry.record_call(self.agent_name, self.model_name, self.round_idx, stats)
+        if self.cassette is not None:
+            self.cassette.record(self.agent_name, msg, content, turn)
+        return content
 
     def get_next_speaker(self, agent_response: str) -> str:
         """
@@ -19,6 +19,9 @@ class ModeratorRoundPrompts:
         target_agent: str = "",
         rounds_num: int = 24,
         agents_num: int = 6,
+        prompt_layout: str = "default",
+        history_token_budget: int = 0,
+        max_tokens: int = 0,
     ):
         self.agent_name = agent_name
         self.p1_name = p1_name
@@ -29,6 +32,9 @@ class ModeratorRoundPrompts:
         self.target_agent = target_agent
         self.rounds_num = rounds_num
         self.agents_num = agents_num
+        self.prompt_layout = prompt_layout
+        self.history_token_budget = history_token_budget
+        self.max_tokens = max_tokens
 
     def build_slot_prompt(self, history: dict, round_idx: int, other_args={}) -> str:
         """
@@ -67,18 +73,38 @@ class ModeratorRoundPrompts:
         )
 
         # collate
-        slot_prompt = history_prompt + scratch_pad + unified_instructions + plan_prompt
+        if self.prompt_layout == "cache_friendly":
+            # static instructions first, so that providers' prompt caching can reuse them;
+            # the history and plan instructions that change every round come last
+            slot_prompt = scratch_pad + unified_instructions + history_prompt + plan_prompt
+        else:
+            slot_prompt = history_prompt + scratch_pad + unified_instructions + plan_prompt
 
         return slot_prompt
 
+    def get_generation_params(self, round_idx: int) -> dict:
+        """
+        Stop sequences and output token budget of the moderator's turn.
+        The position of <PARTY> is not fixed, so only rounds with a plan stop (after </PLAN>).
+        """
+        final_round = (self.rounds_num - round_idx) <= self.agents_num
+        final_vote = round_idx == self.rounds_num
+        stop = []
+        if self.get_plan_prompt(self.agent_name == self.p1_name, final_round, final_vote):
+            stop = ["</PLAN>"]
+        return {"stop": stop, "max_tokens": self.max_tokens}
+
     def get_history_input(self, history: dict, final_round: bool = False, final_vote: bool = False) -> str:
         """
         Creates the history prompt using the history data.
         """
         personalized_history, last_plan = format_history(
-            self.agent_name, history, self.window_size
+            self.agent_name, history, self.window_size, self.history_token_budget
         )
-        slot_prompt = f"The following is a chronological history of up to {self.window_size} interactions <HISTORY> {personalized_history} </HISTORY> "
+        if self.history_token_budget:
+            slot_prompt = f"The following is a chronological history of the most recent interactions <HISTORY> {personalized_history} </HISTORY> "
+        else:
+            slot_prompt = f"The following is a chronological history of up to {self.window_size} interactions <HISTORY> {personalized_history} </HISTORY> "
 
         if last_plan:
             slot_prompt += f"The following are your previous plans from last interactions. You should follow them while also adjusting them according to new observations. <PREV_PLAN> {last_plan} </PREV_PLAN> "
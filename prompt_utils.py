@@ -1,19 +1,51 @@
-def format_history(agent_name, history, window=6):
+_encoding = None
+
+
+def count_tokens(text, tokenizer=None):
+    """
+    Number of tokens of text with a local tokenizer: the model's own (Hugging Face) tokenizer if given,
+    otherwise tiktoken's o200k_base encoding if it can be loaded, otherwise an estimate of 4 characters per token.
+    """
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # not installed, or the encoding file cannot be downloaded (offline)
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def format_history(agent_name, history, window=6, token_budget=0, tokenizer=None):
     # each round is: [agent_name, answer]
     # personalized_history replaces agent_name by the current's agent name
+    # with a token_budget, the window is the most recent rounds that fit in the budget together with the last plan
+    # (counted with tokenizer, the agent's model's tokenizer if it is a local model)
     last_plan = ""
+    if agent_name in history["plan"]:  # take the last plan if it exists
+        last_plan = history["plan"][agent_name][-1]
+
     personalized_history = []
-    for slot in history["rounds"][-window:]:
+    rounds = history["rounds"] if token_budget else history["rounds"][-window:]
+    budget = token_budget - count_tokens(last_plan, tokenizer) if last_plan else token_budget
+    for slot in reversed(rounds):
         slot_str = ""
         if agent_name == slot["agent"]:
             slot_str = f". You ({slot['agent']}): {slot['public_answer']}"
         else:
             slot_str = f". {slot['agent']}: {slot['public_answer']}"
+        if token_budget:
+            budget -= count_tokens(slot_str, tokenizer)
+            if budget < 0:
+                break
         personalized_history.append(slot_str)
-    personalized_history_string = " \n ".join(personalized_history)
-
-    if agent_name in history["plan"]:  # take the last plan if it exists
-        last_plan = history["plan"][agent_name][-1]
+    personalized_history_string = " \n ".join(reversed(personalized_history))
     return personalized_history_string, last_plan
 
 
@@ -0,0 +1,352 @@
+"""
+Shared rate limiting and retries for all LLM API calls.
+
+Each model (or Azure deployment) gets one limiter with a requests-per-minute and a tokens-per-minute
+token bucket, shared by every agent, moderator and judge of the process. Failed calls (429, timeouts,
+5xx) are retried with jittered exponential backoff; a 429 also pauses the whole limiter for the
+Retry-After time the provider asked for, so concurrent callers do not stampede the API.
+
+Asyncio callers (e.g. the leakage judge) can also adapt their concurrency with an AIMDController: the number
+of requests in flight grows while requests succeed and is cut on 429s or rising latency, while the limiter's
+pause remains the one backoff clock shared by all callers.
+"""
+import asyncio
+import random
+import threading
+import time
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {
+    "APIConnectionError",
+    "APITimeoutError",
+    "RateLimitError",
+    "InternalServerError",
+    "ResourceExhausted",
+    "ServiceUnavailable",
+    "DeadlineExceeded",
+    "TooManyRequests",
+}
+
+
+class TokenBucket:
+    """
+    Bucket refilled continuously at capacity_per_minute / 60 per second.
+    Reservations may take the bucket below zero; the caller then waits until the debt is refilled,
+    which serves waiting callers in order.
+    """
+
+    def __init__(self, capacity_per_minute):
+        self.capacity = float(capacity_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def reserve(self, amount, now):
+        """
+        Take amount tokens and return the number of seconds to wait before using them.
+        """
+        self.refill(now)
+        self.tokens -= min(amount, self.capacity)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def adjust(self, delta):
+        """
+        Give back (delta > 0) or take more (delta < 0) tokens once the real usage is known.
+        """
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+
+class ModelLimiter:
+    """
+    Requests and tokens per minute limits of one model/deployment. None means unlimited.
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens=0):
+        """
+        Reserve one request and tokens; returns the seconds to wait before sending it.
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = self.blocked_until - now
+            if self.requests:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens and tokens:
+                wait = max(wait, self.tokens.reserve(tokens, now))
+        return max(wait, 0.0)
+
+    def acquire(self, tokens=0):
+        """
+        Block until a request of tokens can be sent. Returns the time waited.
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def record_usage(self, estimated_tokens, used_tokens):
+        if self.tokens and used_tokens:
+            with self.lock:
+                self.tokens.adjust(estimated_tokens - used_tokens)
+
+    def pause(self, seconds):
+        """
+        Stop all callers of this limiter for seconds (e.g. after a 429).
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+_default_limits = {"rpm": None, "tpm": None}
+_model_limits = {}
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def set_default_limits(rpm=None, tpm=None):
+    """
+    Limits used for every model without limits of its own.
+    """
+    _default_limits["rpm"] = rpm
+    _default_limits["tpm"] = tpm
+
+
+def set_limits(model, rpm=None, tpm=None):
+    """
+    Limits of one model/deployment.
+    """
+    _model_limits[model] = {"rpm": rpm, "tpm": tpm}
+    with _limiters_lock:
+        _limiters.pop(model, None)
+
+
+def get_limiter(model):
+    with _limiters_lock:
+        if model not in _limiters:
+            limits = _model_limits.get(model, _default_limits)
+            _limiters[model] = ModelLimiter(limits["rpm"], limits["tpm"])
+        return _limiters[model]
+
+
+def estimate_tokens(text):
+    """
+    Rough token count (~4 characters per token), used to reserve tokens before the call.
+    """
+    return len(text) // 4 + 1
+
+
+def get_used_tokens(response):
+    """
+    Total tokens of an OpenAI chat completion response.
+    """
+    usage = getattr(response, "usage", None)
+    return usage.total_tokens if usage else 0
+
+
+def get_status_code(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(error, "code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(error):
+    return (
+        get_status_code(error) in RETRYABLE_STATUS
+        or type(error).__name__ in RETRYABLE_ERRORS
+    )
+
+
+def get_retry_after(error):
+    """
+    Seconds the provider asked us to wait (Retry-After / retry-after-ms headers), or None.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        # Retry-After can also be an HTTP date, fall back to our own backoff
+        return None
+    return None
+
+
+def is_rate_limit(error):
+    return get_status_code(error) == 429 or type(error).__name__ in (
+        "RateLimitError",
+        "ResourceExhausted",
+        "TooManyRequests",
+    )
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=60.0):
+    """
+    Full-jitter exponential backoff.
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+def call_with_retry(
+    fn,
+    model,
+    estimated_tokens=0,
+    max_retries=8,
+    base_delay=1.0,
+    max_delay=60.0,
+    get_used_tokens=None,
+    on_retry=None,
+    stats=None,
+):
+    """
+    Call fn() under the limiter of model, retrying retryable errors.
+
+    estimated_tokens: tokens reserved in the tokens-per-minute bucket before the call
+    get_used_tokens: optional function of fn's result returning the real token usage
+    on_retry: optional function(attempt, delay, error) called before sleeping
+    stats: optional dict, filled with the time waited for the limiter ("queue_wait") and the number of "retries"
+    """
+    limiter = get_limiter(model)
+    if stats is None:
+        stats = {}
+    stats.setdefault("queue_wait", 0.0)
+    attempt = 0
+    while True:
+        stats["queue_wait"] += limiter.acquire(estimated_tokens)
+        stats["retries"] = attempt
+        try:
+            result = fn()
+        except Exception as e:
+            if not is_retryable(e) or attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            if is_rate_limit(e):
+                limiter.pause(delay)
+            if on_retry:
+                on_retry(attempt, delay, e)
+            time.sleep(delay)
+            attempt += 1
+            continue
+        if get_used_tokens:
+            limiter.record_usage(estimated_tokens, get_used_tokens(result))
+        return result
+
+
+class AIMDController:
+    """
+    Adaptive concurrency limit of asyncio callers: additive increase, multiplicative decrease.
+
+    The limit doubles every round trip until the first congestion (slow start), then grows by one request per
+    round trip of successes. A 429 or a smoothed latency above latency_tolerance times the lowest latency seen
+    multiplies it by decrease, at most once per round trip (requests started before the last decrease do not
+    count).
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=64, decrease=0.5, latency_tolerance=2.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.slow_start_limit = float(maximum)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.min_latency = None
+        self.latency = None
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        """
+        Wait for a free slot. Returns the start time to pass to release.
+        """
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started, latency=None, rate_limited=False):
+        """
+        Free the slot of a request started at started, which succeeded in latency seconds or failed.
+        """
+        async with self.condition:
+            self.in_flight -= 1
+            congested = rate_limited
+            if latency is not None:
+                self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                congested = congested or self.latency > self.latency_tolerance * self.min_latency
+            if congested and started >= self.last_decrease:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.slow_start_limit = self.limit
+                self.last_decrease = time.monotonic()
+                # later latencies are compared with the recent ones, not with the congested ones
+                self.latency = None
+            elif latency is not None and not congested:
+                step = 1.0 if self.limit < self.slow_start_limit else 1.0 / self.limit
+                self.limit = min(self.maximum, self.limit + step)
+            self.condition.notify_all()
+
+
+async def call_with_retry_async(
+    fn,
+    model,
+    controller,
+    estimated_tokens=0,
+    max_retries=8,
+    base_delay=1.0,
+    max_delay=60.0,
+    on_retry=None,
+):
+    """
+    call_with_retry for asyncio callers: fn() runs in a worker thread once controller has a free slot.
+    A 429 pauses the model's limiter (the shared backoff clock) and cuts the controller's limit, instead of
+    each caller sleeping on its own.
+    """
+    limiter = get_limiter(model)
+    attempt = 0
+    while True:
+        started = await controller.acquire()
+        wait = limiter.reserve(estimated_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        sent = time.monotonic()
+        try:
+            result = await asyncio.to_thread(fn)
+        except Exception as e:
+            rate_limited = is_rate_limit(e)
+            await controller.release(started, rate_limited=rate_limited)
+            if not is_retryable(e) or attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            if on_retry:
+                on_retry(attempt, delay, e)
+            if rate_limited:
+                # the next reservation waits for the pause, like every other caller
+                limiter.pause(delay)
+            else:
+                await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        await controller.release(started, latency=time.monotonic() - sent)
+        return result
@@ -13,6 +13,11 @@ class RoundPrompts:
         target_agent="",
         rounds_num=24,
         agents_num=6,
+        prompt_layout="default",
+        history_token_budget=0,
+        max_tokens=0,
+        first_round_max_tokens=0,
+        tokenizer=None,
     ):
         self.agent_name = agent_name
         self.p1_name = p1_name
@@ -23,6 +28,12 @@ class RoundPrompts:
         self.target_agent = target_agent
         self.rounds_num = rounds_num
         self.agents_num = agents_num
+        self.prompt_layout = prompt_layout
+        self.history_token_budget = history_token_budget
+        self.max_tokens = max_tokens
+        self.first_round_max_tokens = first_round_max_tokens
+        # Hugging Face tokenizer of the agent's model, to count the history's tokens (None for API models)
+        self.tokenizer = tokenizer
 
     def build_slot_prompt(self, history, round_idx, other_args={}):
         first = round_idx == 0  # first round
@@ -62,7 +73,12 @@ class RoundPrompts:
         )
 
         # collate
-        slot_prompt = history_prompt + scratch_pad + unified_instructions + plan_prompt
+        if self.prompt_layout == "cache_friendly":
+            # static instructions first, so that providers' prompt caching can reuse them;
+            # the history and plan instructions that change every round come last
+            slot_prompt = scratch_pad + unified_instructions + history_prompt + plan_prompt
+        else:
+            slot_prompt = history_prompt + scratch_pad + unified_instructions + plan_prompt
 
         # if self.incentive == 'targeted_adv':
         #     print('======')
@@ -71,12 +87,33 @@ class RoundPrompts:
 
         return slot_prompt
 
+    def get_generation_params(self, round_idx):
+        """
+        Stop sequences and output token budget of the agent's turn, by round type:
+            - first round (P1's initial deal): a short answer without tags, only a small token budget
+            - rounds with a plan: stop after </PLAN>
+            - final rounds and the final vote without a plan: stop after </ANSWER>
+        """
+        first = round_idx == 0
+        final_round = (self.rounds_num - round_idx) <= self.agents_num
+        final_vote = round_idx == self.rounds_num
+        if first and self.p1_name == self.agent_name:
+            return {"stop": [], "max_tokens": self.first_round_max_tokens}
+        if self.get_plan_prompt(self.agent_name == self.p1_name, final_round, final_vote):
+            stop = ["</PLAN>"]
+        else:
+            stop = ["</ANSWER>"]
+        return {"stop": stop, "max_tokens": self.max_tokens}
+
     def get_history_input(self, history, final_round=False, final_vote=False):
 
         personalized_history, last_plan = format_history(
-            self.agent_name, history, self.window_size
+            self.agent_name, history, self.window_size, self.history_token_budget, self.tokenizer
         )
-        slot_prompt = f"The following is a chronological history of up to {self.window_size} interactions <HISTORY> {personalized_history} </HISTORY> "
+        if self.history_token_budget:
+            slot_prompt = f"The following is a chronological history of the most recent interactions <HISTORY> {personalized_history} </HISTORY> "
+        else:
+            slot_prompt = f"The following is a chronological history of up to {self.window_size} interactions <HISTORY> {personalized_history} </HISTORY> "
 
         if last_plan:
             slot_prompt += f"The following are your previous plans from last interactions. You should follow them while also adjusting them according to new observations. <PREV_PLAN> {last_plan} </PREV_PLAN> "
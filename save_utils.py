@@ -2,6 +2,9 @@ import json
 import os
 import time
 
+from journal import JournalWriter, get_journal_file, load_history, snapshot
+from telemetry import phase
+
 
 def process_answer(full_answer):
     public_answer = extract_answer(full_answer)
@@ -9,38 +12,106 @@ def process_answer(full_answer):
     return public_answer, plan
 
 
-def save_conversation(
-    history, agent_name, full_answer, prompt, round_assign=[], initial=False
+def apply_turn(
+    content,
+    agent,
+    prompt,
+    full_answer,
+    public_answer,
+    plan,
+    initial=False,
+    slot_assignment=None,
+    prompt_tokens=None,
 ):
+    """
+    Add one turn to the history content (also used to replay journals).
+    """
     if initial:
-        history["content"]["slot_assignment"] = round_assign
-        history["content"]["rounds"] = []
-        history["content"]["plan"] = {}
-        history["content"]["finished_rounds"] = 0
+        content["slot_assignment"] = slot_assignment
+        content["rounds"] = []
+        content["plan"] = {}
+        content["finished_rounds"] = 0
     else:
-        history["content"]["finished_rounds"] += 1
-
-    public_answer, plan = process_answer(full_answer)
+        content["finished_rounds"] += 1
 
-    history["content"]["rounds"].append(
+    content["rounds"].append(
         {
-            "agent": agent_name,
+            "agent": agent,
             "prompt": prompt,
             "full_answer": full_answer,
             "public_answer": public_answer,
         }
     )
+    if prompt_tokens is not None:
+        content["rounds"][-1]["prompt_tokens"] = prompt_tokens
 
     if plan:
-        if agent_name in history["content"]["plan"].keys():
-            history["content"]["plan"][agent_name].append(plan)
+        if agent in content["plan"].keys():
+            content["plan"][agent].append(plan)
         else:
-            history["content"]["plan"][agent_name] = [plan]
+            content["plan"][agent] = [plan]
+    return content
 
-    write_file(history["content"], history["file"])
+
+def save_conversation(
+    history,
+    agent_name,
+    full_answer,
+    prompt,
+    round_assign=[],
+    initial=False,
+    prompt_tokens=None,
+    public_answer=None,
+):
+    """
+    Add the turn to the history and persist it:
+    appended to the session's journal if there is one, otherwise by rewriting the history file.
+    prompt_tokens: local token count of the whole request of the turn (initial prompt and slot prompt)
+    public_answer: public answer already shown to the other agents (pipelined turns), extracted if None
+    """
+    start = time.perf_counter()
+
+    with phase(history.get("telemetry"), "parsing", agent=agent_name):
+        extracted_answer, plan = process_answer(full_answer)
+    if public_answer is None:
+        public_answer = extracted_answer
+
+    record = {
+        "type": "turn",
+        "agent": agent_name,
+        "prompt": prompt,
+        "full_answer": full_answer,
+        "public_answer": public_answer,
+        "plan": plan,
+        "initial": initial,
+        "slot_assignment": round_assign if initial else None,
+        "prompt_tokens": prompt_tokens,
+    }
+    apply_turn(history["content"], **{k: v for k, v in record.items() if k != "type"})
+
+    if history.get("journal") is not None:
+        history["journal"].append(record, history["content"])
+    else:
+        write_file(history["content"], history["file"])
+    if history.get("telemetry") is not None:
+        history["telemetry"].record(
+            "phase",
+            name="save_conversation",
+            duration=time.perf_counter() - start,
+            agent=agent_name,
+        )
     return history
 
 
+def close_history(history):
+    """
+    Compact the journal into the history file and wait for pending writes.
+    """
+    if history.get("journal") is not None:
+        history["journal"].close(history["content"])
+        history["journal"] = None
+
+
 def extract_answer(answer):
     # extract final answer by removing scratchpad
     if "<ANSWER>" and "</ANSWER>" in answer:
@@ -71,34 +142,65 @@ def create_outfiles(args, OUTPUT_DIR):
     """
     create output dirs of experiment if it does not exit
     if restart:
-        load output files from args.output_file
+        load output files from args.output_file (replaying its journal if it is ahead of the history file)
         find next round to start from
         load the same agent assignment per rounds
     else:
         create new dirs, initialize history files and random assignment arrays and start from round 0
+    unless args.no_journal, turns are appended to a journal (see journal.py) instead of rewriting the history file
     """
 
     history = {}
+    use_journal = not getattr(args, "no_journal", False)
 
     if not os.path.isdir(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
     if args.restart:
         history["file"] = os.path.join(OUTPUT_DIR, args.output_file)
+        journal_file = get_journal_file(history["file"])
 
-        with open(history["file"], "r") as file:
-            history["content"] = json.load(file)
+        history["content"], from_journal = load_history(history["file"], apply_turn)
+        if history["content"] is None:
+            raise FileNotFoundError(f"Nothing to restart from: {history['file']}")
 
         round_start = int(history["content"]["finished_rounds"])
         round_assign = history["content"]["slot_assignment"]
+
+        if use_journal:
+            if not from_journal and os.path.exists(journal_file):
+                # behind the history file: new turns must not be appended to it
+                os.remove(journal_file)
+            history["journal"] = JournalWriter(
+                journal_file, history["file"], getattr(args, "compact_every", 0)
+            )
+            if not from_journal:
+                # the journal of a session continued from its history file begins with the history so far
+                history["journal"].append(
+                    {"type": "snapshot", "content": snapshot(history["content"])},
+                    history["content"],
+                )
     else:
-        time_str = time.strftime("%H_%M_%S", time.localtime())
-        output_file = os.path.join(
-            OUTPUT_DIR, args.output_file.split(".json")[0] + time_str + ".json"
-        )
+        if getattr(args, "no_timestamp", False):
+            output_file = os.path.join(OUTPUT_DIR, args.output_file)
+        else:
+            time_str = time.strftime("%H_%M_%S", time.localtime())
+            # concurrent sessions of the same experiment start within the same second
+            session_id = getattr(args, "session_id", "")
+            if session_id:
+                time_str += "_" + session_id
+            output_file = os.path.join(
+                OUTPUT_DIR, args.output_file.split(".json")[0] + time_str + ".json"
+            )
 
         round_start = 0
 
         history = {"file": output_file, "content": {}}
         round_assign = []
+        if use_journal:
+            history["journal"] = JournalWriter(
+                get_journal_file(output_file),
+                output_file,
+                getattr(args, "compact_every", 0),
+            )
 
     return round_assign, round_start, history
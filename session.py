@@ -0,0 +1,446 @@
+"""
+Negotiation session runner.
+
+A session is one full negotiation game (initial deal, rounds_num rounds, final deal by p1).
+run_session() is a coroutine so that many independent sessions can be driven from one process;
+the blocking model calls are executed in worker threads, while the turns of each session stay in strict order.
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import os
+import shutil
+import traceback
+
+from agent import Agent
+from backends import parse_model
+from cassette import Cassette
+from hf_batching import get_batcher
+from hf_prefix_cache import get_prefix_cache
+from initial_prompts import InitialPrompt
+from llm_cache import get_cache
+from mystuff.moderator_agent import Moderator
+from mystuff.moderator_initial_prompt import ModeratorInitialPrompt
+from mystuff.moderator_round_prompts import ModeratorRoundPrompts
+from rounds import RoundPrompts
+from save_utils import close_history, create_outfiles, save_conversation
+from telemetry import SpanRecorder, get_spans_file
+from utils import load_setup, randomize_agents_order, read_config, setup_hf_model
+
+
+def get_output_dir(args):
+    return os.path.join(args.game_dir, args.output_dir, args.exp_name)
+
+
+def setup_agents(args, hf_models, cassette=None, telemetry=None):
+    """
+    Load the game setup and instantiate the agents (and the moderator if args.moderator).
+    hf_models is shared between sessions, so each Hugging Face model is only loaded once per process.
+    cassette is the session's record/replay cassette, telemetry its SpanRecorder, if any.
+
+    Returns:
+        agents: dict of agent_name to config entries, with the Agent under "instance"
+        role_to_agent_names: dict of roles (veto) to agent names
+        moderator_agent: Moderator instance or None
+    """
+    # Load setups of agents from config file. File should contain names, file names, roles, incentives, and models
+    # Also load initial deal file and return a dict of role to agent names
+    agents, initial_deal, role_to_agent_names = load_setup(
+        args.game_dir,
+        args.agents_num,
+        getattr(args, "config_file", "config.txt"),
+        getattr(args, "model_override", ""),
+    )
+
+    cache = None
+    if getattr(args, "cache_path", ""):
+        cache = get_cache(args.cache_path, int(args.cache_max_mb * 1024**2))
+
+    # Instaniate agents (initial prompt, round prompt, agent class)
+    replay = cassette is not None and cassette.mode == "replay"
+    for name, agent in agents.items():
+        provider, model_name = parse_model(agent["model"], args.azure)
+        if provider == "hf" and not agent["model"] in hf_models and not replay:
+            hf_models[agent["model"]] = setup_hf_model(model_name, cache_dir=args.hf_home)
+        hf_batcher, hf_prefix_cache = None, None
+        if agent["model"] in hf_models and getattr(args, "hf_prefix_cache_mb", 0) > 0:
+            # generation with cached prefixes is done one prompt at a time, it takes precedence over batching
+            hf_prefix_cache = get_prefix_cache(
+                agent["model"],
+                hf_models[agent["model"]],
+                max_bytes=int(args.hf_prefix_cache_mb * 1024**2),
+            )
+        elif agent["model"] in hf_models and getattr(args, "hf_batch_size", 1) > 1:
+            hf_batcher = get_batcher(
+                agent["model"],
+                hf_models[agent["model"]],
+                max_batch_size=args.hf_batch_size,
+                max_wait=args.hf_batch_wait,
+            )
+
+        inital_prompt_agent = InitialPrompt(
+            args.game_dir,
+            name,
+            agent["file_name"],
+            role_to_agent_names["p1"],
+            role_to_agent_names["p2"],
+            num_issues=args.issues_num,
+            num_agents=args.agents_num,
+            incentive=agent["incentive"],
+        )
+
+        round_prompt_agent = RoundPrompts(
+            name,
+            role_to_agent_names["p1"],
+            initial_deal,
+            incentive=agent["incentive"],
+            window_size=args.window_size,
+            target_agent=role_to_agent_names.get("target", ""),
+            rounds_num=args.rounds_num,
+            agents_num=args.agents_num,
+            prompt_layout=getattr(args, "prompt_layout", "default"),
+            history_token_budget=getattr(args, "history_token_budget", 0),
+            max_tokens=getattr(args, "max_tokens", 0),
+            first_round_max_tokens=getattr(args, "first_round_max_tokens", 0),
+            tokenizer=hf_models[agent["model"]][1] if agent["model"] in hf_models else None,
+        )
+
+        agent_instance = Agent(
+            inital_prompt_agent,
+            round_prompt_agent,
+            name,
+            args.temp,
+            model=agent["model"],
+            azure=args.azure,
+            hf_models=hf_models,
+            cache=cache,
+            cassette=cassette,
+            hf_batcher=hf_batcher,
+            hf_prefix_cache=hf_prefix_cache,
+            telemetry=telemetry,
+        )
+        agent["instance"] = agent_instance
+
+    # Initialize moderator agent
+    moderator_agent = None
+    if args.moderator:
+        initial_prompt_moderator = ModeratorInitialPrompt(
+            None,
+            None,
+            None,
+            role_to_agent_names["p1"],
+            role_to_agent_names["p2"],
+            args.issues_num,
+            args.agents_num,
+            incentive="cooperative",
+        )
+        round_prompt_moderator = ModeratorRoundPrompts(
+            None,
+            role_to_agent_names["p1"],
+            initial_deal,
+            "cooperative",
+            window_size=args.window_size,
+            rounds_num=args.rounds_num,
+            agents_num=args.agents_num,
+            prompt_layout=getattr(args, "prompt_layout", "default"),
+            history_token_budget=getattr(args, "history_token_budget", 0),
+            max_tokens=getattr(args, "max_tokens", 0),
+        )
+        moderator_agent = Moderator(
+            initial_prompt_moderator,
+            round_prompt_moderator,
+            "Moderator",
+            args.temp,
+            "gpt-4o-mini",
+            cache=cache,
+            cassette=cassette,
+            telemetry=telemetry,
+        )
+
+    return agents, role_to_agent_names, moderator_agent
+
+
+def get_cassette(args, history_file):
+    """
+    Record/replay cassette of the session, or None.
+    By default, recorded cassettes are saved next to the history file as cassette_<history name>.jsonl.
+    Replay cassettes are either recorded cassettes or history*.json files.
+    With several sessions, an explicit --cassette_path becomes <path>_<session id>.<ext> (when recording and
+    replaying alike), so concurrent sessions never share a cassette.
+    """
+    mode = getattr(args, "cassette_mode", "")
+    if not mode:
+        return None
+    if args.restart:
+        raise ValueError("Cassettes replay or record whole sessions, they cannot be used with --restart.")
+    path = args.cassette_path
+    session_id = getattr(args, "session_id", "")
+    if path and session_id:
+        root, ext = os.path.splitext(path)
+        path = f"{root}_{session_id}{ext}"
+    if mode == "record" and not path:
+        path = os.path.join(
+            os.path.dirname(history_file),
+            "cassette_" + os.path.basename(history_file).split(".json")[0] + ".jsonl",
+        )
+    return Cassette(path, mode)
+
+
+def log_response(args, speaker, response, sep="====="):
+    session_id = getattr(args, "session_id", "")
+    tag = f"[{args.exp_name}:{session_id}] " if session_id else ""
+    print(sep)
+    print(f"{tag}{speaker} response: {response}")
+
+
+class TurnPipeline:
+    """
+    Plays the turns of a session in order and saves them.
+    If pipelined, agents' responses are streamed: as soon as the public answer of a turn is complete
+    (</ANSWER>), the next turn starts with that answer in its history, while the previous agent is still
+    generating its plan. A turn is saved (in order) once it is complete, and always before its agent speaks again.
+    """
+
+    def __init__(self, args, history, pipelined=False):
+        self.args = args
+        self.history = history
+        self.pipelined = pipelined
+        self.pending = None  # turn whose public answer is known but whose response may not be complete
+
+    def view(self):
+        """
+        History seen by the next speaker: the saved turns and the public answer of the pending one.
+        """
+        content = self.history["content"]
+        if self.pending is None:
+            return content
+        pending_round = {
+            "agent": self.pending["agent_name"],
+            "public_answer": self.pending["public_answer"],
+        }
+        return {
+            "rounds": content.get("rounds", []) + [pending_round],
+            "plan": content.get("plan", {}),
+        }
+
+    async def play(self, agent_name, agent, round_idx, **save_kwargs):
+        if self.pending is not None and self.pending["agent_name"] == agent_name:
+            # the agent's last plan is part of its prompt
+            await self.flush()
+        if not self.pipelined:
+            slot_prompt, agent_response = await asyncio.to_thread(
+                agent.execute_round, self.history["content"], round_idx
+            )
+            self.save(agent_name, slot_prompt, agent_response, agent.prompt_tokens, save_kwargs)
+            return
+
+        loop = asyncio.get_running_loop()
+        answer = loop.create_future()
+
+        def on_answer(public_answer):
+            loop.call_soon_threadsafe(
+                lambda: answer.done() or answer.set_result(public_answer)
+            )
+
+        task = asyncio.ensure_future(
+            asyncio.to_thread(agent.execute_round, self.view(), round_idx, on_answer)
+        )
+        # backends without streaming (or answers without <ANSWER> tags) only return the whole response
+        await asyncio.wait({answer, task}, return_when=asyncio.FIRST_COMPLETED)
+        if task.done() and task.exception() is not None:
+            raise task.exception()
+        public_answer = answer.result() if answer.done() else None
+        await self.flush()
+        self.pending = {
+            "agent_name": agent_name,
+            "task": task,
+            "public_answer": public_answer,
+            "prompt_tokens": agent.prompt_tokens,
+            "save_kwargs": save_kwargs,
+        }
+        if public_answer is None:
+            # no early answer, the next turn needs the extracted one
+            await self.flush()
+
+    async def flush(self):
+        """
+        Wait for the pending turn to complete and save it.
+        """
+        if self.pending is None:
+            return
+        pending, self.pending = self.pending, None
+        slot_prompt, agent_response = await pending["task"]
+        self.save(
+            pending["agent_name"],
+            slot_prompt,
+            agent_response,
+            pending["prompt_tokens"],
+            dict(pending["save_kwargs"], public_answer=pending["public_answer"]),
+        )
+
+    def save(self, agent_name, slot_prompt, agent_response, prompt_tokens, save_kwargs):
+        self.history = save_conversation(
+            self.history,
+            agent_name,
+            agent_response,
+            slot_prompt,
+            prompt_tokens=prompt_tokens,
+            **save_kwargs,
+        )
+        log_response(self.args, agent_name, agent_response)
+
+
+async def run_session(args, hf_models=None):
+    """
+    Run one negotiation session described by args (same arguments as main.py).
+    Returns the history dict ({"file": ..., "content": ...}).
+    """
+    if hf_models is None:
+        hf_models = {}
+    output_dir = get_output_dir(args)
+
+    # Create output file, or load files if restart is given to continue on last experiments
+    agent_round_assignment, start_round_idx, history = create_outfiles(
+        args, output_dir
+    )
+
+    # Dump config file and scores in output_dir
+    # (the config actually used, since the config file and models can be overridden)
+    config_lines = read_config(
+        args.game_dir,
+        getattr(args, "config_file", "config.txt"),
+        getattr(args, "model_override", ""),
+    )
+    with open(os.path.join(output_dir, "config.txt"), "w") as f:
+        f.write("\n".join(config_lines) + "\n")
+    shutil.copytree(
+        os.path.join(args.game_dir, "scores_files"),
+        os.path.join(output_dir, "scores_files"),
+        dirs_exist_ok=True,
+    )
+
+    cassette = get_cassette(args, history["file"])
+    telemetry = None
+    if not getattr(args, "no_telemetry", False):
+        telemetry = SpanRecorder(get_spans_file(history["file"]))
+        history["telemetry"] = telemetry
+    agents, role_to_agent_names, moderator_agent = setup_agents(
+        args, hf_models, cassette, telemetry
+    )
+
+    # If not restart, agent_round_assignment is empty, then randomize order
+    if cassette is not None and cassette.mode == "replay":
+        agent_round_assignment = cassette.slot_assignment
+    elif not args.restart:
+        agent_round_assignment = randomize_agents_order(
+            agents, role_to_agent_names["p1"], args.rounds_num
+        )
+    if cassette is not None:
+        cassette.set_slot_assignment(agent_round_assignment)
+
+    turns = TurnPipeline(args, history, pipelined=getattr(args, "pipeline_turns", False))
+    try:
+        for round_idx in range(start_round_idx, args.rounds_num):
+            if round_idx == 0:
+                # For first round, initialize with p1 suggesting the first deal from 'initial_deal.txt' file
+                current_agent = role_to_agent_names["p1"]
+                await turns.play(
+                    current_agent,
+                    agents[current_agent]["instance"],
+                    round_idx,
+                    round_assign=agent_round_assignment,
+                    initial=True,
+                )
+
+            # Continue with rounds
+            # Get next agent
+            if moderator_agent:
+                slot_prompt, agent_response = await asyncio.to_thread(
+                    moderator_agent.execute_round, turns.view(), round_idx
+                )
+                # TODO: For now we don't save the moderator's response in the history.
+                # history = save_conversation(history, "Moderator", agent_response, slot_prompt, agent_round_assignment)
+                current_agent = moderator_agent.get_next_speaker(agent_response)
+                log_response(args, "Moderator", agent_response, sep="*****")
+            else:
+                current_agent = agent_round_assignment[round_idx]
+            # Query next agent
+            await turns.play(current_agent, agents[current_agent]["instance"], round_idx)
+
+        # Final deal by P1
+        print(" ==== Deal Suggestions ==== ")
+        current_agent = role_to_agent_names["p1"]
+        await turns.play(current_agent, agents[current_agent]["instance"], args.rounds_num)
+        await turns.flush()
+    finally:
+        # journaled turns are compacted into the history file, also if the session failed
+        close_history(history)
+    if cassette is not None and cassette.prompt_mismatches:
+        print(
+            f"Warning: {cassette.prompt_mismatches} prompts differ from the cassette {cassette.path}"
+        )
+    return history
+
+
+def expand_sessions(args, session_overrides=None, num_sessions=1):
+    """
+    Build one argparse.Namespace per session.
+    session_overrides is a list of dicts overriding main.py arguments (e.g. game_dir, exp_name);
+    each resulting configuration is repeated num_sessions times.
+    With --restart, every session resumes its own output_file (e.g., one per entry of session_overrides):
+    sessions sharing one history file would overwrite each other's turns.
+    """
+    if not session_overrides:
+        session_overrides = [{}]
+    sessions_args = []
+    for overrides in session_overrides:
+        for _ in range(num_sessions):
+            session_args = argparse.Namespace(**vars(args))
+            for key, value in overrides.items():
+                setattr(session_args, key, value)
+            session_args.session_id = (
+                str(len(sessions_args)) if num_sessions * len(session_overrides) > 1 else ""
+            )
+            sessions_args.append(session_args)
+    if getattr(args, "restart", False):
+        histories = collections.Counter(
+            os.path.join(get_output_dir(session_args), session_args.output_file) for session_args in sessions_args
+        )
+        shared = [history for history, count in histories.items() if count > 1]
+        if shared:
+            raise ValueError(
+                f"--restart with several sessions resuming the same history file ({', '.join(shared)}): "
+                "give each session its own output_file (e.g., in --sessions_file)"
+            )
+    return sessions_args
+
+
+async def run_sessions(sessions_args, max_concurrency=4):
+    """
+    Run independent sessions concurrently, at most max_concurrency at the same time.
+    A failing session does not stop the others; its exception is returned in place of its history.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    hf_models = {}
+    # one worker thread per model call in flight: one per running session, two with pipelined turns
+    calls_per_session = 2 if getattr(sessions_args[0], "pipeline_turns", False) else 1
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency * calls_per_session)
+    )
+
+    async def run_one(session_args):
+        async with semaphore:
+            return await run_session(session_args, hf_models)
+
+    results = await asyncio.gather(
+        *[run_one(session_args) for session_args in sessions_args],
+        return_exceptions=True,
+    )
+    for session_args, result in zip(sessions_args, results):
+        if isinstance(result, BaseException):
+            print(f"Session {session_args.exp_name}:{session_args.session_id} failed:")
+            traceback.print_exception(result)
+    if getattr(sessions_args[0], "cache_path", ""):
+        print(f"Response cache: {get_cache(sessions_args[0].cache_path).stats()}")
+    return results
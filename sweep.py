@@ -0,0 +1,266 @@
+"""
+Resumable experiment sweeps.
+
+A sweep spec (JSON) describes a grid of session configurations:
+    {
+        "name": "paper_grid",
+        "args": {"rounds_num": 24, "agents_num": 6, "issues_num": 5},
+        "grid": {
+            "game_dir": ["./games_descriptions/base", "./games_descriptions/game1"],
+            "config_file": ["config.txt"],
+            "model_override": ["openai:gpt-4o", "gemini:gemini-1.5-pro"]
+        },
+        "repetitions": 3,
+        "max_concurrency": 8,
+        "provider_concurrency": {"openai": 8, "gemini": 2, "hf": 1}
+    }
+"args" are main.py arguments shared by all sessions, "grid" maps main.py arguments to the values to sweep
+(all combinations are run), and every configuration is repeated "repetitions" times.
+
+Each configuration is identified by the hash of its arguments; its sessions are saved in
+<game_dir>/<output_dir>/<name>/<hash>/history_rep<N>.json. Running the sweep again skips complete sessions
+and resumes interrupted ones from their history (journal), so completed turns are not requested again.
+The status of all sessions is indexed by configuration hash in sweep_<name>.json next to the spec.
+
+Run with:
+    python sweep.py <SPEC>.json [--dry_run]
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import time
+import traceback
+
+from backends import parse_model
+from journal import load_history, write_file_atomic
+from main import configure, parser as main_parser
+from save_utils import apply_turn
+from session import get_output_dir, run_session
+from utils import read_config
+
+
+def config_hash(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+def expand_grid(spec):
+    """
+    Configurations of the sweep: the shared args combined with each point of the grid.
+    """
+    grid = spec.get("grid", {})
+    keys = sorted(grid)
+    configs = []
+    for values in itertools.product(*(grid[key] for key in keys)):
+        config = dict(spec.get("args", {}))
+        config.update(zip(keys, values))
+        configs.append(config)
+    return configs
+
+
+def load_history_content(history_file):
+    """
+    History content of a session (replaying its journal if it is ahead of the history file), or None if it never started.
+    """
+    return load_history(history_file, apply_turn)[0]
+
+
+def session_status(history_file, rounds_num):
+    """
+    ("new" | "incomplete" | "complete", number of finished rounds) of a session.
+    """
+    content = load_history_content(history_file)
+    if content is None:
+        return "new", 0
+    finished_rounds = content.get("finished_rounds", 0)
+    # the initial deal, rounds_num rounds and the final deal
+    if finished_rounds >= rounds_num + 1:
+        return "complete", finished_rounds
+    return "incomplete", finished_rounds
+
+
+def get_providers(session_args):
+    """
+    Providers used by a session (its agents' models and the moderator's).
+    """
+    providers = set()
+    for line in read_config(session_args.game_dir, session_args.config_file, session_args.model_override):
+        providers.add(parse_model(line.split(",")[-1].strip(), session_args.azure)[0])
+    if session_args.moderator:
+        providers.add("openai")
+    return sorted(providers)
+
+
+def build_sessions(spec, base_args):
+    """
+    One entry per session of the sweep: configuration hash, repetition, arguments, history file and status.
+    """
+    sessions = []
+    for config in expand_grid(spec):
+        key = config_hash(config)
+        for repetition in range(spec.get("repetitions", 1)):
+            session_args = argparse.Namespace(**vars(base_args))
+            for name, value in config.items():
+                if not hasattr(base_args, name):
+                    raise ValueError(f"Unknown main.py argument in the sweep spec: {name}")
+                setattr(session_args, name, value)
+            session_args.exp_name = os.path.join(spec["name"], key)
+            session_args.output_file = f"history_rep{repetition}.json"
+            session_args.no_timestamp = True
+            session_args.session_id = f"{key}:{repetition}"
+            history_file = os.path.join(get_output_dir(session_args), session_args.output_file)
+            status, finished_rounds = session_status(history_file, session_args.rounds_num)
+            # interrupted sessions continue from their history
+            session_args.restart = status == "incomplete"
+            sessions.append(
+                {
+                    "hash": key,
+                    "config": config,
+                    "repetition": repetition,
+                    "args": session_args,
+                    "file": history_file,
+                    "status": status,
+                    "finished_rounds": finished_rounds,
+                }
+            )
+    return sessions
+
+
+class SweepIndex:
+    """
+    Status of the sweep's sessions by configuration hash, rewritten (atomically) after every session.
+    """
+
+    def __init__(self, path, sessions):
+        self.path = path
+        self.index = {}
+        for session in sessions:
+            entry = self.index.setdefault(
+                session["hash"], {"config": session["config"], "sessions": {}}
+            )
+            entry["sessions"][str(session["repetition"])] = self.session_entry(session)
+        self.write()
+
+    def session_entry(self, session):
+        return {
+            "file": session["file"],
+            "status": session["status"],
+            "finished_rounds": session["finished_rounds"],
+        }
+
+    def update(self, session):
+        self.index[session["hash"]]["sessions"][str(session["repetition"])] = self.session_entry(session)
+        self.write()
+
+    def write(self):
+        write_file_atomic(self.index, self.path)
+
+
+async def run_sweep(spec, base_args, index_path, max_concurrency=4, provider_concurrency=None):
+    """
+    Run the sessions of the sweep that are not complete, at most max_concurrency at the same time
+    and at most provider_concurrency[provider] at the same time per provider.
+    """
+    sessions = build_sessions(spec, base_args)
+    index = SweepIndex(index_path, sessions)
+    todo = [session for session in sessions if session["status"] != "complete"]
+    print(
+        f"{len(sessions)} sessions, {len(sessions) - len(todo)} complete, "
+        f"{sum(session['status'] == 'incomplete' for session in todo)} to resume, "
+        f"{sum(session['status'] == 'new' for session in todo)} to start"
+    )
+
+    provider_concurrency = provider_concurrency or {}
+    semaphore = asyncio.Semaphore(max_concurrency)
+    provider_semaphores = {
+        provider: asyncio.Semaphore(limit) for provider, limit in provider_concurrency.items()
+    }
+    hf_models = {}
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=2 * max_concurrency)
+    )
+
+    async def run_one(session):
+        # provider slots are taken first, in a fixed (sorted) order so sessions never wait on each other in a
+        # cycle, and the global slot last: sessions waiting for a saturated provider do not hold global slots
+        semaphores = [
+            provider_semaphores[provider]
+            for provider in get_providers(session["args"])
+            if provider in provider_semaphores
+        ]
+        acquired = []
+        try:
+            for provider_semaphore in semaphores:
+                await provider_semaphore.acquire()
+                acquired.append(provider_semaphore)
+            async with semaphore:
+                try:
+                    history = await run_session(session["args"], hf_models)
+                    session["finished_rounds"] = history["content"].get("finished_rounds", 0)
+                    session["status"] = "complete"
+                except Exception:
+                    traceback.print_exc()
+                    session["status"], session["finished_rounds"] = session_status(
+                        session["file"], session["args"].rounds_num
+                    )
+                    if session["status"] != "complete":
+                        session["status"] = "failed"
+        finally:
+            for provider_semaphore in reversed(acquired):
+                provider_semaphore.release()
+        index.update(session)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_one(session) for session in todo))
+    failed = sum(session["status"] == "failed" for session in todo)
+    print(f"Sweep done in {time.perf_counter() - start:.1f}s, {failed} sessions failed")
+    return sessions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="resumable sweep of negotiation sessions")
+    parser.add_argument("spec", help="JSON sweep spec")
+    parser.add_argument(
+        "--index_file",
+        type=str,
+        default="",
+        help="status index of the sweep, defaults to sweep_<name>.json next to the spec",
+    )
+    parser.add_argument("--max_concurrency", type=int, default=0, help="overrides the spec's")
+    parser.add_argument(
+        "--dry_run", action="store_true", help="only print the status of the sweep's sessions"
+    )
+    args = parser.parse_args()
+
+    with open(args.spec, "r") as f:
+        spec = json.load(f)
+    # process-wide settings (keys, rate limits, ...) are taken from the spec's shared args
+    base_args = main_parser.parse_args([])
+    for name, value in spec.get("args", {}).items():
+        setattr(base_args, name, value)
+    index_path = args.index_file or os.path.join(
+        os.path.dirname(os.path.abspath(args.spec)), f"sweep_{spec['name']}.json"
+    )
+
+    if args.dry_run:
+        for session in build_sessions(spec, base_args):
+            print(
+                f"{session['hash']} rep {session['repetition']}: {session['status']} "
+                f"({session['finished_rounds']} rounds) {session['file']}"
+            )
+    else:
+        configure(base_args)
+        sessions = asyncio.run(
+            run_sweep(
+                spec,
+                base_args,
+                index_path,
+                max_concurrency=args.max_concurrency or spec.get("max_concurrency", 4),
+                provider_concurrency=spec.get("provider_concurrency"),
+            )
+        )
+        if any(session["status"] == "failed" for session in sessions):
+            raise SystemExit(1)
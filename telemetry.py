@@ -0,0 +1,246 @@
+"""
+Per-call telemetry of negotiation sessions.
+
+Each session writes JSONL spans next to its history file (spans_<history name>.jsonl):
+    - "llm_call" spans: agent, model, round, prompt build time, queue wait (rate limiter), time to first
+      token (streaming backends only), total latency, prompt/completion/cached tokens (as reported by the
+      provider), retries, estimated cost, and the round prompt layout
+    - "phase" spans: duration of build_slot_prompt, parsing and save_conversation
+
+Aggregate the spans of one or many experiment directories with:
+    python telemetry.py report <OUTPUT_DIR> [<OUTPUT_DIR> ...]
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# USD per 1M tokens: (prompt, cached prompt, completion). Models are matched by the longest prefix.
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.6),
+    "gpt-4o": (2.5, 1.25, 10.0),
+    "gpt-4-turbo": (10.0, 10.0, 30.0),
+    "gpt-4-32k": (60.0, 60.0, 120.0),
+    "gpt-4": (30.0, 30.0, 60.0),
+    "gpt-35-turbo": (0.5, 0.5, 1.5),
+    "gpt-3.5-turbo": (0.5, 0.5, 1.5),
+    "gemini-1.0-pro": (0.5, 0.5, 1.5),
+    "gemini-1.5-pro": (1.25, 0.3125, 5.0),
+    "gemini-1.5-flash": (0.075, 0.01875, 0.3),
+}
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    """
+    Estimated cost in USD, None for unknown (e.g., local) models.
+    """
+    matches = [name for name in PRICES if model.startswith(name)]
+    if not matches or prompt_tokens is None or completion_tokens is None:
+        return None
+    prompt_price, cached_price, completion_price = PRICES[max(matches, key=len)]
+    cached_tokens = cached_tokens or 0
+    return (
+        (prompt_tokens - cached_tokens) * prompt_price
+        + cached_tokens * cached_price
+        + completion_tokens * completion_price
+    ) / 1e6
+
+
+def get_openai_usage(response):
+    """
+    Prompt, completion and cached tokens of an OpenAI chat completion (or final stream chunk).
+    """
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return {}
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "cached_tokens": getattr(details, "cached_tokens", None) if details else None,
+    }
+
+
+def get_spans_file(history_file):
+    return os.path.join(
+        os.path.dirname(history_file),
+        "spans_" + os.path.basename(history_file).split(".json")[0] + ".jsonl",
+    )
+
+
+class SpanRecorder:
+    """
+    Appends the spans of one session to a JSONL file. Shared by the session's agents.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, span_type, **fields):
+        span = {"type": span_type, "time": time.time(), **fields}
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(span) + "\n")
+
+    def record_call(self, agent, model, round_idx, stats):
+        """
+        Span of one model call. stats is filled by the agent while calling the model.
+        """
+        stats = dict(stats)
+        stats.setdefault("cost", None)
+        if stats.get("cost") is None and not stats.get("cache_hit"):
+            stats["cost"] = estimate_cost(
+                model,
+                stats.get("prompt_tokens"),
+                stats.get("completion_tokens"),
+                stats.get("cached_tokens"),
+            )
+        self.record("llm_call", agent=agent, model=model, round=round_idx, **stats)
+
+    @contextmanager
+    def phase(self, name, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(
+                "phase", name=name, duration=time.perf_counter() - start, **fields
+            )
+
+
+@contextmanager
+def phase(recorder, name, **fields):
+    """
+    recorder.phase if there is a recorder, otherwise nothing.
+    """
+    if recorder is None:
+        yield
+        return
+    with recorder.phase(name, **fields):
+        yield
+
+
+def load_spans(dirs):
+    spans = []
+    for directory in dirs:
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                if not (filename.startswith("spans_") and filename.endswith(".jsonl")):
+                    continue
+                session = os.path.join(root, filename)
+                with open(session, "r") as f:
+                    for line in f:
+                        span = json.loads(line)
+                        span["session"] = session
+                        spans.append(span)
+    return spans
+
+
+def summarize(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": p50, "p95": p95, "p99": p99}
+
+
+def aggregate_calls(calls, key):
+    groups = {}
+    for call in calls:
+        groups.setdefault(call.get(key), []).append(call)
+    rows = []
+    for group, group_calls in sorted(
+        groups.items(), key=lambda item: (item[0] is None, str(type(item[0])), item[0] or 0)
+    ):
+        latency = summarize([call.get("latency") for call in group_calls])
+        costs = [call.get("cost") for call in group_calls if call.get("cost") is not None]
+        prompt_tokens = sum(call.get("prompt_tokens") or 0 for call in group_calls)
+        cached_tokens = sum(call.get("cached_tokens") or 0 for call in group_calls)
+        rows.append(
+            {
+                key: group,
+                "calls": len(group_calls),
+                "latency_p50": latency["p50"],
+                "latency_p95": latency["p95"],
+                "latency_p99": latency["p99"],
+                "ttft_p50": summarize([call.get("ttft") for call in group_calls])["p50"],
+                "queue_wait_p95": summarize(
+                    [call.get("queue_wait") for call in group_calls]
+                )["p95"],
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": sum(
+                    call.get("completion_tokens") or 0 for call in group_calls
+                ),
+                "cached_ratio": cached_tokens / prompt_tokens if prompt_tokens else None,
+                "retries": sum(call.get("retries") or 0 for call in group_calls),
+                "cost": sum(costs) if costs else None,
+            }
+        )
+    return rows
+
+
+def aggregate_phases(phases):
+    groups = {}
+    for span in phases:
+        groups.setdefault(span["name"], []).append(span["duration"])
+    rows = []
+    for name, durations in sorted(groups.items()):
+        row = {"phase": name, "count": len(durations), "total": sum(durations)}
+        row.update(summarize(durations))
+        rows.append(row)
+    return rows
+
+
+def format_table(rows):
+    if not rows:
+        return "(no spans)"
+    columns = list(rows[0].keys())
+
+    def fmt(value):
+        if value is None:
+            return "-"
+        if isinstance(value, float):
+            return f"{value:.4f}"
+        return str(value)
+
+    cells = [[fmt(row[column]) for column in columns] for row in rows]
+    widths = [
+        max(len(column), *(len(row[i]) for row in cells)) for i, column in enumerate(columns)
+    ]
+    lines = ["  ".join(column.ljust(width) for column, width in zip(columns, widths))]
+    for row in cells:
+        lines.append("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+    return "\n".join(lines)
+
+
+def report(dirs):
+    spans = load_spans(dirs)
+    calls = [span for span in spans if span["type"] == "llm_call"]
+    phases = [span for span in spans if span["type"] == "phase"]
+    sessions = len({span["session"] for span in spans})
+    costs = [call["cost"] for call in calls if call.get("cost") is not None]
+    print(
+        f"{sessions} sessions, {len(calls)} model calls, estimated cost: {sum(costs):.4f} USD"
+    )
+    for key in ("agent", "model", "round", "prompt_layout"):
+        print(f"\n==== Calls per {key} ====")
+        print(format_table(aggregate_calls(calls, key)))
+    print("\n==== Phases ====")
+    print(format_table(aggregate_phases(phases)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="negotiation telemetry")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    report_parser = subparsers.add_parser(
+        "report", help="latency, token and cost report of experiment directories"
+    )
+    report_parser.add_argument("dirs", nargs="+")
+    args = parser.parse_args()
+    if args.command == "report":
+        report(args.dirs)
@@ -2,16 +2,15 @@ import os
 import random
 
 import numpy as np
-import openai
-import torch
-import vertexai
-from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, pipeline
 
 
 def setup_hf_model(model_name, cache_dir="/disk1/", max_new_tokens=7000):
     """
     Sets up a Hugging Face model and tokenizer, caching it for future use.
     """
+    # imported here, so that runs without local models do not load transformers and torch
+    from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, pipeline
+
     config = AutoConfig.from_pretrained(
         model_name,
         use_cache=True,
@@ -37,9 +36,20 @@ def setup_hf_model(model_name, cache_dir="/disk1/", max_new_tokens=7000):
     return model, tokenizer, pipeline_gen
 
 
-def load_setup(game_dir, agents_num):
+def read_config(game_dir, config_file="config.txt", model_override=""):
+    """
+    Lines of the agents' config file (relative to game_dir), with every agent's model replaced by model_override if set.
+    """
+    with open(os.path.join(game_dir, config_file), "r") as f:
+        lines = [line.strip() for line in f.readlines() if line.strip()]
+    if model_override:
+        lines = [line.rsplit(",", 1)[0] + "," + model_override for line in lines]
+    return lines
+
+
+def load_setup(game_dir, agents_num, config_file="config.txt", model_override=""):
     """
-    load config files of the experiments (<game_dir>/config.txt)
+    load config files of the experiments (<game_dir>/config.txt, or <game_dir>/<config_file>)
     The config file is organized as: one line per agent.
     Each line should be comma-separated items of:
         1) The name of the agent (as written in the game description file),
@@ -57,8 +67,7 @@ def load_setup(game_dir, agents_num):
         intial deal: deal to kick off, add as input in initial_deal_file
         role_to_agents: dict of roles (veto) to agent names
     """
-    with open(os.path.join(game_dir, "config.txt"), "r") as f:
-        agents_config_file = f.readlines()
+    agents_config_file = read_config(game_dir, config_file, model_override)
 
     agents = {}
     role_to_agents = {}
@@ -89,9 +98,12 @@ def load_setup(game_dir, agents_num):
 
 def set_constants(args):
     if args.gemini:
+        import vertexai
+
         vertexai.init(project=args.gemini_project_name, location=args.gemini_loc)
 
-    openai.api_key = args.api_key
+    if args.api_key:
+        os.environ["OPENAI_API_KEY"] = args.api_key
 
     os.environ["TRANSFORMERS_CACHE"] = args.hf_home
     os.environ["HF_HOME"] = args.hf_home